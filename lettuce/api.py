@@ -1,12 +1,17 @@
 import os
 import secrets 
 import hashlib 
+from contextlib import asynccontextmanager
 from typing import Set 
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, status  
+from fastapi import FastAPI, Depends, HTTPException, Request, status  
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials 
-from routers import pipeline_routes, search_routes
+from components.embeddings import EmbeddingModelName, embedder_registry, embedding_batcher
+from components.executor import QueueFullError, database_executor, inference_executor
+from components.model_pool import llm_batcher, llm_pool
+from routers import model_routes, pipeline_routes, search_routes
 
 
 load_dotenv()
@@ -53,7 +58,25 @@ def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)
     return credentials.credentials
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Preload the embedding models named in PRELOAD_EMBEDDING_MODELS (a comma-separated list of EmbeddingModelName members, e.g. "BGESMALL,MINILM") so the first requests don't pay for loading them
+    """
+    preload = os.getenv("PRELOAD_EMBEDDING_MODELS")
+    if preload:
+        embedder_registry.preload(
+            [EmbeddingModelName[name.strip()] for name in preload.split(",") if name.strip()]
+        )
+    yield
+    inference_executor.shutdown()
+    database_executor.shutdown()
+    embedder_registry.clear()
+    llm_pool.clear()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="OMOP concept Assistant",
     description="The API to assist in identifying OMOP concepts",
     version="0.1.0",
@@ -63,6 +86,33 @@ app = FastAPI(
     },
 )
 
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError) -> JSONResponse:
+    """
+    Ask clients to retry when the inference or database workers are saturated
+    """
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.get("/queues", dependencies=[Depends(verify_api_key)])
+async def queue_stats():
+    """
+    Report the running, queued and refused calls of the inference and database workers, and the queue depth and batch size histograms of LLM and embedding micro-batching
+    """
+    return {
+        **{
+            executor.name: executor.stats()
+            for executor in (inference_executor, database_executor)
+        },
+        "llm_batching": llm_batcher.stats(),
+        "embedding_batching": embedding_batcher.stats(),
+    }
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Adjust as needed
@@ -83,6 +133,12 @@ app.include_router(
     dependencies=[Depends(verify_api_key)]  
 )
 
+app.include_router(
+    router=model_routes.router,
+    prefix="/models",
+    dependencies=[Depends(verify_api_key)]
+)
+
 
 def main():
     import uvicorn
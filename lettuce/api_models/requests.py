@@ -1,5 +1,8 @@
 from typing import Optional, List
 from pydantic import BaseModel
+from components.decoding import SpeculativeDecoding
+from components.llama_runtime import LlamaRuntimeOptions
+from options.pipeline_options import LLMModel
 
 class ConceptSuggestionRequest(BaseModel):
     """
@@ -34,3 +37,33 @@ class ConceptSuggestionRequest(BaseModel):
     standard_concept: bool = False
     valid_concept: bool = False
     top_k: int = 5
+
+
+class ModelPoolRequest(BaseModel):
+    """
+    A model describing API requests to load, reload or unload a model in the LLM model pool
+
+    Attributes
+    ----------
+    llm_model: LLMModel
+        The model to act on
+    temperature: float
+        A temperature in the profile to act on. 0 selects the deterministic instance, anything else the sampled one
+    weights_path: Optional[str]
+        A local GGUF file. If None, the LOCAL_LLM environment variable is used, and if that is unset the model is downloaded
+    n_ctx: Optional[int]
+        The context size of the instance. If None, the configured llama.cpp runtime's is used
+    n_batch: Optional[int]
+        The prompt processing batch size of the instance. If None, the configured llama.cpp runtime's is used
+    speculative_decoding: SpeculativeDecoding
+        How the instance drafts tokens to verify in one batch
+    llm_runtime: Optional[LlamaRuntimeOptions]
+        The llama.cpp settings the instance was loaded with, as sent in a pipeline request's llm_runtime. Settings left out come from the runtime profile, LLAMA_* environment variables and defaults
+    """
+    llm_model: LLMModel
+    temperature: float = 0
+    weights_path: Optional[str] = None
+    n_ctx: Optional[int] = None
+    n_batch: Optional[int] = None
+    speculative_decoding: SpeculativeDecoding = SpeculativeDecoding.NONE
+    llm_runtime: Optional[LlamaRuntimeOptions] = None
@@ -3,6 +3,8 @@ import time
 
 from dotenv import load_dotenv
 
+from components.decoding import DecodingMode, SpeculativeDecoding
+from components.llama_runtime import LlamaRuntimeOptions
 from components.pipeline import LLMPipeline
 from options.pipeline_options import LLMModel
 
@@ -12,6 +14,12 @@ def run(
     temperature: float,
     informal_names: list[str],
     logger: Logger,
+    decoding_mode: DecodingMode | None = None,
+    max_tokens: int | None = None,
+    embed_vocab: list[str] | None = None,
+    grammar_concept_class: list[str] | None = None,
+    speculative_decoding: SpeculativeDecoding | None = None,
+    llm_runtime: LlamaRuntimeOptions | None = None,
 ) -> list[dict]:
     """
     Run the LLM assistant to suggest a formal drug name for an informal medicine name
@@ -26,6 +34,18 @@ def run(
         The informal names of the medications
     logger: Logger
         The logger to use
+    decoding_mode: DecodingMode | None
+        Whether replies are free text or constrained to a single-line drug name
+    max_tokens: int | None
+        The most tokens generated per reply
+    embed_vocab: list[str] | None
+        The vocabularies replies are limited to in vocabulary decoding
+    grammar_concept_class: list[str] | None
+        The concept classes replies are limited to in vocabulary decoding
+    speculative_decoding: SpeculativeDecoding | None
+        How a local LLM drafts tokens to verify in one batch
+    llm_runtime: LlamaRuntimeOptions | None
+        llama.cpp settings for a local LLM
 
     Returns
     -------
@@ -42,7 +62,15 @@ def run(
     load_dotenv()
 
     pipeline = LLMPipeline(
-        llm_model=llm_model, temperature=temperature, logger=logger
+        llm_model=llm_model,
+        temperature=temperature,
+        logger=logger,
+        decoding_mode=decoding_mode,
+        max_tokens=max_tokens,
+        embed_vocab=embed_vocab,
+        grammar_concept_class=grammar_concept_class,
+        speculative_decoding=speculative_decoding,
+        llm_runtime=llm_runtime,
     ).get_simple_assistant()
     start = time.time()
     pipeline.warm_up()
@@ -59,6 +87,8 @@ def run(
 
         logger.info(f"Reply: {replies}")
         logger.info(f"Meta: {meta}")
+        if meta and "prompt_tokens_reused" in meta[0]:
+            logger.info(f"Prompt tokens reused from cache: {meta[0]['prompt_tokens_reused']}")
 
         output = {"reply": replies, "informal_name": informal_name, "meta": meta}
         logger.info(f"LLM Output: {output}")
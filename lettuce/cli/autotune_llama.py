@@ -0,0 +1,199 @@
+import argparse
+import itertools
+import os
+import platform
+import time
+from typing import Dict, List
+
+from llama_cpp import Llama
+
+from components.llama_runtime import KVCacheType, LlamaRuntime, save_runtime_profile
+from components.models import gpu_layers, resolve_weights_path
+from components.prompt import Prompts
+from options.pipeline_options import LLMModel
+from utils.logging_utils import logger
+
+
+def candidate_runtimes(args: argparse.Namespace) -> List[LlamaRuntime]:
+    """
+    Combine the candidate values of each setting, skipping combinations llama.cpp can't run
+    """
+    candidates = []
+    for n_batch, n_threads, kv_type, flash_attn, n_gpu_layers in itertools.product(
+        args.batch_sizes, args.threads, args.kv_types, args.flash_attn, args.gpu_layers
+    ):
+        # A quantized V cache needs flash attention
+        if kv_type not in (KVCacheType.F16, KVCacheType.F32) and not flash_attn:
+            continue
+        candidates.append(
+            LlamaRuntime(
+                n_ctx=args.n_ctx,
+                n_batch=n_batch,
+                max_tokens=args.max_tokens,
+                n_gpu_layers=n_gpu_layers,
+                n_threads=n_threads,
+                n_threads_batch=n_threads,
+                use_mmap=not args.mlock,
+                use_mlock=args.mlock,
+                type_k=kv_type,
+                type_v=kv_type,
+                flash_attn=flash_attn,
+            )
+        )
+    return candidates
+
+
+def benchmark_runtime(
+    path: str, runtime: LlamaRuntime, prompts: List[str], repeats: int
+) -> Dict[str, float]:
+    """
+    Time prompt processing and generation for each prompt with a runtime
+
+    The context is reset before each prompt, so the whole prompt is processed every time.
+    """
+    llama = Llama(model_path=path, **{**runtime.model_kwargs(gpu_layers(runtime)), "verbose": False})
+    try:
+        # Untimed run, so first-call allocations aren't measured
+        llama.create_completion(prompts[0], max_tokens=4, temperature=0)
+        prompt_tokens = 0
+        prompt_seconds = 0.0
+        generated_tokens = 0
+        generate_seconds = 0.0
+        for _ in range(repeats):
+            for prompt in prompts:
+                tokens = llama.tokenize(prompt.encode("utf-8"), special=True)
+                llama.reset()
+                start = time.perf_counter()
+                llama.eval(tokens)
+                prompt_seconds += time.perf_counter() - start
+                prompt_tokens += len(tokens)
+
+                # The evaluated prompt is reused, so this times generation
+                start = time.perf_counter()
+                output = llama.create_completion(prompt, max_tokens=runtime.max_tokens, temperature=0)
+                generate_seconds += time.perf_counter() - start
+                generated_tokens += output["usage"]["completion_tokens"]
+        requests = repeats * len(prompts)
+        return {
+            "prompt_tokens_per_second": prompt_tokens / prompt_seconds,
+            "generated_tokens_per_second": generated_tokens / generate_seconds if generate_seconds else 0.0,
+            "mean_request_ms": (prompt_seconds + generate_seconds) / requests * 1000,
+        }
+    finally:
+        llama.close()
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(
+        description="Benchmark llama.cpp settings for a GGUF model on this host, and write the fastest to a profile that later runs load through LLAMA_RUNTIME_PROFILE"
+    )
+    parser.add_argument(
+        "--llm-model",
+        type=str,
+        default=LLMModel.LLAMA_3_1_8B.name,
+        choices=[model.name for model in LLMModel],
+        help="The model to tune. Its weights are downloaded unless --weights is given",
+    )
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default=os.getenv("LOCAL_LLM") or None,
+        help="A local GGUF file. Defaults to LOCAL_LLM",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=os.getenv("LLAMA_RUNTIME_PROFILE") or "llama_runtime_profile.json",
+        help="Where the profile is written. Defaults to LLAMA_RUNTIME_PROFILE",
+    )
+    parser.add_argument("--n-ctx", type=int, default=1024, help="Context size, which is not tuned")
+    parser.add_argument(
+        "--max-tokens", type=int, default=32, help="Tokens generated per benchmark prompt"
+    )
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[32, 128, 512], help="Candidate n_batch values"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=sorted({max(1, cpu_count // 2), cpu_count}),
+        help="Candidate thread counts, used for both generation and prompt processing",
+    )
+    parser.add_argument(
+        "--kv-types",
+        type=KVCacheType,
+        nargs="+",
+        default=[KVCacheType.F16, KVCacheType.Q8_0],
+        choices=list(KVCacheType),
+        help="Candidate KV cache types",
+    )
+    parser.add_argument(
+        "--flash-attn",
+        type=lambda value: value.lower() in ("1", "true", "yes"),
+        nargs="+",
+        default=[False, True],
+        help="Candidate flash attention settings",
+    )
+    parser.add_argument(
+        "--gpu-layers",
+        type=int,
+        nargs="+",
+        default=[None],
+        help="Candidate GPU layer counts. Defaults to every layer when CUDA or MPS is available",
+    )
+    parser.add_argument(
+        "--mlock", action="store_true", help="Lock the weights in RAM instead of memory-mapping them"
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="Times each prompt is run per candidate")
+    parser.add_argument(
+        "names",
+        type=str,
+        nargs="*",
+        default=["Tylenol", "Advil", "Augmentin", "paracetamol 500mg"],
+        help="Informal names to render benchmark prompts for",
+    )
+    args = parser.parse_args()
+
+    model = LLMModel[args.llm_model]
+    path = resolve_weights_path(model, args.weights, logger)
+    builder = Prompts(model=model, prompt_type="simple").get_prompt()
+    prompts = [builder.run(informal_name=name)["prompt"] for name in args.names]
+
+    results = []
+    for runtime in candidate_runtimes(args):
+        try:
+            result = benchmark_runtime(path, runtime, prompts, args.repeats)
+        except Exception as e:
+            logger.warning(f"Skipping {runtime.model_dump(exclude_none=True)}: {e}")
+            continue
+        results.append((runtime, result))
+        print(
+            f"n_batch={runtime.n_batch:<5} threads={runtime.n_threads:<4} kv={runtime.type_k.value:<5} "
+            f"flash_attn={runtime.flash_attn!s:<6} gpu_layers={runtime.n_gpu_layers!s:<5}"
+            f"{result['prompt_tokens_per_second']:>10.1f} prompt tok/s"
+            f"{result['generated_tokens_per_second']:>10.1f} gen tok/s"
+            f"{result['mean_request_ms']:>10.1f} ms/request"
+        )
+    if not results:
+        raise SystemExit("No candidate settings could be loaded")
+
+    best, best_result = min(results, key=lambda item: item[1]["mean_request_ms"])
+    # The token budget is a per-request choice, so the profile keeps the default
+    best = best.model_copy(update={"max_tokens": LlamaRuntime().max_tokens})
+    save_runtime_profile(
+        args.output,
+        best,
+        model_path=path,
+        host=platform.node(),
+        cpu_count=cpu_count,
+        benchmark=best_result,
+        tuned_at=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+    print(f"\nFastest: {best.model_dump(exclude_none=True)}")
+    print(f"Wrote {args.output}. Set LLAMA_RUNTIME_PROFILE={args.output} to load it")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import os
+import time
+from typing import Dict, List
+
+from components.decoding import SpeculativeDecoding
+from components.embeddings import EmbeddingModelName, Embeddings
+from components.model_pool import ModelPool, PooledGenerator
+from components.prompt import Prompts
+from options.pipeline_options import LLMModel
+from utils.logging_utils import logger
+
+
+def build_prompts(model: LLMModel, names: List[str], rag: bool, vocabularies: List[str]) -> List[str]:
+    """
+    Render the prompt the pipeline would send for each name, with vector search results when rag is set
+    """
+    if not rag:
+        builder = Prompts(model=model, prompt_type="simple").get_prompt()
+        return [builder.run(informal_name=name)["prompt"] for name in names]
+    builder = Prompts(model=model, prompt_type="top_n_RAG").get_prompt()
+    results = Embeddings(
+        model_name=EmbeddingModelName.BGESMALL, embed_vocab=vocabularies, standard_concept=True
+    ).search(names)
+    return [
+        builder.run(
+            informal_name=name,
+            vec_results=[{"content": result["concept"]} for result in name_results],
+        )["prompt"]
+        for name, name_results in zip(names, results)
+    ]
+
+
+def benchmark_mode(
+    model: LLMModel,
+    mode: SpeculativeDecoding,
+    prompts: List[str],
+    args: argparse.Namespace,
+) -> Dict[str, float | List[str]]:
+    pool = ModelPool()
+    llm = PooledGenerator(
+        model=model,
+        temperature=0,
+        weights_path=args.weights,
+        n_ctx=args.n_ctx,
+        max_tokens=args.max_tokens,
+        pool=pool,
+        speculative_decoding=mode,
+    )
+    llm.warm_up()
+    # One untimed run, so first-call allocations aren't measured
+    llm.run(prompts[0])
+
+    tokens = 0
+    elapsed = 0.0
+    replies = []
+    for prompt in prompts:
+        start = time.perf_counter()
+        result = llm.run(prompt)
+        elapsed += time.perf_counter() - start
+        tokens += result["meta"][0].get("usage", {}).get("completion_tokens", 0)
+        replies.append(result["replies"][0].strip())
+    pool.clear()
+    return {
+        "tokens_per_second": tokens / elapsed if elapsed else 0.0,
+        "mean_ms": elapsed / len(prompts) * 1000,
+        "tokens": tokens,
+        "replies": replies,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the generation speed of a local model with and without speculative decoding, at temperature 0"
+    )
+    parser.add_argument("names", type=str, nargs="+", help="Informal names to prompt with")
+    parser.add_argument(
+        "--llm-model",
+        type=str,
+        default=LLMModel.LLAMA_3_1_8B.name,
+        choices=[model.name for model in LLMModel],
+        help="The model to benchmark",
+    )
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default=os.getenv("LOCAL_LLM") or None,
+        help="A local GGUF file. Defaults to LOCAL_LLM, or downloading the model's weights",
+    )
+    parser.add_argument(
+        "--modes",
+        type=SpeculativeDecoding,
+        nargs="+",
+        default=list(SpeculativeDecoding),
+        choices=list(SpeculativeDecoding),
+        help="Speculative decoding modes to compare",
+    )
+    parser.add_argument(
+        "--rag",
+        action="store_true",
+        help="Use the top_n_RAG prompt with vector search results, as the RAG pipeline does",
+    )
+    parser.add_argument(
+        "--vocabulary", type=str, nargs="*", default=["RxNorm"], help="Vocabularies searched for --rag"
+    )
+    parser.add_argument("--max-tokens", type=int, default=128, help="Tokens generated per prompt")
+    parser.add_argument("--n-ctx", type=int, default=1024, help="Context size")
+    args = parser.parse_args()
+
+    model = LLMModel[args.llm_model]
+    prompts = build_prompts(model, args.names, args.rag, args.vocabulary)
+
+    results = {}
+    for mode in args.modes:
+        try:
+            results[mode] = benchmark_mode(model, mode, prompts, args)
+        except ValueError as e:
+            logger.warning(f"Skipping {mode.value}: {e}")
+
+    baseline = results.get(SpeculativeDecoding.NONE)
+    print(f"{len(prompts)} prompts, {model.value}, {'top_n_RAG' if args.rag else 'simple'} prompt")
+    print(f"{'mode':<16}{'tokens/s':>10}{'mean ms':>10}{'tokens':>8}{'speedup':>9}{'same replies':>14}")
+    for mode, result in results.items():
+        speedup = (
+            result["tokens_per_second"] / baseline["tokens_per_second"]
+            if baseline and baseline["tokens_per_second"]
+            else float("nan")
+        )
+        same = (
+            sum(a == b for a, b in zip(result["replies"], baseline["replies"]))
+            if baseline
+            else len(prompts)
+        )
+        print(
+            f"{mode.value:<16}{result['tokens_per_second']:>10.1f}{result['mean_ms']:>10.1f}"
+            f"{result['tokens']:>8}{speedup:>9.2f}{f'{same}/{len(prompts)}':>14}"
+        )
+
+
+if __name__ == "__main__":
+    main()
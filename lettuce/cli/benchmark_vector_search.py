@@ -0,0 +1,127 @@
+import argparse
+import time
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from components.embeddings import PGVectorQuery
+from omop.db_manager import get_session
+from omop.omop_models import Embedding
+from omop.omop_queries import query_vector
+from omop.vector_index import DistanceMetric, RetrievalMode, report_vector_indexes
+
+
+def exact_neighbours(
+    session: Session,
+    queries: List[np.ndarray],
+    top_k: int,
+    metric: DistanceMetric,
+    embed_vocab: List[str] | None,
+) -> List[List[int]]:
+    """
+    Find the true nearest neighbours of each query by disabling index scans, so nothing approximate is used
+    """
+    neighbours = []
+    for query in queries:
+        session.execute(select(func.set_config("enable_indexscan", "off", True)))
+        rows = session.execute(
+            query_vector(query, embed_vocab=embed_vocab, n=top_k, metric=metric)
+        ).mappings().all()
+        session.rollback()
+        neighbours.append([row["id"] for row in rows])
+    return neighbours
+
+
+def benchmark_mode(
+    session: Session,
+    queries: List[np.ndarray],
+    truth: List[List[int]],
+    mode: RetrievalMode,
+    args: argparse.Namespace,
+) -> Dict[str, float]:
+    retriever = PGVectorQuery(
+        session,
+        embed_vocab=args.vocabulary,
+        top_k=args.top_k,
+        ef_search=args.ef_search,
+        probes=args.probes,
+        metric=args.metric,
+        mode=mode,
+        rerank_factor=args.rerank_factor,
+    )
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        documents = retriever.run(query.tolist())["documents"]
+        latencies.append((time.perf_counter() - start) * 1000)
+        session.rollback()
+        found = {doc.id for doc in documents}
+        recalls.append(len(found.intersection(expected)) / len(expected) if expected else 1.0)
+    return {
+        "recall": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(np.mean(latencies)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the recall and latency of each vector retrieval mode against exact search, using embeddings sampled from the table as queries"
+    )
+    parser.add_argument("--queries", type=int, default=100, help="Number of sampled query embeddings")
+    parser.add_argument("--top-k", type=int, default=10, help="Results per query")
+    parser.add_argument(
+        "--modes",
+        type=RetrievalMode,
+        nargs="+",
+        default=list(RetrievalMode),
+        choices=list(RetrievalMode),
+        help="Retrieval modes to benchmark",
+    )
+    parser.add_argument(
+        "--metric",
+        type=DistanceMetric,
+        default=DistanceMetric.COSINE,
+        choices=list(DistanceMetric),
+        help="Distance metric to rank by",
+    )
+    parser.add_argument("--ef-search", type=int, default=None, help="hnsw.ef_search for each query")
+    parser.add_argument("--probes", type=int, default=None, help="ivfflat.probes for each query")
+    parser.add_argument(
+        "--rerank-factor", type=int, default=4, help="Candidates reranked per result in the quantized modes"
+    )
+    parser.add_argument(
+        "--vocabulary", type=str, nargs="*", default=None, help="Restrict results to these vocabularies"
+    )
+    args = parser.parse_args()
+
+    with get_session() as session:
+        queries = [
+            np.asarray(embedding, dtype=np.float32)
+            for embedding in session.execute(
+                select(Embedding.embedding).order_by(func.random()).limit(args.queries)
+            ).scalars()
+        ]
+        session.rollback()
+        truth = exact_neighbours(session, queries, args.top_k, args.metric, args.vocabulary)
+
+        print(f"{len(queries)} queries, top {args.top_k}, {args.metric.value} distance")
+        print(f"{'mode':<10}{'recall':>10}{'p50 ms':>10}{'p95 ms':>10}{'mean ms':>10}")
+        for mode in args.modes:
+            result = benchmark_mode(session, queries, truth, mode, args)
+            print(
+                f"{mode.value:<10}{result['recall']:>10.3f}{result['p50_ms']:>10.2f}"
+                f"{result['p95_ms']:>10.2f}{result['mean_ms']:>10.2f}"
+            )
+
+        print("\nIndexes")
+        for index in report_vector_indexes(session):
+            print(f"{index['name']:<60}{index['size']:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import time
+
+from components.ann_index import export_ann_index, hnswlib
+from omop.db_manager import get_session
+from utils.logging_utils import logger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the embeddings table to an in-process ANN index for the ann retriever backend"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        required=True,
+        help="Directory the index files are written to. Point ANN_INDEX_PATH at it to use the index",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float16",
+        choices=["float16", "float32"],
+        help="Storage type of the memory-mapped vector matrix",
+    )
+    parser.add_argument(
+        "--hnsw",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Build an HNSW graph (requires hnswlib). Without one, searches are exact",
+    )
+    parser.add_argument("--m", type=int, default=16, help="HNSW links per node")
+    parser.add_argument(
+        "--ef-construction", type=int, default=200, help="HNSW build candidate list size"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=10000, help="Rows streamed from the database at a time"
+    )
+    args = parser.parse_args()
+
+    if args.hnsw and hnswlib is None:
+        logger.warning("hnswlib is not installed, so no HNSW graph will be built. Install lettuce[ann] to build one")
+
+    start = time.time()
+    with get_session() as session:
+        count = export_ann_index(
+            session,
+            args.output_dir,
+            dtype=args.dtype,
+            build_hnsw=args.hnsw,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            chunk_size=args.chunk_size,
+        )
+    logger.info(f"Exported {count} embeddings to {args.output_dir} in {time.time() - start} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import time
+
+from components.embeddings import EmbeddingModelName, get_embedding_model
+from components.embeddings_builder import build_embeddings
+from omop.db_manager import engine
+from utils.logging_utils import logger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build or refresh the concept embeddings table. Only new or changed concepts are embedded, so an interrupted build resumes when rerun"
+    )
+    parser.add_argument(
+        "--embedding-model",
+        type=EmbeddingModelName,
+        default=EmbeddingModelName.BGESMALL,
+        choices=list(EmbeddingModelName),
+        help="Model to embed concept names with",
+    )
+    parser.add_argument(
+        "--prefix", type=str, default="", help="Prefix put before each concept name, e.g. 'passage: ' for E5 models"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Worker processes embedding concept names"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=256, help="Names embedded per inference call"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=8192, help="Concepts read, embedded and loaded as a unit"
+    )
+    parser.add_argument(
+        "--vocabulary",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Only embed concepts from these vocabularies",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Empty the embeddings table and embed every concept again",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete embeddings for concepts no longer in the concept table",
+    )
+    args = parser.parse_args()
+
+    start = time.time()
+    progress = 0
+
+    def log_progress(n: int) -> None:
+        nonlocal progress
+        progress += n
+        logger.info(f"Embedded {progress} concepts ({progress / (time.time() - start):.0f}/s)")
+
+    summary = build_embeddings(
+        engine,
+        get_embedding_model(args.embedding_model),
+        prefix=args.prefix,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+        vocabularies=args.vocabulary,
+        full=args.full,
+        prune=args.prune,
+        on_chunk=log_progress,
+    )
+    logger.info(
+        f"Embedded {summary.embedded} concepts and pruned {summary.pruned} embeddings in {time.time() - start} seconds"
+    )
+
+
+if __name__ == "__main__":
+    main()
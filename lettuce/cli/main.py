@@ -26,6 +26,13 @@ def main():
             standard_concept=args.standard_concept,
             embedding_model=args.embedding_model,
             top_k=args.embedding_top_k,
+            retriever_backend=args.retriever_backend,
+            distance_metric=args.distance_metric,
+            retrieval_mode=args.retrieval_mode,
+            decoding_mode=args.decoding_mode,
+            max_tokens=args.llm_max_tokens,
+            speculative_decoding=args.speculative_decoding,
+            llm_runtime=BaseOptions.llm_runtime(args),
         ).get_rag_assistant()
         pl.warm_up()
         logger.info(f"Pipeline warmup in {time.time() - start} seconds")
@@ -55,6 +62,10 @@ def main():
             embed_vocab=args.embed_vocab,
             standard_concept=args.standard_concept,
             top_k=args.embedding_top_k,
+            batch_size=args.embedding_batch_size,
+            retriever_backend=args.retriever_backend,
+            distance_metric=args.distance_metric,
+            retrieval_mode=args.retrieval_mode,
        )
         embed_results = embeddings.search(args.informal_names)
         for query, result in zip(results, embed_results):
@@ -65,6 +76,10 @@ def main():
             llm_model=LLMModel[args.llm_model],
             temperature=args.temperature,
             logger=logger,
+            decoding_mode=args.decoding_mode,
+            max_tokens=args.llm_max_tokens,
+            speculative_decoding=args.speculative_decoding,
+            llm_runtime=BaseOptions.llm_runtime(args),
         ).get_simple_assistant()
         pipeline.warm_up()
 
@@ -77,7 +92,12 @@ def main():
     db_results = OMOPMatcher(
         logger, 
         vocabulary_id=args.vocabulary_id,
-        search_threshold=args.search_threshold
+        search_threshold=args.search_threshold,
+        max_candidates=args.max_text_candidates,
+        rank_function=args.text_rank_function,
+        match_all_words_first=args.match_all_words_first,
+        min_candidates=args.min_text_candidates,
+        candidate_search=args.candidate_search,
     ).run(search_terms=db_queries)
 
     for query, result in zip(results, db_results):
@@ -0,0 +1,51 @@
+import argparse
+import time
+
+from omop.db_manager import engine
+from omop.trigram_index import build_trigram_indexes, drop_trigram_indexes
+from utils.logging_utils import logger
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build, rebuild or drop the pg_trgm indexes on concept and synonym names that trigram search uses"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command, help_text in [
+        ("build", "Create the pg_trgm extension and build the indexes if they do not exist"),
+        ("rebuild", "Drop and rebuild the indexes"),
+    ]:
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument(
+            "--concurrently",
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="Build without blocking writes to the tables",
+        )
+        subparser.add_argument(
+            "--maintenance-work-mem",
+            type=str,
+            default=None,
+            help="maintenance_work_mem for the builds, e.g. 2GB",
+        )
+
+    subparsers.add_parser("drop", help="Drop the indexes")
+
+    args = parser.parse_args()
+
+    if args.command in ("build", "rebuild"):
+        start = time.time()
+        names = build_trigram_indexes(
+            engine,
+            rebuild=args.command == "rebuild",
+            concurrently=args.concurrently,
+            maintenance_work_mem=args.maintenance_work_mem,
+        )
+        logger.info(f"Built {', '.join(names)} in {time.time() - start} seconds")
+    elif args.command == "drop":
+        logger.info(f"Dropped {', '.join(drop_trigram_indexes(engine))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import time
+
+from omop.db_manager import engine, get_session
+from omop.vector_index import (
+    DistanceMetric,
+    RetrievalMode,
+    VectorIndexMethod,
+    build_filtered_embeddings,
+    build_vector_index,
+    drop_filtered_embeddings,
+    drop_vector_index,
+    report_vector_indexes,
+)
+from utils.logging_utils import logger
+
+
+def _add_index_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--method",
+        type=VectorIndexMethod,
+        default=VectorIndexMethod.HNSW,
+        choices=list(VectorIndexMethod),
+        help="Index type",
+    )
+    parser.add_argument(
+        "--metric",
+        type=DistanceMetric,
+        default=DistanceMetric.COSINE,
+        choices=list(DistanceMetric),
+        help="Distance metric the index serves. It must match the metric queries use, or the index is ignored",
+    )
+    parser.add_argument(
+        "--mode",
+        type=RetrievalMode,
+        default=RetrievalMode.EXACT,
+        choices=list(RetrievalMode),
+        help="Index the full vectors, or a halfvec or binary-quantized copy for the matching retrieval mode",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build, rebuild, drop or report the pgvector indexes on the embeddings table"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command, help_text in [
+        ("build", "Build an index if it does not exist"),
+        ("rebuild", "Drop and rebuild an index, so new build parameters take effect"),
+    ]:
+        subparser = subparsers.add_parser(command, help=help_text)
+        _add_index_arguments(subparser)
+        subparser.add_argument("--m", type=int, default=16, help="HNSW links per node")
+        subparser.add_argument(
+            "--ef-construction", type=int, default=64, help="HNSW build candidate list size"
+        )
+        subparser.add_argument(
+            "--lists",
+            type=int,
+            default=None,
+            help="IVFFlat list count. Defaults to rows / 1000, or sqrt(rows) above a million rows",
+        )
+        subparser.add_argument(
+            "--concurrently",
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="Build without blocking writes to the table",
+        )
+        subparser.add_argument(
+            "--maintenance-work-mem",
+            type=str,
+            default=None,
+            help="maintenance_work_mem for the build, e.g. 2GB",
+        )
+
+    denormalize = subparsers.add_parser(
+        "denormalize",
+        help="Build the embeddings table copy that holds concept filter columns and is partitioned by vocabulary. Vector search uses it once it exists",
+    )
+    _add_index_arguments(denormalize)
+    denormalize.add_argument("--m", type=int, default=16, help="HNSW links per node")
+    denormalize.add_argument(
+        "--ef-construction", type=int, default=64, help="HNSW build candidate list size"
+    )
+    denormalize.add_argument(
+        "--lists", type=int, default=None, help="IVFFlat list count per partition"
+    )
+    denormalize.add_argument(
+        "--vocabulary",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Vocabularies given their own partition. Defaults to every vocabulary with embeddings",
+    )
+    denormalize.add_argument(
+        "--maintenance-work-mem",
+        type=str,
+        default=None,
+        help="maintenance_work_mem for the index build, e.g. 2GB",
+    )
+
+    drop = subparsers.add_parser("drop", help="Drop an index")
+    _add_index_arguments(drop)
+
+    subparsers.add_parser(
+        "drop-denormalized",
+        help="Drop the denormalized embeddings table, so vector search uses the embeddings table again",
+    )
+
+    subparsers.add_parser("report", help="List the indexes on the embeddings table")
+
+    args = parser.parse_args()
+
+    if args.command in ("build", "rebuild"):
+        start = time.time()
+        name = build_vector_index(
+            engine,
+            args.method,
+            args.metric,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            lists=args.lists,
+            rebuild=args.command == "rebuild",
+            concurrently=args.concurrently,
+            maintenance_work_mem=args.maintenance_work_mem,
+            mode=args.mode,
+        )
+        logger.info(f"Built {name} in {time.time() - start} seconds")
+    elif args.command == "denormalize":
+        start = time.time()
+        count = build_filtered_embeddings(
+            engine,
+            method=args.method,
+            metric=args.metric,
+            mode=args.mode,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            lists=args.lists,
+            vocabularies=args.vocabulary,
+            maintenance_work_mem=args.maintenance_work_mem,
+        )
+        logger.info(f"Copied {count} embeddings to the denormalized table in {time.time() - start} seconds")
+    elif args.command == "drop":
+        logger.info(f"Dropped {drop_vector_index(engine, args.method, args.metric, args.mode)}")
+    elif args.command == "drop-denormalized":
+        logger.info(f"Dropped {drop_filtered_embeddings(engine)}")
+
+    with get_session() as session:
+        for index in report_vector_indexes(session):
+            status = "valid" if index["valid"] else "INVALID"
+            print(f"{index['name']} ({index['size']}, {status}): {index['definition']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+import json
+import os
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+from haystack import component
+from haystack.dataclasses import Document
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from omop.omop_models import Concept, Embedding, DB_VECSIZE
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.npz"
+CATEGORIES_FILE = "categories.json"
+HNSW_FILE = "hnsw.bin"
+
+
+class DescribedConcept(NamedTuple):
+    """
+    A concept and its distance from a query, shaped like the rows PGVectorQuery returns with describe_concept
+    """
+
+    Concept: Concept
+    score: float
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def export_ann_index(
+    session: Session,
+    output_dir: str,
+    dtype: str = "float16",
+    build_hnsw: bool = True,
+    m: int = 16,
+    ef_construction: int = 200,
+    chunk_size: int = 10000,
+) -> int:
+    """
+    Export the embeddings table and the concept filter columns to files an ANNIndex can memory-map
+
+    Vectors are L2-normalized on export, so inner product on the exported matrix ranks the same as cosine distance in pgvector.
+    If hnswlib is installed and build_hnsw is true, an HNSW graph over the vectors is built and saved alongside them.
+
+    Parameters
+    ----------
+    session: Session
+        A session connected to the OMOP database
+    output_dir: str
+        The directory the index files are written to
+    dtype: str
+        The storage type of the vector matrix, "float16" or "float32"
+    build_hnsw: bool
+        Whether to build an HNSW graph
+    m: int
+        The number of links per node in the HNSW graph
+    ef_construction: int
+        The size of the candidate list used when building the HNSW graph
+    chunk_size: int
+        The number of rows streamed from the database at a time
+
+    Returns
+    -------
+    int
+        The number of vectors exported
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    count = session.execute(
+        select(func.count())
+        .select_from(Embedding)
+        .join(Concept, Concept.concept_id == Embedding.concept_id)
+    ).scalar_one()
+    dimensions = DB_VECSIZE
+
+    vectors = np.lib.format.open_memmap(
+        os.path.join(output_dir, VECTORS_FILE),
+        mode="w+",
+        dtype=np.dtype(dtype),
+        shape=(count, dimensions),
+    )
+    concept_ids = np.zeros(count, dtype=np.int64)
+    names: List[str] = []
+    vocabulary_codes = np.zeros(count, dtype=np.int32)
+    domain_codes = np.zeros(count, dtype=np.int32)
+    standard = np.zeros(count, dtype=bool)
+    valid = np.zeros(count, dtype=bool)
+    categories: Dict[str, Dict[str, int]] = {"vocabulary_id": {}, "domain_id": {}}
+
+    query = (
+        select(
+            Embedding.concept_id,
+            Embedding.embedding,
+            Concept.concept_name,
+            Concept.vocabulary_id,
+            Concept.domain_id,
+            Concept.standard_concept,
+            Concept.invalid_reason,
+        )
+        .join(Concept, Concept.concept_id == Embedding.concept_id)
+        .order_by(Embedding.concept_id)
+        .execution_options(yield_per=chunk_size)
+    )
+    row_index = 0
+    for partition in session.execute(query).partitions():
+        if row_index >= count:
+            break
+        partition = partition[: count - row_index]
+        end = row_index + len(partition)
+        vectors[row_index:end] = _normalize_rows([row.embedding for row in partition])
+        for i, row in enumerate(partition, start=row_index):
+            concept_ids[i] = row.concept_id
+            names.append(row.concept_name)
+            vocabulary_codes[i] = categories["vocabulary_id"].setdefault(
+                row.vocabulary_id, len(categories["vocabulary_id"])
+            )
+            domain_codes[i] = categories["domain_id"].setdefault(
+                row.domain_id, len(categories["domain_id"])
+            )
+            standard[i] = row.standard_concept == "S"
+            valid[i] = row.invalid_reason is None
+        row_index = end
+    vectors.flush()
+
+    np.savez(
+        os.path.join(output_dir, METADATA_FILE),
+        concept_ids=concept_ids[:row_index],
+        concept_names=np.array(names, dtype=object),
+        vocabulary_codes=vocabulary_codes[:row_index],
+        domain_codes=domain_codes[:row_index],
+        standard=standard[:row_index],
+        valid=valid[:row_index],
+    )
+    with open(os.path.join(output_dir, CATEGORIES_FILE), "w") as f:
+        json.dump(categories, f)
+
+    if build_hnsw and hnswlib is not None and row_index:
+        hnsw = hnswlib.Index(space="ip", dim=dimensions)
+        hnsw.init_index(max_elements=row_index, ef_construction=ef_construction, M=m)
+        for start in range(0, row_index, chunk_size):
+            end = min(start + chunk_size, row_index)
+            hnsw.add_items(
+                np.asarray(vectors[start:end], dtype=np.float32),
+                np.arange(start, end),
+            )
+        hnsw.save_index(os.path.join(output_dir, HNSW_FILE))
+    return row_index
+
+
+class ANNIndex:
+    """
+    An in-process nearest neighbour index over exported concept embeddings
+
+    The vector matrix is memory-mapped, so several worker processes share one copy through the page cache.
+    Filters on vocabulary, domain, standard and valid concepts are applied with boolean masks over the exported columns.
+    When a filter keeps only a small fraction of concepts, the masked rows are searched exactly.
+    Otherwise the HNSW graph is searched with over-fetching, and any query left with fewer than k filtered results falls back to exact search.
+
+    Parameters
+    ----------
+    index_dir: str
+        A directory written by export_ann_index
+    ef_search: int
+        The size of the HNSW candidate list at query time
+    exact_fraction: float
+        Filters keeping less than this fraction of concepts are searched exactly
+    overfetch: int
+        How many times k candidates to take from the HNSW graph before filtering
+    chunk_size: int
+        The number of rows scored at a time during exact search
+    """
+
+    def __init__(
+        self,
+        index_dir: str,
+        ef_search: int = 64,
+        exact_fraction: float = 0.05,
+        overfetch: int = 10,
+        chunk_size: int = 65536,
+    ) -> None:
+        self._vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+        metadata = np.load(os.path.join(index_dir, METADATA_FILE), allow_pickle=True)
+        self.concept_ids = metadata["concept_ids"]
+        self.concept_names = metadata["concept_names"]
+        self._vocabulary_codes = metadata["vocabulary_codes"]
+        self._domain_codes = metadata["domain_codes"]
+        self._standard = metadata["standard"]
+        self._valid = metadata["valid"]
+        with open(os.path.join(index_dir, CATEGORIES_FILE)) as f:
+            self._categories = json.load(f)
+        self._exact_fraction = exact_fraction
+        self._overfetch = overfetch
+        self._chunk_size = chunk_size
+        self._hnsw = None
+        hnsw_path = os.path.join(index_dir, HNSW_FILE)
+        if hnswlib is not None and os.path.isfile(hnsw_path):
+            self._hnsw = hnswlib.Index(space="ip", dim=self._vectors.shape[1])
+            self._hnsw.load_index(hnsw_path, max_elements=len(self.concept_ids))
+            self._hnsw.set_ef(ef_search)
+
+    def __len__(self) -> int:
+        return len(self.concept_ids)
+
+    @property
+    def dimensions(self) -> int:
+        return self._vectors.shape[1]
+
+    def _codes(self, column: str, values: List[str]) -> List[int]:
+        return [self._categories[column][v] for v in values if v in self._categories[column]]
+
+    def filter_mask(
+        self,
+        embed_vocab: List[str] | None = None,
+        domain_id: List[str] | None = None,
+        standard_concept: bool = False,
+        valid_concept: bool = False,
+    ) -> np.ndarray | None:
+        """
+        Build a boolean mask of the concepts passing the filters, or None if there are no filters
+        """
+        mask = None
+
+        def combine(current, condition):
+            return condition if current is None else current & condition
+
+        if embed_vocab is not None:
+            mask = combine(
+                mask, np.isin(self._vocabulary_codes, self._codes("vocabulary_id", embed_vocab))
+            )
+        if domain_id is not None:
+            mask = combine(mask, np.isin(self._domain_codes, self._codes("domain_id", domain_id)))
+        if standard_concept:
+            mask = combine(mask, self._standard)
+        if valid_concept:
+            mask = combine(mask, self._valid)
+        return mask
+
+    def _exact_search(
+        self, queries: np.ndarray, k: int, candidates: np.ndarray | None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        n_rows = len(self) if candidates is None else len(candidates)
+        best_rows = np.full((len(queries), 0), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        for start in range(0, n_rows, self._chunk_size):
+            end = min(start + self._chunk_size, n_rows)
+            rows = np.arange(start, end) if candidates is None else candidates[start:end]
+            chunk = np.asarray(self._vectors[rows], dtype=np.float32)
+            scores = queries @ chunk.T
+            all_rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+            all_scores = np.concatenate([best_scores, scores], axis=1)
+            keep = min(k, all_scores.shape[1])
+            top = np.argpartition(-all_scores, keep - 1, axis=1)[:, :keep]
+            best_rows = np.take_along_axis(all_rows, top, axis=1)
+            best_scores = np.take_along_axis(all_scores, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return best_rows, 1 - best_scores
+
+    def search(
+        self,
+        query_embeddings,
+        k: int = 5,
+        embed_vocab: List[str] | None = None,
+        domain_id: List[str] | None = None,
+        standard_concept: bool = False,
+        valid_concept: bool = False,
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        Find the nearest concepts to each query embedding
+
+        Parameters
+        ----------
+        query_embeddings
+            An array-like of shape (n_queries, dimensions)
+        k: int
+            The number of concepts returned for each query
+        embed_vocab: List[str] | None
+            If supplied, only concepts from these vocabularies are returned
+        domain_id: List[str] | None
+            If supplied, only concepts from these domains are returned
+        standard_concept: bool
+            If true, only standard concepts are returned
+        valid_concept: bool
+            If true, only valid concepts are returned
+
+        Returns
+        -------
+        List[List[Tuple[int, float]]]
+            For each query, (row, cosine distance) pairs ordered from nearest to furthest
+        """
+        queries = _normalize_rows(np.atleast_2d(query_embeddings))
+        if len(self) == 0 or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+        mask = self.filter_mask(embed_vocab, domain_id, standard_concept, valid_concept)
+        candidates = None if mask is None else np.flatnonzero(mask)
+
+        if self._hnsw is None or (
+            candidates is not None and len(candidates) < self._exact_fraction * len(self)
+        ):
+            rows, distances = self._exact_search(queries, k, candidates)
+            return [
+                [(int(r), float(d)) for r, d in zip(row, dist) if r >= 0]
+                for row, dist in zip(rows, distances)
+            ]
+
+        fetch = min(len(self), k if mask is None else k * self._overfetch)
+        labels, distances = self._hnsw.knn_query(queries, k=fetch)
+        results = []
+        for i, (row, dist) in enumerate(zip(labels, distances)):
+            hits = [
+                (int(r), float(d)) for r, d in zip(row, dist) if mask is None or mask[r]
+            ][:k]
+            if len(hits) < k and candidates is not None and len(candidates) > len(hits):
+                exact_rows, exact_distances = self._exact_search(queries[i : i + 1], k, candidates)
+                hits = [(int(r), float(d)) for r, d in zip(exact_rows[0], exact_distances[0])]
+            results.append(hits)
+        return results
+
+
+@lru_cache(maxsize=4)
+def load_ann_index(index_dir: str) -> ANNIndex:
+    """
+    Load an ANNIndex once per process
+    """
+    return ANNIndex(index_dir)
+
+
+@component
+class ANNVectorQuery:
+    """
+    A haystack component for retrieving concepts from an in-process ANNIndex, as an alternative to PGVectorQuery
+
+    Parameters
+    ----------
+    index: ANNIndex
+        The index to search
+    connection: Session | None
+        A session used to fetch full concept rows when describe_concept is requested
+    """
+
+    def __init__(
+        self,
+        index: ANNIndex,
+        connection: Session | None = None,
+        embed_vocab: List[str] | None = None,
+        domain_id: List[str] | None = None,
+        standard_concept: bool = False,
+        valid_concept: bool = False,
+        top_k: int = 5,
+    ) -> None:
+        self._index = index
+        self._connection = connection
+        self._embed_vocab = embed_vocab
+        self._domain_id = domain_id
+        self._standard_concept = standard_concept
+        self._valid_concept = valid_concept
+        self._top_k = top_k
+
+    def _search(self, query_embeddings) -> List[List[Tuple[int, float]]]:
+        return self._index.search(
+            query_embeddings,
+            k=self._top_k,
+            embed_vocab=self._embed_vocab,
+            domain_id=self._domain_id,
+            standard_concept=self._standard_concept,
+            valid_concept=self._valid_concept,
+        )
+
+    def _documents(self, hits: List[Tuple[int, float]]) -> List[Document]:
+        return [
+            Document(
+                id=str(self._index.concept_ids[row]),
+                content=self._index.concept_names[row],
+                score=distance,
+            )
+            for row, distance in hits
+        ]
+
+    def _describe(self, hits: List[Tuple[int, float]]) -> List[DescribedConcept]:
+        if self._connection is None:
+            raise ValueError("describe_concept requires a database connection")
+        ids = [int(self._index.concept_ids[row]) for row, _ in hits]
+        concepts = {
+            c.concept_id: c
+            for c in self._connection.execute(
+                select(Concept).where(Concept.concept_id.in_(ids))
+            ).scalars()
+        }
+        return [
+            DescribedConcept(concepts[concept_id], distance)
+            for concept_id, (_, distance) in zip(ids, hits)
+            if concept_id in concepts
+        ]
+
+    @component.output_types(documents=List[Document])
+    def run(
+        self,
+        query_embedding: List[float],
+        describe_concept: bool = False,
+    ):
+        hits = self._search([query_embedding])[0]
+        if describe_concept:
+            return self._describe(hits)
+        return {"documents": self._documents(hits)}
+
+    def run_batch(self, query_embeddings) -> Dict[str, List[List[Document]]]:
+        """
+        Retrieve the nearest concepts for several embeddings
+
+        Parameters
+        ----------
+        query_embeddings
+            The embeddings to search with
+
+        Returns
+        -------
+        Dict[str, List[List[Document]]]
+            The documents for each query embedding, in the order of query_embeddings
+        """
+        if len(query_embeddings) == 0:
+            return {"documents": []}
+        return {"documents": [self._documents(hits) for hits in self._search(query_embeddings)]}
@@ -0,0 +1,294 @@
+import time
+import uuid
+from typing import Any, Dict, List, Sequence, Tuple
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama
+
+# llama-cpp-python's default sampling settings for create_completion
+TOP_K = 40
+TOP_P = 0.95
+MIN_P = 0.05
+
+
+def batched_decoding_supported(llama: Llama) -> bool:
+    """
+    Whether this llama-cpp-python has the internals batched_completion drives the context through
+
+    batched_completion fills llama._batch and decodes it with llama._ctx, and checks end of generation against llama._model.vocab.
+    These are private, and only have this shape from llama-cpp-python 0.3.7; with older versions prompts are completed one at a time.
+    """
+    return (
+        hasattr(llama, "_batch")
+        and hasattr(llama, "_ctx")
+        and hasattr(getattr(llama, "_model", None), "vocab")
+        and hasattr(llama_cpp, "llama_token_is_eog")
+    )
+
+
+def _shared_prefix(token_lists: Sequence[Sequence[int]]) -> int:
+    """
+    The number of leading tokens every list has in common, leaving at least one token of each list to produce its logits
+    """
+    shared = min(len(tokens) for tokens in token_lists) - 1
+    first = token_lists[0]
+    for tokens in token_lists[1:]:
+        i = 0
+        while i < shared and tokens[i] == first[i]:
+            i += 1
+        shared = i
+    return max(shared, 0)
+
+
+def _cells_needed(token_lists: Sequence[Sequence[int]], max_tokens: int) -> int:
+    shared = _shared_prefix(token_lists) if len(token_lists) > 1 else 0
+    return shared + sum(len(tokens) - shared + max_tokens for tokens in token_lists)
+
+
+def plan_batches(
+    token_lists: Sequence[Sequence[int]], max_tokens: int, n_ctx: int, n_batch: int
+) -> List[List[int]]:
+    """
+    Split prompts into groups whose sequences fit in the KV cache together
+
+    All sequences of a batch share the model's single context of n_ctx cells, and each decoding step sends one token per sequence, so a group holds at most n_batch prompts.
+
+    Returns
+    -------
+    List[List[int]]
+        Indices into token_lists, in order
+    """
+    groups: List[List[int]] = []
+    current: List[int] = []
+    for i in range(len(token_lists)):
+        candidate = current + [i]
+        if current and (
+            len(candidate) > n_batch
+            or _cells_needed([token_lists[j] for j in candidate], max_tokens) > n_ctx
+        ):
+            groups.append(current)
+            candidate = [i]
+        current = candidate
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _sample(logits: np.ndarray, temperature: float, rng: np.random.Generator) -> int:
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    top = np.argpartition(logits, -TOP_K)[-TOP_K:]
+    top = top[np.argsort(logits[top])[::-1]]
+    probs = np.exp(logits[top] - logits[top[0]])
+    probs /= probs.sum()
+    keep = int(np.searchsorted(np.cumsum(probs), TOP_P)) + 1
+    keep = max(1, min(keep, int(np.sum(probs >= MIN_P * probs[0]))))
+    top = top[:keep]
+    scaled = np.exp((logits[top] - logits[top[0]]) / temperature)
+    return int(rng.choice(top, p=scaled / scaled.sum()))
+
+
+def _decode(
+    llama: Llama, entries: List[Tuple[int, int, Sequence[int], bool]], n_vocab: int
+) -> Dict[int, np.ndarray]:
+    """
+    Decode (token, position, sequence ids, wants logits) entries in chunks of n_batch, returning the logits of each marked entry's last sequence id
+    """
+    logits: Dict[int, np.ndarray] = {}
+    batch = llama._batch.batch
+    for start in range(0, len(entries), llama.n_batch):
+        chunk = entries[start : start + llama.n_batch]
+        batch.n_tokens = len(chunk)
+        for i, (token, pos, seq_ids, want_logits) in enumerate(chunk):
+            batch.token[i] = token
+            batch.pos[i] = pos
+            batch.n_seq_id[i] = len(seq_ids)
+            for j, seq_id in enumerate(seq_ids):
+                batch.seq_id[i][j] = seq_id
+            batch.logits[i] = want_logits
+        llama._ctx.decode(llama._batch)
+        for i, (_, _, seq_ids, want_logits) in enumerate(chunk):
+            if want_logits:
+                row = llama._ctx.get_logits_ith(i)
+                logits[seq_ids[-1]] = np.ctypeslib.as_array(row, shape=(n_vocab,)).copy()
+    return logits
+
+
+def _first_stop(text: bytes, stop: Sequence[bytes]) -> int | None:
+    positions = [text.find(s) for s in stop]
+    positions = [p for p in positions if p != -1]
+    return min(positions) if positions else None
+
+
+def _completion(
+    llama: Llama,
+    text: bytes,
+    prompt_tokens: int,
+    completion_tokens: int,
+    finish_reason: str,
+    batch_size: int,
+    tokens_reused: int,
+) -> Dict[str, Any]:
+    return {
+        "id": f"cmpl-{uuid.uuid4()}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": llama.model_path,
+        "choices": [
+            {
+                "text": text.decode("utf-8", errors="ignore"),
+                "index": 0,
+                "logprobs": None,
+                "finish_reason": finish_reason,
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+        "batch_size": batch_size,
+        "prompt_tokens_reused": tokens_reused,
+    }
+
+
+def _complete_group(
+    llama: Llama,
+    token_lists: List[List[int]],
+    max_tokens: int,
+    temperature: float,
+    stop: Sequence[bytes],
+    rng: np.random.Generator,
+) -> List[Dict[str, Any]]:
+    n_vocab = llama.n_vocab()
+    n = len(token_lists)
+    shared = _shared_prefix(token_lists) if n > 1 else 0
+    all_sequences = list(range(n))
+
+    # The shared prefix is evaluated once, with each of its cells belonging to every sequence
+    entries = [(token, pos, all_sequences, False) for pos, token in enumerate(token_lists[0][:shared])]
+    for seq, tokens in enumerate(token_lists):
+        for pos in range(shared, len(tokens)):
+            entries.append((tokens[pos], pos, (seq,), pos == len(tokens) - 1))
+    logits = _decode(llama, entries, n_vocab)
+
+    positions = [len(tokens) for tokens in token_lists]
+    generated: List[List[int]] = [[] for _ in range(n)]
+    texts = [b""] * n
+    finish: List[str | None] = [None] * n
+    vocab = llama._model.vocab
+    while True:
+        entries = []
+        for seq in range(n):
+            if finish[seq] is not None:
+                continue
+            token = _sample(logits[seq], temperature, rng)
+            if llama_cpp.llama_token_is_eog(vocab, token):
+                finish[seq] = "stop"
+                continue
+            generated[seq].append(token)
+            texts[seq] = llama.detokenize(generated[seq], prev_tokens=token_lists[seq])
+            stop_at = _first_stop(texts[seq], stop)
+            if stop_at is not None:
+                texts[seq] = texts[seq][:stop_at]
+                finish[seq] = "stop"
+                continue
+            if len(generated[seq]) >= max_tokens:
+                finish[seq] = "length"
+                continue
+            entries.append((token, positions[seq], (seq,), True))
+            positions[seq] += 1
+        if not entries:
+            break
+        logits = _decode(llama, entries, n_vocab)
+
+    return [
+        _completion(
+            llama,
+            texts[seq],
+            len(token_lists[seq]),
+            len(generated[seq]),
+            finish[seq],
+            n,
+            shared if seq > 0 else 0,
+        )
+        for seq in range(n)
+    ]
+
+
+def batched_completion(
+    llama: Llama,
+    prompts: Sequence[str],
+    max_tokens: int = 128,
+    temperature: float = 0.0,
+    stop: str | List[str] | None = None,
+    seed: int | None = None,
+) -> List[Dict[str, Any] | ValueError]:
+    """
+    Complete several prompts at once, as parallel sequences in one llama.cpp context
+
+    Each decoding step sends the next token of every unfinished sequence in a single batch, so the weights are read once per step rather than once per prompt.
+    The tokens the prompts start with in common, e.g. the few-shot examples, are evaluated once and shared by every sequence.
+    Prompts that don't fit in the context together are run in consecutive groups.
+
+    Temperature 0 is greedy, as with create_completion. Other temperatures sample with llama-cpp-python's default top-k, top-p and min-p.
+    Grammars and speculative decoding are not supported; those requests use create_completion.
+
+    The context is cleared before and after, so the next create_completion evaluates its prompt from the start.
+
+    Parameters
+    ----------
+    llama: Llama
+        The model, not used by anything else until this returns
+    prompts: Sequence[str]
+        The prompts to complete
+    max_tokens: int
+        The most tokens generated per prompt
+    temperature: float
+        The sampling temperature
+    stop: str | List[str] | None
+        Generation stops at, and the reply excludes, the first of these strings
+    seed: int | None
+        Seeds sampling when temperature is above 0
+
+    Returns
+    -------
+    List[Dict[str, Any] | ValueError]
+        A completion per prompt, shaped like create_completion's, or a ValueError for a prompt longer than the context
+    """
+    stop_list = [stop] if isinstance(stop, str) else list(stop or [])
+    stop_bytes = [s.encode("utf-8") for s in stop_list]
+    rng = np.random.default_rng(seed)
+    n_ctx = llama.n_ctx()
+    token_lists = [llama.tokenize(prompt.encode("utf-8"), special=True) for prompt in prompts]
+    results: List[Dict[str, Any] | ValueError | None] = [None] * len(prompts)
+
+    fitting = []
+    for i, tokens in enumerate(token_lists):
+        if len(tokens) >= n_ctx:
+            results[i] = ValueError(
+                f"Requested tokens ({len(tokens)}) exceed context window of {n_ctx}"
+            )
+        else:
+            fitting.append(i)
+
+    try:
+        for group in plan_batches([token_lists[i] for i in fitting], max_tokens, n_ctx, llama.n_batch):
+            indices = [fitting[j] for j in group]
+            group_tokens = [token_lists[i] for i in indices]
+            # As create_completion does, a prompt alone gets whatever room is left
+            group_max_tokens = (
+                min(max_tokens, n_ctx - len(group_tokens[0])) if len(indices) == 1 else max_tokens
+            )
+            llama._ctx.kv_cache_clear()
+            llama.reset()
+            completions = _complete_group(
+                llama, group_tokens, group_max_tokens, temperature, stop_bytes, rng
+            )
+            for i, completion in zip(indices, completions):
+                results[i] = completion
+    finally:
+        llama._ctx.kv_cache_clear()
+        llama.reset()
+    return results
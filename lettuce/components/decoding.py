@@ -0,0 +1,104 @@
+import os
+from enum import Enum
+from typing import Any, Dict, List
+
+
+class DecodingMode(str, Enum):
+    """
+    How replies to the formal-name prompts are decoded
+
+    free lets the model write anything up to the token budget.
+    constrained restricts local models to a single line of printable text, using a GBNF grammar, and stops every model at the end of that line.
+    vocabulary restricts local models to the exact name of a concept in the selected vocabularies, so a reply always resolves to a concept. Remote models fall back to constrained.
+    """
+
+    FREE = "free"
+    CONSTRAINED = "constrained"
+    VOCABULARY = "vocabulary"
+
+
+class SpeculativeDecoding(str, Enum):
+    """
+    How a local model drafts tokens to verify in one batch
+
+    prompt_lookup copies the tokens that followed the latest n-gram the last time it appeared in the prompt, which suits the RAG prompt, where the answer is usually in vec_results.
+    draft_model asks a small model with the same vocabulary, listed in draft_models in components.models, for its greedy continuation.
+    """
+
+    NONE = "none"
+    PROMPT_LOOKUP = "prompt_lookup"
+    DRAFT_MODEL = "draft_model"
+
+
+DEFAULT_MAX_TOKENS = {
+    DecodingMode.FREE: 128,
+    DecodingMode.CONSTRAINED: 24,
+    DecodingMode.VOCABULARY: 48,
+}
+
+# A single line holding one concept name, e.g. "Acetaminophen 500 MG Oral Tablet [Tylenol]" or "Sjögren's syndrome".
+# Concept names use brackets, colons and non-ASCII letters, so any printable character is allowed after a first one that isn't a space.
+# The newline ends the reply and is removed by the stop sequence
+FORMAL_NAME_GRAMMAR = r"""
+root ::= " "? name "\n"
+name ::= [^\x00-\x20\x7F] [^\x00-\x1F\x7F]*
+"""
+
+STOP_SEQUENCES = ["\n", "Informal name:", "Response:"]
+
+
+def resolve_decoding_mode(mode: DecodingMode | None) -> DecodingMode:
+    """
+    Use the mode given, or the LLM_DECODING_MODE environment variable, defaulting to free
+    """
+    if mode is not None:
+        return mode
+    return DecodingMode(os.getenv("LLM_DECODING_MODE", DecodingMode.FREE.value))
+
+
+def decoding_kwargs(
+    mode: DecodingMode,
+    max_tokens: int | None = None,
+    eot_token: str = "",
+    grammar: bool = True,
+    vocabulary_gbnf: str | None = None,
+) -> Dict[str, Any]:
+    """
+    Build the generation settings for a decoding mode
+
+    Parameters
+    ----------
+    mode: DecodingMode
+        The decoding mode
+    max_tokens: int | None
+        The most tokens generated per reply. If None, the mode's default budget is used
+    eot_token: str
+        The model's end of turn token, added to the stop sequences
+    grammar: bool
+        Whether the generator accepts a GBNF grammar. Only local llama.cpp models do
+    vocabulary_gbnf: str | None
+        The grammar of concept names used in vocabulary mode, from vocabulary_grammar
+
+    Returns
+    -------
+    Dict[str, Any]
+        Generation kwargs. The grammar is GBNF text, which PooledGenerator compiles
+    """
+    kwargs: Dict[str, Any] = {
+        "max_tokens": max_tokens if max_tokens is not None else DEFAULT_MAX_TOKENS[mode]
+    }
+    if mode == DecodingMode.FREE:
+        return kwargs
+    stop: List[str] = list(STOP_SEQUENCES)
+    if eot_token:
+        stop.append(eot_token)
+    kwargs["stop"] = stop
+    if not grammar:
+        return kwargs
+    if mode == DecodingMode.VOCABULARY:
+        if vocabulary_gbnf is None:
+            raise ValueError("Vocabulary decoding needs the grammar of concept names")
+        kwargs["grammar"] = vocabulary_gbnf
+    else:
+        kwargs["grammar"] = FORMAL_NAME_GRAMMAR
+    return kwargs
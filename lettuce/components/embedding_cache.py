@@ -0,0 +1,76 @@
+import hashlib
+import os
+import unicodedata
+from typing import Dict, List
+
+import numpy as np
+
+from utils.cache import TieredCache
+
+
+class QueryEmbeddingCache:
+    """
+    A cache of query embeddings keyed by model, prefix and normalized text
+
+    Source data repeats the same informal names across jobs, so embeddings are kept in a TieredCache: an in-memory LRU, optionally backed by SQLite so they survive restarts.
+    Text is normalized with NFKC and whitespace collapsed. Case is kept, because some of the embedding models are case-sensitive.
+    Callers embed the normalized text, so an entry holds the same embedding whichever of the texts sharing its key filled it.
+
+    Parameters
+    ----------
+    max_entries: int
+        The number of embeddings held in memory
+    path: str | None
+        Path of a SQLite database for the persistent tier. If None, the cache is memory-only
+    """
+
+    def __init__(self, max_entries: int = 10000, path: str | None = None) -> None:
+        self._cache = TieredCache(
+            max_entries=max_entries, path=path, table="query_embeddings"
+        )
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    def key(self, model: str, prefix: str, text: str) -> str:
+        raw = "\x1f".join([model, prefix, self.normalize(text)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, model: str, prefix: str, text: str) -> np.ndarray | None:
+        value = self._cache.get(self.key(model, prefix, text))
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32)
+
+    def put(self, model: str, prefix: str, text: str, embedding) -> None:
+        self._cache.put(
+            self.key(model, prefix, text),
+            np.asarray(embedding, dtype=np.float32).tobytes(),
+        )
+
+    def get_many(
+        self, model: str, prefix: str, texts: List[str]
+    ) -> List[np.ndarray | None]:
+        return [self.get(model, prefix, text) for text in texts]
+
+    def put_many(self, model: str, prefix: str, texts: List[str], embeddings) -> None:
+        self._cache.put_many(
+            (self.key(model, prefix, text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in zip(texts, embeddings)
+        )
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Report hit and miss counts for the cache
+        """
+        return self._cache.stats()
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+    path=os.getenv("EMBEDDING_CACHE_PATH") or None,
+)
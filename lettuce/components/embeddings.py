@@ -4,14 +4,29 @@ from haystack_integrations.components.embedders.fastembed import (
 )
 from haystack import component
 from haystack.dataclasses import Document
-from typing import Any, List, Dict
+from typing import Any, Iterable, List, Dict, Tuple
+import numpy as np
 from pydantic import BaseModel
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
+import contextlib
+import functools
 import os
+import threading
+import time
 
-from omop.omop_queries import query_vector
+from components.ann_index import ANNVectorQuery, load_ann_index
+from components.embedding_cache import QueryEmbeddingCache, query_embedding_cache
+from omop.omop_queries import query_vector, query_vector_batch
 from omop.db_manager import db_session
+from omop.vector_index import (
+    DistanceMetric,
+    EmbeddingLayout,
+    RetrievalMode,
+    apply_search_settings,
+    detect_embedding_layout,
+)
+from utils.batching import MicroBatcher
 
 # -------- Embedding Models -------- >
 
@@ -35,6 +50,18 @@ class EmbeddingModelName(str, Enum):
     CONTRIEVER = "contriever"
 
 
+class RetrieverBackend(str, Enum):
+    """
+    This class enumerates the places vector search can run.
+
+    PGVECTOR searches the embeddings table in postgres.
+    ANN searches an in-process index exported from that table, see components.ann_index.
+    """
+
+    PGVECTOR = "pgvector"
+    ANN = "ann"
+
+
 class EmbeddingModelInfo(BaseModel):
     """
     A simple class to hold the information for embeddings models
@@ -100,6 +127,14 @@ EMBEDDING_MODELS = {
 class PGVectorQuery:
     """
     A haystack component for retrieving concept information using embeddings in a postgres database with pgvector
+
+    ef_search and probes set hnsw.ef_search and ivfflat.probes for each query, trading recall for latency.
+    If they are None, the server defaults apply.
+    Concepts are ranked by metric, and scores are on the cosine distance scale whichever metric is used.
+    In the halfvec and binary retrieval modes, top_k * rerank_factor candidates are found with a quantized index, then reranked by exact distance.
+    layout selects the embeddings table joined to concept, or the denormalized table partitioned by vocabulary.
+    Each query runs in a transaction of its own, committed once the results are read, so the search settings end with it and the connection goes back to the pool.
+    If the session is already in a transaction, the query joins it, and the settings last until the caller ends it.
     """
     def __init__(
             self,
@@ -109,6 +144,12 @@ class PGVectorQuery:
             standard_concept:bool = False,
             valid_concept:bool = False,
             top_k: int = 5,
+            ef_search: int | None = None,
+            probes: int | None = None,
+            metric: DistanceMetric = DistanceMetric.COSINE,
+            mode: RetrievalMode = RetrievalMode.EXACT,
+            rerank_factor: int = 4,
+            layout: EmbeddingLayout = EmbeddingLayout.JOINED,
             ) -> None:
         self._connection = connection
         self._embed_vocab = embed_vocab
@@ -116,6 +157,24 @@ class PGVectorQuery:
         self._standard_concept = standard_concept
         self._valid_concept = valid_concept
         self._top_k = top_k
+        self._ef_search = ef_search
+        self._probes = probes
+        self._metric = metric
+        self._mode = mode
+        self._rerank_factor = rerank_factor
+        self._layout = layout
+
+    def _execute(self, query) -> List[Any]:
+        if self._connection.in_transaction():
+            transaction = contextlib.nullcontext()
+        else:
+            transaction = self._connection.begin()
+        try:
+            with transaction:
+                apply_search_settings(self._connection, self._ef_search, self._probes)
+                return self._connection.execute(query).mappings().all()
+        except SQLAlchemyError as e:
+            raise SQLAlchemyError(f"Vector query execution failed: {str(e)}")
 
     @component.output_types(documents=List[Document])
     def run(
@@ -123,8 +182,6 @@ class PGVectorQuery:
             query_embedding: List[float],
             describe_concept: bool = False,
             ):
-        # only have cosine_similarity at the moment
-        #TODO add selection of distance metric to query_vector
         query = query_vector(
                 query_embedding=query_embedding,
                 embed_vocab=self._embed_vocab,
@@ -133,11 +190,12 @@ class PGVectorQuery:
                 valid_concept=self._valid_concept,
                 n = self._top_k,
                 describe_concept=describe_concept,
+                metric=self._metric,
+                mode=self._mode,
+                rerank_factor=self._rerank_factor,
+                layout=self._layout,
                 ) 
-        try:
-            query_results = self._connection.execute(query).mappings().all()
-        except SQLAlchemyError as e:
-            raise SQLAlchemyError(f"Vector query execution failed: {str(e)}")
+        query_results = self._execute(query)
         if describe_concept:
             return query_results
         else:
@@ -152,6 +210,49 @@ class PGVectorQuery:
             except KeyError as e:
                 raise KeyError(f"Missing required key in query results: {str(e)}")
 
+    def run_batch(self, query_embeddings: List[List[float]] | np.ndarray) -> Dict[str, List[List[Document]]]:
+        """
+        Retrieve the nearest concepts for several embeddings in one database round trip
+
+        Parameters
+        ----------
+        query_embeddings: List[List[float]] | np.ndarray
+            The embeddings to search with
+
+        Returns
+        -------
+        Dict[str, List[List[Document]]]
+            The documents for each query embedding, in the order of query_embeddings
+        """
+        documents: List[List[Document]] = [[] for _ in range(len(query_embeddings))]
+        if len(query_embeddings) == 0:
+            return {"documents": documents}
+        query = query_vector_batch(
+                query_embeddings=query_embeddings,
+                embed_vocab=self._embed_vocab,
+                domain_id=self._domain_id,
+                standard_concept=self._standard_concept,
+                valid_concept=self._valid_concept,
+                n=self._top_k,
+                metric=self._metric,
+                mode=self._mode,
+                rerank_factor=self._rerank_factor,
+                layout=self._layout,
+                )
+        query_results = self._execute(query)
+        try:
+            for res in query_results:
+                documents[res["ordinal"] - 1].append(
+                    Document(
+                        id=res["id"],
+                        content=res["content"],
+                        score=res["score"],
+                        )
+                    )
+        except KeyError as e:
+            raise KeyError(f"Missing required key in query results: {str(e)}")
+        return {"documents": documents}
+
 def get_embedding_model(name: EmbeddingModelName) -> EmbeddingModel:
     """
     Collects the details of an embedding model when given its name
@@ -170,6 +271,352 @@ def get_embedding_model(name: EmbeddingModelName) -> EmbeddingModel:
     return EmbeddingModel(name=name, info=EMBEDDING_MODELS[name])
 
 
+class _RegistryEntry:
+    """
+    A loaded embedder and the time it was last handed out
+    """
+
+    def __init__(self, embedder: FastembedTextEmbedder) -> None:
+        self.embedder = embedder
+        self.last_used = time.monotonic()
+
+
+class EmbedderRegistry:
+    """
+    A process-wide store of warm FastEmbed embedders
+
+    Loading an embedding model means reading the ONNX weights and building an inference session, which takes far longer than embedding a query.
+    The registry loads each (model, prefix) pair once and hands the same embedder to every caller.
+    Loading is guarded by a lock per key, so concurrent requests for a model that is still loading wait for it rather than loading it twice, and requests for other models are not blocked.
+
+    Parameters
+    ----------
+    idle_timeout: float | None
+        Seconds an embedder can go unused before it is evicted. If None, embedders are never evicted.
+    """
+
+    def __init__(self, idle_timeout: float | None = 3600) -> None:
+        self._idle_timeout = idle_timeout
+        self._entries: Dict[Tuple[EmbeddingModelName, str], _RegistryEntry] = {}
+        self._key_locks: Dict[Tuple[EmbeddingModelName, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key: Tuple[EmbeddingModelName, str]) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _drop(self, key: Tuple[EmbeddingModelName, str]) -> None:
+        """
+        Remove an embedder and its key lock, unless a load for the key holds the lock. Call with self._lock held
+        """
+        del self._entries[key]
+        key_lock = self._key_locks.get(key)
+        if key_lock is not None and not key_lock.locked():
+            del self._key_locks[key]
+
+    def get(self, model: EmbeddingModel, prefix: str = "") -> FastembedTextEmbedder:
+        """
+        Fetch a warm embedder for a model, loading it if this process has not yet done so
+
+        Parameters
+        ----------
+        model: EmbeddingModel
+            The embedding model to load
+        prefix: str
+            A string prepended to every text before embedding, e.g. "query:"
+
+        Returns
+        -------
+        FastembedTextEmbedder
+            An embedder that has already been warmed up
+        """
+        key = (model.name, prefix)
+        self.evict_idle()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_used = time.monotonic()
+                return entry.embedder
+
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                embedder = FastembedTextEmbedder(
+                    model=model.info.path, parallel=0, prefix=prefix
+                )
+                embedder.warm_up()
+                entry = _RegistryEntry(embedder)
+                with self._lock:
+                    self._entries[key] = entry
+            entry.last_used = time.monotonic()
+            return entry.embedder
+
+    def preload(
+        self,
+        model_names: Iterable[EmbeddingModelName],
+        prefixes: Iterable[str] = ("", "query:"),
+    ) -> None:
+        """
+        Load embedders ahead of the first request
+
+        Parameters
+        ----------
+        model_names: Iterable[EmbeddingModelName]
+            The models to load
+        prefixes: Iterable[str]
+            The prefixes to load each model with
+        """
+        prefixes = list(prefixes)
+        for name in model_names:
+            model = get_embedding_model(name)
+            for prefix in prefixes:
+                self.get(model, prefix)
+
+    def evict_idle(self) -> List[Tuple[EmbeddingModelName, str]]:
+        """
+        Drop embedders that have not been used within the idle timeout
+
+        Returns
+        -------
+        List[Tuple[EmbeddingModelName, str]]
+            The (model, prefix) keys that were evicted
+        """
+        if self._idle_timeout is None:
+            return []
+        cutoff = time.monotonic() - self._idle_timeout
+        with self._lock:
+            evicted = [
+                key for key, entry in self._entries.items() if entry.last_used < cutoff
+            ]
+            for key in evicted:
+                self._drop(key)
+        return evicted
+
+    def loaded(self) -> List[Tuple[EmbeddingModelName, str]]:
+        """
+        List the (model, prefix) keys currently held by the registry
+        """
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self) -> None:
+        """
+        Drop every loaded embedder
+        """
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+
+def _idle_timeout_from_env() -> float | None:
+    timeout = os.getenv("EMBEDDER_IDLE_TIMEOUT", "3600")
+    if timeout.lower() in ("", "none", "0"):
+        return None
+    return float(timeout)
+
+
+embedder_registry = EmbedderRegistry(idle_timeout=_idle_timeout_from_env())
+
+embedding_batcher = MicroBatcher(
+    max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "32")),
+    max_wait_ms=float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "2")),
+)
+
+
+def embed_batch(
+    embedder: FastembedTextEmbedder, texts: List[str], batch_size: int = 256
+) -> np.ndarray:
+    """
+    Embed a list of texts with a warm embedder in as few inference calls as possible
+
+    FastembedTextEmbedder.run only takes a single string, so this goes to the underlying FastEmbed model, which splits the input into chunks of batch_size and runs one ONNX inference per chunk.
+    The embedder's prefix and suffix are applied, so the vectors match those from FastembedTextEmbedder.run.
+
+    Parameters
+    ----------
+    embedder: FastembedTextEmbedder
+        An embedder that has been warmed up
+    texts: List[str]
+        The texts to embed
+    batch_size: int
+        The number of texts embedded per inference call
+
+    Returns
+    -------
+    np.ndarray
+        A float32 array of shape (len(texts), dimensions)
+    """
+    if not all(isinstance(text, str) for text in texts):
+        raise TypeError("embed_batch expects a list of strings")
+    if embedder.embedding_backend is None:
+        raise RuntimeError("The embedding model has not been loaded. Please call warm_up() before running.")
+    documents = [embedder.prefix + text + embedder.suffix for text in texts]
+    embeddings = embedder.embedding_backend.model.embed(
+        documents, batch_size=batch_size, parallel=embedder.parallel
+    )
+    return np.asarray(list(embeddings), dtype=np.float32)
+
+
+def _embed_requests(
+    embedder: FastembedTextEmbedder, batch_size: int, requests: List[List[str]]
+) -> List[np.ndarray | List[List[float]]]:
+    # A lone text is embedded as FastembedTextEmbedder.run does
+    if len(requests) == 1 and len(requests[0]) == 1:
+        return [[embedder.run(requests[0][0])["embedding"]]]
+    embeddings = embed_batch(
+        embedder, [text for texts in requests for text in texts], batch_size=batch_size
+    )
+    results = []
+    start = 0
+    for texts in requests:
+        results.append(embeddings[start : start + len(texts)])
+        start += len(texts)
+    return results
+
+
+def batched_embed(
+    embedder: FastembedTextEmbedder,
+    texts: List[str],
+    batcher: MicroBatcher,
+    batch_size: int = 256,
+) -> np.ndarray | List[List[float]]:
+    """
+    Embed texts together with the texts of concurrent calls for the same embedder
+
+    The batcher merges calls from different threads, so one ONNX inference serves several requests, and hands each caller back its own rows.
+
+    Parameters
+    ----------
+    embedder: FastembedTextEmbedder
+        An embedder that has been warmed up
+    texts: List[str]
+        The texts to embed
+    batcher: MicroBatcher
+        Collects concurrent calls into batches
+    batch_size: int
+        The number of texts embedded per inference call
+
+    Returns
+    -------
+    np.ndarray | List[List[float]]
+        One embedding per text. A lone text embedded on its own comes back as a list, as FastembedTextEmbedder.run returns it
+    """
+    group = (id(embedder), batch_size)
+    return batcher.submit(
+        group, list(texts), functools.partial(_embed_requests, embedder, batch_size)
+    )
+
+
+def cached_embed_batch(
+    embedder: FastembedTextEmbedder,
+    model: EmbeddingModel,
+    texts: List[str],
+    cache: QueryEmbeddingCache,
+    batch_size: int = 256,
+    batcher: MicroBatcher | None = None,
+) -> np.ndarray:
+    """
+    Embed a list of texts, only running the model for texts the cache has not seen
+
+    Texts are embedded as the cache normalizes them, so texts sharing a cache key are embedded once, with the same result.
+
+    Parameters
+    ----------
+    embedder: FastembedTextEmbedder
+        An embedder that has been warmed up
+    model: EmbeddingModel
+        The model the embedder was loaded with, used in the cache key
+    texts: List[str]
+        The texts to embed
+    cache: QueryEmbeddingCache
+        The cache to read from and populate
+    batch_size: int
+        The number of texts embedded per inference call
+    batcher: MicroBatcher | None
+        If supplied, texts missing from the cache are embedded together with those of concurrent calls
+
+    Returns
+    -------
+    np.ndarray
+        A float32 array of shape (len(texts), dimensions)
+    """
+    model_key = model.name.value
+    embeddings = cache.get_many(model_key, embedder.prefix, texts)
+    missing: Dict[str, List[int]] = {}
+    for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+        if embedding is None:
+            missing.setdefault(cache.key(model_key, embedder.prefix, text), []).append(i)
+    if missing:
+        to_embed = [cache.normalize(texts[positions[0]]) for positions in missing.values()]
+        if batcher is not None:
+            new_embeddings = np.asarray(
+                batched_embed(embedder, to_embed, batcher, batch_size=batch_size), dtype=np.float32
+            )
+        else:
+            new_embeddings = embed_batch(embedder, to_embed, batch_size=batch_size)
+        cache.put_many(model_key, embedder.prefix, to_embed, new_embeddings)
+        for positions, embedding in zip(missing.values(), new_embeddings):
+            for i in positions:
+                embeddings[i] = embedding
+    return np.vstack(embeddings).astype(np.float32, copy=False)
+
+
+@component
+class RegisteredTextEmbedder:
+    """
+    A haystack component that embeds text using an embedder held by an EmbedderRegistry
+
+    Haystack only allows a component instance to belong to one pipeline, so each pipeline gets its own lightweight instance of this class while the model itself is shared through the registry.
+    Texts missing from the cache are embedded together with those of concurrent requests.
+
+    Parameters
+    ----------
+    model: EmbeddingModel
+        The embedding model to use
+    prefix: str
+        A string prepended to every text before embedding
+    registry: EmbedderRegistry | None
+        The registry to fetch the embedder from. Defaults to the process-wide registry
+    cache: QueryEmbeddingCache | None
+        The cache checked before embedding. Defaults to the process-wide query embedding cache
+    batcher: MicroBatcher | None
+        Collects concurrent requests into batches. Defaults to the process-wide embedding batcher
+    """
+
+    def __init__(
+        self,
+        model: EmbeddingModel,
+        prefix: str = "",
+        registry: EmbedderRegistry | None = None,
+        cache: QueryEmbeddingCache | None = None,
+        batcher: MicroBatcher | None = None,
+    ) -> None:
+        self._model = model
+        self._prefix = prefix
+        self._registry = registry if registry is not None else embedder_registry
+        self._cache = cache if cache is not None else query_embedding_cache
+        self._batcher = batcher if batcher is not None else embedding_batcher
+
+    def warm_up(self) -> None:
+        self._registry.get(self._model, self._prefix)
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        if not isinstance(text, str):
+            raise TypeError("RegisteredTextEmbedder expects a string as input")
+        text = self._cache.normalize(text)
+        cached = self._cache.get(self._model.name.value, self._prefix, text)
+        if cached is not None:
+            return {"embedding": cached.tolist()}
+        embedder = self._registry.get(self._model, self._prefix)
+        embedding = batched_embed(embedder, [text], self._batcher)[0]
+        if isinstance(embedding, np.ndarray):
+            embedding = embedding.tolist()
+        self._cache.put(self._model.name.value, self._prefix, text, embedding)
+        return {"embedding": embedding}
+
+
 class Embeddings:
     """
     This class allows the building or loading of a vector
@@ -191,6 +638,16 @@ class Embeddings:
         standard_concept: bool=False,
         valid_concept: bool = False,
         top_k: int=5,
+        batch_size: int = 256,
+        registry: EmbedderRegistry | None = None,
+        cache: QueryEmbeddingCache | None = None,
+        retriever_backend: RetrieverBackend | None = None,
+        ann_index_path: str | None = None,
+        ef_search: int | None = None,
+        probes: int | None = None,
+        distance_metric: DistanceMetric | None = None,
+        retrieval_mode: RetrievalMode | None = None,
+        batcher: MicroBatcher | None = None,
     ) -> None:
         """
         Initialises the connection to an embeddings database
@@ -214,48 +671,151 @@ class Embeddings:
 
         search_kwargs: dict
             kwargs for vector search.
+
+        batch_size: int
+            The number of search terms embedded per inference call.
+
+        registry: EmbedderRegistry | None
+            The registry embedders are fetched from. Defaults to the process-wide registry.
+
+        cache: QueryEmbeddingCache | None
+            The cache of query embeddings. Defaults to the process-wide query embedding cache.
+
+        retriever_backend: RetrieverBackend | None
+            Where vector search runs. Defaults to the RETRIEVER_BACKEND environment variable, or pgvector if that is not set.
+
+        ann_index_path: str | None
+            The directory of an exported ANN index, used with the ANN backend. Defaults to the ANN_INDEX_PATH environment variable.
+
+        ef_search: int | None
+            hnsw.ef_search for pgvector queries. If None, the server default is used.
+
+        probes: int | None
+            ivfflat.probes for pgvector queries. If None, the server default is used.
+
+        distance_metric: DistanceMetric | None
+            The metric pgvector ranks concepts by. Defaults to the VECTOR_DISTANCE_METRIC environment variable, or cosine.
+            Scores are on the cosine distance scale whichever metric is used. The ANN backend always ranks by cosine.
+
+        retrieval_mode: RetrievalMode | None
+            Whether pgvector searches the full vectors, or a halfvec or binary-quantized index followed by an exact rerank.
+            Defaults to the VECTOR_RETRIEVAL_MODE environment variable, or exact.
+
+        batcher: MicroBatcher | None
+            Merges query embedding with that of concurrent requests. Defaults to the process-wide embedding batcher.
         """
         self._model = get_embedding_model(model_name)
+        self._registry = registry if registry is not None else embedder_registry
         self._embed_vocab = embed_vocab
         self._domain_id = domain_id
         self._standard_concept = standard_concept
         self._valid_concept = valid_concept
         self._top_k = top_k
+        self._batch_size = batch_size
+        self._cache = cache if cache is not None else query_embedding_cache
+        self._batcher = batcher if batcher is not None else embedding_batcher
+        self._retriever_backend = RetrieverBackend(
+            retriever_backend or os.getenv("RETRIEVER_BACKEND", RetrieverBackend.PGVECTOR.value)
+        )
+        self._ann_index_path = ann_index_path or os.getenv("ANN_INDEX_PATH")
+        self._ef_search = ef_search
+        self._probes = probes
+        self._distance_metric = DistanceMetric(
+            distance_metric or os.getenv("VECTOR_DISTANCE_METRIC", DistanceMetric.COSINE.value)
+        )
+        self._retrieval_mode = RetrievalMode(
+            retrieval_mode or os.getenv("VECTOR_RETRIEVAL_MODE", RetrievalMode.EXACT.value)
+        )
 
 
-    def get_embedder(self) -> FastembedTextEmbedder:
+    def get_embedder(self) -> RegisteredTextEmbedder:
         """
         Get an embedder for queries in LLM pipelines
 
+        The model is shared with every other caller through the process-wide embedder registry, so it is only loaded once per process.
+
         Returns
         _______
-        FastembedTextEmbedder
+        RegisteredTextEmbedder
         """
-        query_embedder = FastembedTextEmbedder(model=self._model.info.path, parallel=0)
-        query_embedder.warm_up()
-        return query_embedder
+        return RegisteredTextEmbedder(
+            self._model, registry=self._registry, cache=self._cache, batcher=self._batcher
+        )
 
-    def get_retriever(self) -> PGVectorQuery:
+    def get_retriever(self) -> PGVectorQuery | ANNVectorQuery:
         """
         Get a retriever for LLM pipelines
 
+        A pgvector retriever reads the denormalized embeddings table if it has been built, otherwise the embeddings table joined to concept.
+
         Returns
         -------
-        PGVectorQuery
+        PGVectorQuery | ANNVectorQuery
+            An ANNVectorQuery if the ANN backend was selected, otherwise a PGVectorQuery
         """
+        if self._retriever_backend == RetrieverBackend.ANN:
+            if not self._ann_index_path:
+                raise ValueError("The ANN retriever backend needs ann_index_path or ANN_INDEX_PATH to be set")
+            index = load_ann_index(self._ann_index_path)
+            if index.dimensions != self._model.info.dimensions:
+                raise AssertionError(f"Embedder dimensions {self._model.info.dimensions} not equal to ANN index dimensions {index.dimensions}")
+            return ANNVectorQuery(
+                    index,
+                    connection=db_session(),
+                    embed_vocab=self._embed_vocab,
+                    domain_id=self._domain_id,
+                    standard_concept=self._standard_concept,
+                    valid_concept=self._valid_concept,
+                    top_k=self._top_k,
+                    )
         try:
             assert(self._model.info.dimensions == int(os.environ["DB_VECSIZE"]))
+            session = db_session()
+            # The layout lookup ends its transaction, so each query can begin its own
+            with session.begin():
+                layout = detect_embedding_layout(session)
             return PGVectorQuery(
-                    db_session(),
+                    session,
                     embed_vocab=self._embed_vocab,
                     domain_id=self._domain_id,
                     standard_concept=self._standard_concept,
                     valid_concept=self._valid_concept,
                     top_k=self._top_k,
+                    ef_search=self._ef_search,
+                    probes=self._probes,
+                    metric=self._distance_metric,
+                    mode=self._retrieval_mode,
+                    layout=layout,
                     )
         except AssertionError:
             raise AssertionError(f"Embedder dimensions {str(self._model.info.dimensions)} not equal to vector store dimensions {str()}")
 
+    def embed_queries(self, query: List[str]) -> np.ndarray:
+        """
+        Embed a list of search terms in batches
+
+        Parameters
+        ----------
+        query: List[str]
+            A list of informal medication names
+
+        Returns
+        -------
+        np.ndarray
+            A float32 array with one row per search term
+        """
+        if not query:
+            return np.empty((0, self._model.info.dimensions), dtype=np.float32)
+        query_embedder = self._registry.get(self._model, prefix="query:")
+        return cached_embed_batch(
+            query_embedder,
+            self._model,
+            query,
+            self._cache,
+            batch_size=self._batch_size,
+            batcher=self._batcher,
+        )
+
     def search(self, query: List[str]) -> List[List[Dict[str, Any]]]:
         """
         Search the attached vector database with a list of informal medications
@@ -271,15 +831,8 @@ class Embeddings:
             For each medication in the query, the result of searching the vector database
         """
         retriever = self.get_retriever()
-        query_embedder = FastembedTextEmbedder(
-            model=self._model.info.path, parallel=0, prefix="query:"
-        )
-        query_embedder.warm_up()
-        query_embeddings = [query_embedder.run(name) for name in query]
-        result = [
-            retriever.run(query_embedding["embedding"])
-            for query_embedding in query_embeddings
-        ]
+        query_embeddings = self.embed_queries(query)
+        result = retriever.run_batch(query_embeddings)["documents"]
         return [
             [
                 {
@@ -287,7 +840,7 @@ class Embeddings:
                     "concept": doc.content,
                     "score": doc.score,
                 }
-                for doc in res["documents"]
+                for doc in documents
             ]
-            for res in result
+            for documents in result
         ]
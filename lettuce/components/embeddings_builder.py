@@ -0,0 +1,308 @@
+import io
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Callable, List, NamedTuple, Sequence, Set
+
+import numpy as np
+from haystack_integrations.components.embedders.fastembed import (
+    FastembedTextEmbedder,
+)
+from sqlalchemy import delete, func, literal, or_, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+
+from components.embeddings import EmbeddingModel, embed_batch
+from omop.omop_models import (
+    DB_SCHEMA,
+    DB_VECSIZE,
+    DB_VECTABLE,
+    Concept,
+    Embedding,
+    EmbeddingBuildState,
+)
+
+
+class BuildSummary(NamedTuple):
+    embedded: int
+    pruned: int
+
+
+class PendingChunk(NamedTuple):
+    """
+    A chunk of concepts read from the database, waiting to be embedded
+    """
+
+    concept_ids: List[int]
+    names: List[str]
+    text_hashes: List[str]
+    replaces: List[int]
+
+
+def model_key(model: EmbeddingModel, prefix: str) -> str:
+    return f"{model.name.value}:{prefix}"
+
+
+def text_hash(prefix: str):
+    """
+    The hash recorded for each embedded concept name, computed in the database so changed names are found without reading every row
+    """
+    return func.md5(literal(prefix) + Concept.concept_name)
+
+
+def pending_concepts_query(
+    model: EmbeddingModel,
+    prefix: str = "",
+    vocabularies: List[str] | None = None,
+) -> Select:
+    """
+    Select the concepts whose names have no embedding from this model, or have changed since they were embedded
+
+    Parameters
+    ----------
+    model: EmbeddingModel
+        The model embeddings are built with
+    prefix: str
+        The prefix put before each name when it is embedded
+    vocabularies: List[str] | None
+        If supplied, only concepts from these vocabularies are selected
+
+    Returns
+    -------
+    Select
+        A query returning concept_id, concept_name, text_hash and embedded columns, ordered by concept_id.
+        embedded is true when the concept already has a stale embedding to replace
+    """
+    name_hash = text_hash(prefix)
+    query = (
+        select(
+            Concept.concept_id,
+            Concept.concept_name,
+            name_hash.label("text_hash"),
+            EmbeddingBuildState.concept_id.is_not(None).label("embedded"),
+        )
+        .outerjoin(
+            EmbeddingBuildState,
+            EmbeddingBuildState.concept_id == Concept.concept_id,
+        )
+        .where(Concept.concept_name.is_not(None))
+        .where(
+            or_(
+                EmbeddingBuildState.concept_id.is_(None),
+                EmbeddingBuildState.text_hash != name_hash,
+                EmbeddingBuildState.model != model_key(model, prefix),
+            )
+        )
+        .order_by(Concept.concept_id)
+    )
+    if vocabularies is not None:
+        query = query.where(Concept.vocabulary_id.in_(vocabularies))
+    return query
+
+
+def copy_rows(concept_ids: Sequence[int], vectors: np.ndarray) -> io.StringIO:
+    """
+    Format embeddings as the text COPY format: a concept id and a pgvector literal per line
+    """
+    buffer = io.StringIO()
+    for concept_id, vector in zip(concept_ids, vectors):
+        buffer.write(f"{int(concept_id)}\t[{','.join(map(repr, vector.tolist()))}]\n")
+    buffer.seek(0)
+    return buffer
+
+
+def _table(name: str) -> str:
+    return f'"{DB_SCHEMA}"."{name}"'
+
+
+def ensure_tables(engine: Engine) -> None:
+    """
+    Create the embeddings table and its build state table if they do not exist
+    """
+    with engine.begin() as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+    Embedding.__table__.create(engine, checkfirst=True)
+    EmbeddingBuildState.__table__.create(engine, checkfirst=True)
+
+
+def write_chunk(
+    engine: Engine,
+    chunk: PendingChunk,
+    vectors: np.ndarray,
+    key: str,
+) -> None:
+    """
+    Load one chunk of embeddings and record it in the build state, in a single transaction
+
+    Stale embeddings for changed concepts are deleted first. Because the state rows commit with the embeddings, a crash loses at most the chunks in flight.
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if chunk.replaces:
+            cursor.execute(
+                f"DELETE FROM {_table(DB_VECTABLE)} WHERE concept_id = ANY(%s)",
+                (chunk.replaces,),
+            )
+        cursor.copy_expert(
+            f"COPY {_table(DB_VECTABLE)} (concept_id, embedding) FROM STDIN",
+            copy_rows(chunk.concept_ids, vectors),
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO {_table(EmbeddingBuildState.__tablename__)} (concept_id, model, text_hash)
+            SELECT concept_id, %s, text_hash FROM unnest(%s::integer[], %s::text[]) AS t(concept_id, text_hash)
+            ON CONFLICT (concept_id) DO UPDATE SET model = EXCLUDED.model, text_hash = EXCLUDED.text_hash
+            """,
+            (key, chunk.concept_ids, chunk.text_hashes),
+        )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+_worker_embedder: FastembedTextEmbedder | None = None
+
+
+def _init_worker(model_path: str, prefix: str, threads: int | None) -> None:
+    global _worker_embedder
+    _worker_embedder = FastembedTextEmbedder(
+        model=model_path, prefix=prefix, threads=threads, progress_bar=False
+    )
+    _worker_embedder.warm_up()
+
+
+def _embed_in_worker(names: List[str], batch_size: int) -> np.ndarray:
+    return embed_batch(_worker_embedder, names, batch_size=batch_size)
+
+
+def build_embeddings(
+    engine: Engine,
+    model: EmbeddingModel,
+    prefix: str = "",
+    workers: int = 1,
+    batch_size: int = 256,
+    chunk_size: int = 8192,
+    vocabularies: List[str] | None = None,
+    full: bool = False,
+    prune: bool = False,
+    on_chunk: Callable[[int], None] | None = None,
+) -> BuildSummary:
+    """
+    Build or refresh the embeddings table from the concept table
+
+    Concepts are streamed through a server-side cursor in chunks of chunk_size, embedded in worker processes, and bulk-loaded with COPY.
+    Only concepts with no embedding, or whose name, model or prefix has changed, are embedded, so rerunning after a crash resumes where it stopped and rerunning after a vocabulary release only embeds what changed.
+
+    Parameters
+    ----------
+    engine: Engine
+        An engine connected to the OMOP database
+    model: EmbeddingModel
+        The model to embed concept names with. Its dimensions must match DB_VECSIZE
+    prefix: str
+        A prefix put before each concept name, for models trained with passage prefixes
+    workers: int
+        The number of worker processes embedding chunks. ONNX threads are divided between them
+    batch_size: int
+        The number of names embedded per inference call
+    chunk_size: int
+        The number of concepts read, embedded and loaded as a unit
+    vocabularies: List[str] | None
+        If supplied, only concepts from these vocabularies are embedded
+    full: bool
+        If true, the embeddings and build state are emptied first and everything is embedded again
+    prune: bool
+        If true, embeddings for concepts no longer in the concept table are deleted
+    on_chunk: Callable[[int], None] | None
+        Called with the number of concepts in each chunk once it is loaded, for progress reporting
+
+    Returns
+    -------
+    BuildSummary
+        The number of concepts embedded and the number of embeddings pruned
+    """
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    if model.info.dimensions != DB_VECSIZE:
+        raise ValueError(
+            f"{model.name.value} produces {model.info.dimensions}-dimensional embeddings, but DB_VECSIZE is {DB_VECSIZE}"
+        )
+    ensure_tables(engine)
+    with engine.begin() as connection:
+        if full:
+            connection.execute(text(f"TRUNCATE {_table(DB_VECTABLE)}"))
+            connection.execute(text(f"TRUNCATE {_table(EmbeddingBuildState.__tablename__)}"))
+        else:
+            has_state = connection.execute(select(EmbeddingBuildState.concept_id).limit(1)).first()
+            has_embeddings = connection.execute(select(Embedding.concept_id).limit(1)).first()
+            if has_embeddings is not None and has_state is None:
+                raise RuntimeError(
+                    f"{DB_VECTABLE} was not built by this tool, so there is no record of what it holds. Rebuild it with full=True"
+                )
+
+    key = model_key(model, prefix)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    embedded = 0
+    pending: Set[Future] = set()
+    chunks = {}
+
+    def finish(done: Set[Future]) -> None:
+        nonlocal embedded
+        for future in done:
+            chunk = chunks.pop(future)
+            write_chunk(engine, chunk, future.result(), key)
+            embedded += len(chunk.concept_ids)
+            if on_chunk is not None:
+                on_chunk(len(chunk.concept_ids))
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(model.info.path, prefix, threads),
+    ) as executor, engine.connect() as reader:
+        result = reader.execution_options(yield_per=chunk_size).execute(
+            pending_concepts_query(model, prefix, vocabularies)
+        )
+        for partition in result.partitions():
+            chunk = PendingChunk(
+                concept_ids=[row.concept_id for row in partition],
+                names=[row.concept_name for row in partition],
+                text_hashes=[row.text_hash for row in partition],
+                replaces=[row.concept_id for row in partition if row.embedded],
+            )
+            future = executor.submit(_embed_in_worker, chunk.names, batch_size)
+            chunks[future] = chunk
+            pending.add(future)
+            # Bound the chunks held in memory while keeping every worker busy
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+        finish(wait(pending).done)
+
+    pruned = 0
+    if prune:
+        with engine.begin() as connection:
+            missing = ~select(Concept.concept_id).where(
+                Concept.concept_id == Embedding.concept_id
+            ).exists()
+            pruned = connection.execute(delete(Embedding).where(missing)).rowcount
+            connection.execute(
+                delete(EmbeddingBuildState).where(
+                    ~select(Concept.concept_id)
+                    .where(Concept.concept_id == EmbeddingBuildState.concept_id)
+                    .exists()
+                )
+            )
+
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f'CREATE INDEX IF NOT EXISTS "{DB_VECTABLE}_concept_id_idx" ON {_table(DB_VECTABLE)} (concept_id)'
+            )
+        )
+    return BuildSummary(embedded=embedded, pruned=pruned)
@@ -0,0 +1,127 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a BoundedExecutor already holds as much work as it allows
+    """
+
+
+class BoundedExecutor:
+    """
+    Runs blocking calls from async routes in a fixed set of worker threads, with a bounded queue in front
+
+    Awaiting run leaves the event loop free, so cheap requests are served while the workers are busy.
+    Once max_workers calls are running and max_queue are waiting, new calls are refused with QueueFullError rather than piling up.
+    A call holds its place until it finishes, even if the request that made it is cancelled, because a running thread can't be interrupted.
+
+    Threads rather than processes are used because llama.cpp, onnxruntime and database drivers release the GIL while they work, and a process pool would need its own copy of every loaded model.
+
+    Parameters
+    ----------
+    name: str
+        Used to name the worker threads and in stats
+    max_workers: int
+        The number of calls run at once
+    max_queue: int
+        The number of calls waiting for a worker before new calls are refused
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"lettuce-{name}"
+        )
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _call(self, func: Callable[..., T]) -> T:
+        with self._lock:
+            self._running += 1
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+
+    def _done(self, _) -> None:
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Call func(*args, **kwargs) in a worker thread and wait for its result
+
+        Context variables are copied into the worker, so logging context carries over.
+
+        Raises
+        ------
+        QueueFullError
+            If the workers are busy and the queue is full
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError(
+                f"The {self.name} queue is full ({self.max_workers} running, {self.max_queue} waiting)"
+            )
+        with self._lock:
+            self._pending += 1
+        context = contextvars.copy_context()
+        try:
+            future = self._executor.submit(
+                self._call, functools.partial(context.run, func, *args, **kwargs)
+            )
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report the calls running, waiting, completed and refused
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._pending - self._running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# LLM generation, embedding and model loading. Concurrent LLM calls are batched, so there should be at least LLM_MAX_BATCH_SIZE workers
+inference_executor = BoundedExecutor(
+    "inference",
+    max_workers=int(os.getenv("INFERENCE_WORKERS", "8")),
+    max_queue=int(os.getenv("INFERENCE_QUEUE_SIZE", "32")),
+)
+
+# Database queries, which mostly wait on the server
+database_executor = BoundedExecutor(
+    "database",
+    max_workers=int(os.getenv("DATABASE_WORKERS", "8")),
+    max_queue=int(os.getenv("DATABASE_QUEUE_SIZE", "64")),
+)
@@ -0,0 +1,197 @@
+import json
+import os
+from enum import Enum
+from typing import Any, Dict
+
+from pydantic import BaseModel, ConfigDict
+
+
+class KVCacheType(str, Enum):
+    """
+    The data types llama.cpp can store the KV cache in
+
+    Quantized types shrink the cache, so longer contexts fit in memory. llama.cpp needs flash attention for a quantized V cache.
+    """
+
+    F32 = "f32"
+    F16 = "f16"
+    Q8_0 = "q8_0"
+    Q5_1 = "q5_1"
+    Q5_0 = "q5_0"
+    Q4_1 = "q4_1"
+    Q4_0 = "q4_0"
+
+    @property
+    def ggml_type(self) -> int:
+        return {
+            "f32": 0,
+            "f16": 1,
+            "q4_0": 2,
+            "q4_1": 3,
+            "q5_0": 6,
+            "q5_1": 7,
+            "q8_0": 8,
+        }[self.value]
+
+
+# LlamaRuntime settings that are sent with each prompt rather than used to load the model
+GENERATION_FIELDS = {"max_tokens"}
+
+
+class LlamaRuntime(BaseModel):
+    """
+    The settings a llama.cpp model is loaded and run with
+
+    Instances are immutable and hashable, so they can be part of a ModelKey.
+
+    Attributes
+    ----------
+    n_ctx: int
+        The context size
+    n_batch: int
+        The prompt processing batch size
+    max_tokens: int
+        The maximum number of tokens generated per prompt
+    n_gpu_layers: int | None
+        The number of layers offloaded to a GPU, -1 for all. If None, every layer is offloaded when CUDA or MPS is available
+    n_threads: int | None
+        Threads used for generation. If None, llama.cpp uses half the CPU count
+    n_threads_batch: int | None
+        Threads used for prompt processing. If None, llama.cpp uses the CPU count
+    use_mmap: bool
+        Memory-map the weights file rather than reading it into memory
+    use_mlock: bool
+        Lock the weights in RAM, so they are never swapped out
+    type_k: KVCacheType | None
+        The data type of the K cache. If None, llama.cpp uses f16
+    type_v: KVCacheType | None
+        The data type of the V cache. If None, llama.cpp uses f16
+    flash_attn: bool
+        Use flash attention
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    n_ctx: int = 1024
+    n_batch: int = 32
+    max_tokens: int = 128
+    n_gpu_layers: int | None = None
+    n_threads: int | None = None
+    n_threads_batch: int | None = None
+    use_mmap: bool = True
+    use_mlock: bool = False
+    type_k: KVCacheType | None = None
+    type_v: KVCacheType | None = None
+    flash_attn: bool = False
+
+    def model_kwargs(self, n_gpu_layers: int) -> Dict[str, Any]:
+        """
+        Build the keyword arguments for llama_cpp.Llama
+
+        Settings left at llama.cpp's defaults are omitted.
+
+        Parameters
+        ----------
+        n_gpu_layers: int
+            The number of GPU layers, resolved by the caller when n_gpu_layers is None
+        """
+        kwargs: Dict[str, Any] = {
+            "n_ctx": self.n_ctx,
+            "n_batch": self.n_batch,
+            "n_gpu_layers": n_gpu_layers,
+            "verbose": True,
+        }
+        if self.n_threads is not None:
+            kwargs["n_threads"] = self.n_threads
+        if self.n_threads_batch is not None:
+            kwargs["n_threads_batch"] = self.n_threads_batch
+        if not self.use_mmap:
+            kwargs["use_mmap"] = False
+        if self.use_mlock:
+            kwargs["use_mlock"] = True
+        if self.type_k is not None:
+            kwargs["type_k"] = self.type_k.ggml_type
+        if self.type_v is not None:
+            kwargs["type_v"] = self.type_v.ggml_type
+        if self.flash_attn:
+            kwargs["flash_attn"] = True
+        return kwargs
+
+    def load_settings(self) -> "LlamaRuntime":
+        """
+        These settings with those that only affect generation, i.e. max_tokens, reset to their defaults
+
+        Runtimes that differ only in generation settings load the same model, so this is the runtime a ModelKey, or a cached prefix state, is keyed by.
+        """
+        return self.model_copy(
+            update={field: LlamaRuntime.model_fields[field].default for field in GENERATION_FIELDS}
+        )
+
+
+class LlamaRuntimeOptions(BaseModel):
+    """
+    Overrides for some LlamaRuntime settings. Settings left as None keep the value they are applied to
+
+    The attributes are the same as LlamaRuntime's.
+    """
+
+    n_ctx: int | None = None
+    n_batch: int | None = None
+    max_tokens: int | None = None
+    n_gpu_layers: int | None = None
+    n_threads: int | None = None
+    n_threads_batch: int | None = None
+    use_mmap: bool | None = None
+    use_mlock: bool | None = None
+    type_k: KVCacheType | None = None
+    type_v: KVCacheType | None = None
+    flash_attn: bool | None = None
+
+    def apply(self, runtime: LlamaRuntime) -> LlamaRuntime:
+        return runtime.model_copy(update=self.model_dump(exclude_none=True))
+
+    @classmethod
+    def from_env(cls) -> "LlamaRuntimeOptions":
+        """
+        Read overrides from LLAMA_N_CTX, LLAMA_N_BATCH, LLAMA_MAX_TOKENS, LLAMA_N_GPU_LAYERS, LLAMA_N_THREADS, LLAMA_N_THREADS_BATCH, LLAMA_USE_MMAP, LLAMA_USE_MLOCK, LLAMA_TYPE_K, LLAMA_TYPE_V and LLAMA_FLASH_ATTN
+        """
+        values = {}
+        for field in cls.model_fields:
+            value = os.getenv(f"LLAMA_{field.upper()}")
+            if value:
+                values[field] = value
+        return cls.model_validate(values)
+
+
+def load_runtime_profile(path: str) -> LlamaRuntime:
+    """
+    Read the settings from a profile written by lettuce-autotune-llama
+    """
+    with open(path) as f:
+        return LlamaRuntime.model_validate(json.load(f)["runtime"])
+
+
+def save_runtime_profile(path: str, runtime: LlamaRuntime, **details: Any) -> None:
+    """
+    Write settings to a profile, with any details of how they were chosen
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"runtime": runtime.model_dump(mode="json"), **details}, f, indent=2)
+
+
+def resolve_runtime(options: LlamaRuntimeOptions | None = None) -> LlamaRuntime:
+    """
+    Work out the settings to load a model with
+
+    The LLAMA_RUNTIME_PROFILE file is the base if it is set, otherwise the defaults.
+    LLAMA_* environment variables override it, and options override both.
+    """
+    profile = os.getenv("LLAMA_RUNTIME_PROFILE")
+    runtime = load_runtime_profile(profile) if profile else LlamaRuntime()
+    runtime = LlamaRuntimeOptions.from_env().apply(runtime)
+    if options is not None:
+        runtime = options.apply(runtime)
+    return runtime
@@ -0,0 +1,443 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from haystack import component
+from haystack_integrations.components.generators.llama_cpp import LlamaCppGenerator
+from llama_cpp import LlamaGrammar
+
+from components.batched_decoding import batched_completion, batched_decoding_supported
+from components.decoding import SpeculativeDecoding
+from components.llama_runtime import LlamaRuntime, resolve_runtime
+from components.models import (
+    LlamaModelDraft,
+    get_local_weights,
+    resolve_weights_path,
+    speculative_draft_model,
+)
+from components.prefix_cache import PrefixStateCache, prefix_state_cache
+from options.pipeline_options import LLMModel
+from utils.batching import MicroBatcher
+from utils.logging_utils import logger as default_logger
+
+# Generation settings batched_completion supports. Requests with any others, e.g. a grammar, run on their own
+BATCHABLE_KWARGS = {"max_tokens", "temperature", "stop", "seed"}
+
+
+def temperature_profile(temperature: float) -> str:
+    """
+    Group temperatures into the profiles that get their own model instance
+
+    Deterministic and sampled requests are served by separate instances, so long sampled generations don't hold up greedy ones.
+    The exact temperature is sent with every request, so all temperatures in a profile share an instance.
+    """
+    return "deterministic" if temperature == 0 else "sampled"
+
+
+class ModelKey(NamedTuple):
+    """
+    Everything that decides which loaded model instance a request can use
+
+    runtime holds the other load settings, e.g. threads and KV cache type. Its n_ctx and n_batch are replaced by the key's. If None, resolve_runtime decides when the model is loaded.
+    It should be a runtime's load_settings, so requests differing only in max_tokens share an instance.
+    """
+
+    model: LLMModel
+    weights_path: str | None
+    n_ctx: int
+    n_batch: int
+    temperature_profile: str
+    speculative_decoding: SpeculativeDecoding = SpeculativeDecoding.NONE
+    runtime: LlamaRuntime | None = None
+
+
+class _PoolEntry:
+    """
+    A loaded generator, its memory footprint, and the lock that serializes access to it
+    """
+
+    def __init__(self, generator: LlamaCppGenerator, footprint: int) -> None:
+        self.generator = generator
+        self.footprint = footprint
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.closed = False
+
+
+def _close(entry: _PoolEntry) -> None:
+    entry.closed = True
+    model = getattr(entry.generator, "model", None)
+    if isinstance(getattr(model, "draft_model", None), LlamaModelDraft):
+        model.draft_model.close()
+    if model is not None and hasattr(model, "close"):
+        model.close()
+    entry.generator.model = None
+
+
+class ModelPool:
+    """
+    A process-wide pool of loaded llama.cpp models
+
+    Loading GGUF weights takes far longer than answering a prompt, so each ModelKey is loaded once and kept resident.
+    llama.cpp contexts are not thread-safe, so each instance has a lock and requests for the same instance take turns.
+    When loading a model would take the pool over its memory budget, the least recently used idle instances are unloaded first.
+    Models can be loaded, reloaded or unloaded while the process runs, and requests already using a replaced instance finish on it before it is closed.
+
+    Parameters
+    ----------
+    memory_budget: int | None
+        The total size in bytes of the weights the pool keeps loaded. If None, nothing is evicted
+    logger: logging.Logger | None
+        Logger for loads and evictions
+    """
+
+    def __init__(
+        self, memory_budget: int | None = None, logger: logging.Logger | None = None
+    ) -> None:
+        self._memory_budget = memory_budget
+        self._logger = logger or default_logger
+        self._entries: OrderedDict[ModelKey, _PoolEntry] = OrderedDict()
+        self._key_locks: Dict[ModelKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key: ModelKey) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _load(self, key: ModelKey) -> _PoolEntry:
+        path = resolve_weights_path(key.model, key.weights_path, self._logger)
+        footprint = os.path.getsize(path)
+        self._make_room(footprint)
+        start = time.time()
+        runtime = (key.runtime or resolve_runtime().load_settings()).model_copy(
+            update={"n_ctx": key.n_ctx, "n_batch": key.n_batch}
+        )
+        draft_model, draft_footprint = speculative_draft_model(
+            key.speculative_decoding,
+            key.model,
+            self._logger,
+            runtime=runtime,
+        )
+        generator = None
+        try:
+            generator = get_local_weights(
+                path,
+                0.0 if key.temperature_profile == "deterministic" else 0.7,
+                self._logger,
+                runtime=runtime,
+                draft_model=draft_model,
+            )
+            generator.warm_up()
+            if isinstance(draft_model, LlamaModelDraft):
+                draft_model.check_compatible(generator.model)
+        except Exception:
+            # The model never joins the pool, so nothing else would free its memory
+            if generator is not None:
+                _close(_PoolEntry(generator, footprint))
+            if isinstance(draft_model, LlamaModelDraft):
+                draft_model.close()
+            raise
+        footprint += draft_footprint
+        self._logger.info(f"Loaded {key.model.value} into the model pool in {time.time() - start} seconds")
+        return _PoolEntry(generator, footprint)
+
+    def _make_room(self, footprint: int) -> None:
+        if self._memory_budget is None:
+            return
+        with self._lock:
+            used = sum(entry.footprint for entry in self._entries.values())
+            for key in list(self._entries.keys()):
+                if used + footprint <= self._memory_budget:
+                    break
+                entry = self._entries[key]
+                if not entry.lock.acquire(blocking=False):
+                    continue
+                try:
+                    del self._entries[key]
+                    _close(entry)
+                finally:
+                    entry.lock.release()
+                used -= entry.footprint
+                self._logger.info(f"Evicted {key.model.value} from the model pool")
+        if used + footprint > self._memory_budget:
+            self._logger.warning(
+                "Loading a model beyond the model pool's memory budget, because every loaded model is in use"
+            )
+
+    def get(self, key: ModelKey) -> _PoolEntry:
+        """
+        Fetch the entry for a key, loading the model if it isn't resident
+
+        Loading is guarded by a lock per key, so concurrent requests for a model that is loading wait for it rather than loading it twice.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                entry = self._load(key)
+                with self._lock:
+                    self._entries[key] = entry
+            return entry
+
+    @contextmanager
+    def acquire(self, key: ModelKey) -> Iterator[LlamaCppGenerator]:
+        """
+        Hold a model instance for the duration of a with block
+
+        Parameters
+        ----------
+        key: ModelKey
+            The instance to use
+
+        Yields
+        ------
+        LlamaCppGenerator
+            A warm generator that no other request uses until the block exits
+        """
+        while True:
+            entry = self.get(key)
+            entry.lock.acquire()
+            if not entry.closed:
+                break
+            # Unloaded or replaced between lookup and locking
+            entry.lock.release()
+        try:
+            entry.last_used = time.monotonic()
+            yield entry.generator
+        finally:
+            entry.lock.release()
+
+    def reload(self, key: ModelKey) -> None:
+        """
+        Load a fresh instance for a key and swap it in, e.g. after the weights file has been replaced
+
+        New requests use the new instance immediately. The old one is closed once its current request finishes.
+        """
+        with self._key_lock(key):
+            new_entry = self._load(key)
+            with self._lock:
+                old_entry = self._entries.get(key)
+                self._entries[key] = new_entry
+                self._entries.move_to_end(key)
+        if old_entry is not None:
+            with old_entry.lock:
+                _close(old_entry)
+
+    def unload(self, key: ModelKey) -> bool:
+        """
+        Unload an instance once its current request finishes
+
+        Returns
+        -------
+        bool
+            Whether the key was loaded
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        with entry.lock:
+            _close(entry)
+        return True
+
+    def loaded(self) -> List[Dict[str, Any]]:
+        """
+        Describe the loaded instances, least recently used first
+        """
+        with self._lock:
+            return [
+                {
+                    "model": key.model.value,
+                    "weights_path": key.weights_path,
+                    "n_ctx": key.n_ctx,
+                    "n_batch": key.n_batch,
+                    "temperature_profile": key.temperature_profile,
+                    "speculative_decoding": key.speculative_decoding.value,
+                    "footprint_bytes": entry.footprint,
+                    "in_use": entry.lock.locked(),
+                }
+                for key, entry in self._entries.items()
+            ]
+
+    def clear(self) -> None:
+        """
+        Unload every instance
+        """
+        with self._lock:
+            keys = list(self._entries.keys())
+        for key in keys:
+            self.unload(key)
+
+
+@functools.lru_cache(maxsize=8)
+def compiled_grammar(gbnf: str) -> LlamaGrammar:
+    """
+    Compile a GBNF grammar once per process
+
+    PooledGenerators are built per request, and a vocabulary grammar can hold every concept name in a vocabulary, so compiled grammars are shared between them
+    """
+    return LlamaGrammar.from_string(gbnf, verbose=False)
+
+
+def _memory_budget_from_env() -> int | None:
+    value = os.getenv("LLM_POOL_MEMORY_GB")
+    if not value:
+        return None
+    return int(float(value) * 1024**3)
+
+
+llm_pool = ModelPool(memory_budget=_memory_budget_from_env())
+
+llm_batcher = MicroBatcher(
+    max_batch_size=int(os.getenv("LLM_MAX_BATCH_SIZE", "8")),
+    max_wait_ms=float(os.getenv("LLM_BATCH_MAX_WAIT_MS", "5")),
+)
+
+
+@component
+class PooledGenerator:
+    """
+    A haystack component that generates text with a model held by a ModelPool
+
+    Haystack only allows a component instance to belong to one pipeline, so each pipeline gets its own lightweight instance of this class while the model itself is shared through the pool.
+    It has the same inputs and outputs as LlamaCppGenerator.
+    A GBNF grammar may be passed as text in generation_kwargs. It is compiled once and reused.
+
+    Concurrent prompts for the same model and generation settings are collected by a MicroBatcher and decoded together as parallel sequences with batched_completion.
+    Prompts with a grammar, or for a model using speculative decoding, are generated one at a time.
+
+    Parameters
+    ----------
+    model: LLMModel
+        The model to generate with
+    temperature: float
+        The temperature sent with every prompt
+    weights_path: str | None
+        A local GGUF file. If None, the model's weights are downloaded from Hugging Face
+    n_ctx: int | None
+        The context size the model is loaded with. If None, the runtime's is used
+    n_batch: int | None
+        The prompt processing batch size the model is loaded with. If None, the runtime's is used
+    max_tokens: int | None
+        The maximum number of tokens generated per prompt. If None, the runtime's is used
+    pool: ModelPool | None
+        The pool to fetch the model from. Defaults to the process-wide pool
+    speculative_decoding: SpeculativeDecoding
+        How the model drafts tokens to verify in one batch
+    prefix: str | None
+        The fixed start of every prompt this generator is sent. If supplied, its evaluated state is cached and restored before each prompt
+    prefix_cache: PrefixStateCache | None
+        The cache prefix states are kept in. Defaults to the process-wide cache
+    runtime: LlamaRuntime | None
+        The settings the model is loaded and run with. If None, resolve_runtime decides
+    batcher: MicroBatcher | None
+        Collects concurrent prompts into batches. Defaults to the process-wide batcher
+    """
+
+    def __init__(
+        self,
+        model: LLMModel,
+        temperature: float,
+        weights_path: str | None = None,
+        n_ctx: int | None = None,
+        n_batch: int | None = None,
+        max_tokens: int | None = None,
+        pool: ModelPool | None = None,
+        speculative_decoding: SpeculativeDecoding = SpeculativeDecoding.NONE,
+        prefix: str | None = None,
+        prefix_cache: PrefixStateCache | None = None,
+        runtime: LlamaRuntime | None = None,
+        batcher: MicroBatcher | None = None,
+    ) -> None:
+        runtime = runtime or resolve_runtime()
+        self._key = ModelKey(
+            model=model,
+            weights_path=weights_path,
+            n_ctx=n_ctx or runtime.n_ctx,
+            n_batch=n_batch or runtime.n_batch,
+            temperature_profile=temperature_profile(temperature),
+            speculative_decoding=speculative_decoding,
+            runtime=runtime.load_settings(),
+        )
+        self._generation_kwargs = {
+            "max_tokens": max_tokens or runtime.max_tokens,
+            "temperature": temperature,
+        }
+        self._pool = pool if pool is not None else llm_pool
+        self._prefix = prefix
+        self._prefix_cache = prefix_cache if prefix_cache is not None else prefix_state_cache
+        self._batcher = batcher if batcher is not None else llm_batcher
+
+    @property
+    def key(self) -> ModelKey:
+        return self._key
+
+    def warm_up(self) -> None:
+        self._pool.get(self._key)
+
+    def _batchable(self, generation_kwargs: Dict[str, Any]) -> bool:
+        return (
+            self._batcher.enabled
+            and self._key.speculative_decoding == SpeculativeDecoding.NONE
+            and set(generation_kwargs) <= BATCHABLE_KWARGS
+        )
+
+    def _run_one(
+        self, generator: LlamaCppGenerator, prompt: str, generation_kwargs: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        tokens_reused = 0
+        if self._prefix and prompt.startswith(self._prefix):
+            tokens_reused = self._prefix_cache.prepare(
+                generator.model, self._prefix, prompt, runtime=self._key.runtime
+            )
+        result = generator.run(prompt, generation_kwargs=generation_kwargs)
+        for meta in result["meta"]:
+            meta["prompt_tokens_reused"] = tokens_reused
+            meta["batch_size"] = 1
+        return result
+
+    def _run_batch(
+        self, generation_kwargs: Dict[str, Any], prompts: List[str]
+    ) -> List[Dict[str, Any] | ValueError]:
+        with self._pool.acquire(self._key) as generator:
+            # A lone prompt keeps the prefix cache
+            if len(prompts) == 1 or not batched_decoding_supported(generator.model):
+                return [
+                    self._run_one(generator, prompt, generation_kwargs) for prompt in prompts
+                ]
+            completions = batched_completion(generator.model, prompts, **generation_kwargs)
+        return [
+            completion
+            if isinstance(completion, ValueError)
+            else {"replies": [completion["choices"][0]["text"]], "meta": [completion]}
+            for completion in completions
+        ]
+
+    @component.output_types(replies=List[str], meta=List[Dict[str, Any]])
+    def run(self, prompt: str, generation_kwargs: Optional[Dict[str, Any]] = None):
+        generation_kwargs = {**self._generation_kwargs, **(generation_kwargs or {})}
+        if self._batchable(generation_kwargs):
+            group = (
+                id(self._pool),
+                self._key,
+                self._prefix,
+                json.dumps(generation_kwargs, sort_keys=True),
+            )
+            return self._batcher.submit(
+                group, prompt, functools.partial(self._run_batch, generation_kwargs)
+            )
+        if isinstance(generation_kwargs.get("grammar"), str):
+            generation_kwargs["grammar"] = compiled_grammar(generation_kwargs["grammar"])
+        with self._pool.acquire(self._key) as generator:
+            return self._run_one(generator, prompt, generation_kwargs)
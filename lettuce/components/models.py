@@ -1,9 +1,15 @@
 import os 
 import logging
-from typing import Any 
+from typing import Any, Tuple
+import numpy as np
+import numpy.typing as npt
 from haystack.components.generators import OpenAIGenerator
 from haystack_integrations.components.generators.llama_cpp import LlamaCppGenerator
 from huggingface_hub import hf_hub_download
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+from components.decoding import SpeculativeDecoding
+from components.llama_runtime import LlamaRuntime, resolve_runtime
 from options.pipeline_options import LLMModel
 import torch
 
@@ -84,10 +90,48 @@ local_models = {
 }
 
 
+# Smaller models with the same tokenizer, used to draft tokens in SpeculativeDecoding.DRAFT_MODEL
+draft_models = {
+    "llama-3-8b": "llama-3.2-3b",
+    "llama-3-70b": "llama-3.2-3b",
+    "llama-3.1-8b": "llama-3.2-3b",
+}
+
+
+def gpu_layers(runtime: LlamaRuntime) -> int:
+    """
+    The number of layers to offload: the runtime's setting, or every layer when CUDA or MPS is available
+    """
+    if runtime.n_gpu_layers is not None:
+        return runtime.n_gpu_layers
+    return -1 if (torch.cuda.is_available() or torch.backends.mps.is_available()) else 0
+
+
+def _llama_cpp_generator(
+    path_to_weights: os.PathLike | str,
+    temperature: float,
+    logger: logging.Logger,
+    runtime: LlamaRuntime,
+    draft_model: LlamaDraftModel | None = None,
+) -> LlamaCppGenerator:
+    device = gpu_layers(runtime)
+    logger.info(f"Using {device} GPU layers")
+    model_kwargs = runtime.model_kwargs(device)
+    if draft_model is not None:
+        model_kwargs["draft_model"] = draft_model
+    return LlamaCppGenerator(
+        model=path_to_weights, 
+        model_kwargs=model_kwargs, 
+        generation_kwargs={"max_tokens": runtime.max_tokens, "temperature": temperature}
+    )
+
+
 def get_local_weights(
     path_to_weights: os.PathLike | str | None, 
     temperature: float, 
-    logger: logging.Logger
+    logger: logging.Logger,
+    runtime: LlamaRuntime | None = None,
+    draft_model: LlamaDraftModel | None = None,
 ):
     """
     Load a local GGUF model weights file and return a LlamaCppGenerator object.
@@ -100,6 +144,10 @@ def get_local_weights(
         The temperature for model generation (default is 0.7).
     logger : logging.Logger
         Logger instance for tracking progress and errors.
+    runtime : LlamaRuntime | None
+        The settings the model is loaded and run with. If None, they come from resolve_runtime: a tuned profile, LLAMA_* environment variables, and defaults.
+    draft_model : LlamaDraftModel | None
+        Drafts tokens for speculative decoding, from speculative_draft_model. If None, tokens are generated one at a time.
 
     Returns
     -------
@@ -116,19 +164,9 @@ def get_local_weights(
         raise FileNotFoundError(f"Model weights file not found at {path_to_weights}")
    
     logger.info(f"Loading local model weights from {path_to_weights}")
-    device = -1 if (torch.cuda.is_available() or torch.backends.mps.is_available()) else 0
-    logger.info(f"Using {device} GPU layers")
-
     # Load the model using llama 
-    llm = LlamaCppGenerator(
-        model=path_to_weights, 
-        model_kwargs={
-            "n_ctx": 1024,
-            "n_batch": 32,
-            "n_gpu_layers": device,
-            "verbose": True
-        }, 
-        generation_kwargs={"max_tokens": 128, "temperature": temperature}
+    llm = _llama_cpp_generator(
+        path_to_weights, temperature, logger, runtime or resolve_runtime(), draft_model
     )
     logger.info(f"Succesfully loaded LlamaCppGenerator from {path_to_weights}")
     logger.info(f"LLM Loaded: n_ctx={llm.config.get('n_ctx')}, n_batch={llm.config.get('n_batch')}")
@@ -140,13 +178,9 @@ def download_model_from_huggingface(
     temperature: float, 
     logger: logging.Logger, 
     fallback_model: str = "llama-3.1-8b",
-    n_ctx: int = 1024,
-    n_batch: int = 32,
-    max_tokens: int = 128 
+    runtime: LlamaRuntime | None = None,
 ): 
     logger.info(f"Loading local model: {model_name}")
-    device = -1 if (torch.cuda.is_available() or torch.backends.mps.is_available()) else 0
-    logger.info(f"Using {device} GPU layers")
 
     try: 
         model_config = local_models[model_name]
@@ -160,16 +194,7 @@ def download_model_from_huggingface(
         raise ValueError(f"Failed to load model {model_name}: {str(e)}")
     
     try: 
-        llm = LlamaCppGenerator(
-            model=model_path, 
-            model_kwargs={
-                "n_ctx": n_ctx,
-                "n_batch": n_batch,
-                "n_gpu_layers": device,
-                "verbose": True
-            },
-            generation_kwargs={"max_tokens": max_tokens, "temperature": temperature}
-        )
+        llm = _llama_cpp_generator(model_path, temperature, logger, runtime or resolve_runtime())
     except Exception as e: 
         logger.error(f"Failed to initialize LlamaCppGenerator for {model_name}: {str(e)}")
         raise ValueError(f"Failed to initialize local model {model_name}: {str(e)}")
@@ -177,6 +202,49 @@ def download_model_from_huggingface(
     return llm 
 
 
+def resolve_weights_path(
+    model: LLMModel,
+    path_to_local_weights: os.PathLike | str | None,
+    logger: logging.Logger,
+    fallback_model: str = "llama-3.1-8b",
+) -> str:
+    """
+    Find the GGUF file for a model, downloading it from Hugging Face if no local file is given
+
+    Downloads are cached by huggingface_hub, so this only reaches the network the first time.
+
+    Parameters
+    ----------
+    model: LLMModel
+        The model the weights are for
+    path_to_local_weights: os.PathLike | str | None
+        A local GGUF file to use instead of downloading
+    logger: logging.Logger
+        Logger instance for tracking progress and errors
+    fallback_model: str
+        The model downloaded if there are no download details for model
+
+    Returns
+    -------
+    str
+        The path of the weights file
+    """
+    if path_to_local_weights:
+        if not os.path.isfile(path_to_local_weights):
+            logger.error(f"Model weights not found at {path_to_local_weights}")
+            raise FileNotFoundError(f"Model weights file not found at {path_to_local_weights}")
+        return str(path_to_local_weights)
+    model_config = local_models.get(model.value)
+    if model_config is None:
+        logger.warning(f"Model {model.value} not found in local_models. Falling back to {fallback_model}")
+        model_config = local_models[fallback_model]
+    try:
+        return hf_hub_download(**model_config)
+    except Exception as e:
+        logger.error(f"Failed to download model {model.value}: {str(e)}")
+        raise ValueError(f"Failed to load model {model.value}: {str(e)}")
+
+
 def connect_to_openai(
     model_name: str, 
     temperature: float, 
@@ -227,3 +295,125 @@ def get_model(
             llm = download_model_from_huggingface(model_name, temperature, logger)
 
     return llm
+
+
+class LlamaModelDraft(LlamaDraftModel):
+    """
+    Drafts tokens with a smaller llama.cpp model that shares the target model's vocabulary
+
+    The draft model keeps its own context, and only evaluates the tokens after the longest prefix it has in common with each call's input.
+
+    Parameters
+    ----------
+    draft: Llama
+        The loaded draft model
+    num_pred_tokens: int
+        The number of tokens drafted per call
+    """
+
+    def __init__(self, draft: Llama, num_pred_tokens: int = 4) -> None:
+        self.draft = draft
+        self.num_pred_tokens = num_pred_tokens
+
+    def check_compatible(self, target: Llama) -> None:
+        """
+        Raise a ValueError if the draft model's tokens don't mean the same as the target's
+        """
+        if self.draft.n_vocab() != target.n_vocab():
+            raise ValueError(
+                f"The draft model has a vocabulary of {self.draft.n_vocab()} tokens, but the target model has {target.n_vocab()}"
+            )
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        tokens = input_ids.tolist()
+        if not tokens or len(tokens) + self.num_pred_tokens > self.draft.n_ctx():
+            return np.array([], dtype=np.intc)
+        # Always re-evaluate the last token, so there are logits to sample from
+        reused = min(Llama.longest_token_prefix(self.draft._input_ids, tokens), len(tokens) - 1)
+        self.draft.n_tokens = reused
+        self.draft.eval(tokens[reused:])
+        drafted = []
+        for _ in range(self.num_pred_tokens):
+            token = self.draft.sample(temp=0.0)
+            if token == self.draft.token_eos():
+                break
+            drafted.append(token)
+            self.draft.eval([token])
+        return np.array(drafted, dtype=np.intc)
+
+    def close(self) -> None:
+        self.draft.close()
+
+
+def speculative_draft_model(
+    mode: SpeculativeDecoding,
+    model: LLMModel,
+    logger: logging.Logger,
+    runtime: LlamaRuntime | None = None,
+    num_pred_tokens: int | None = None,
+) -> Tuple[LlamaDraftModel | None, int]:
+    """
+    Build the draft model for a speculative decoding mode
+
+    Parameters
+    ----------
+    mode: SpeculativeDecoding
+        The speculative decoding mode
+    model: LLMModel
+        The model the drafts are for. In draft_model mode, its entry in draft_models is loaded
+    logger: logging.Logger
+        Logger instance for tracking progress and errors
+    runtime: LlamaRuntime | None
+        The settings of the target model, which the draft model is loaded with too
+    num_pred_tokens: int | None
+        The number of tokens drafted per step. If None, 10 are drafted by prompt lookup and 4 by a draft model
+
+    Returns
+    -------
+    Tuple[LlamaDraftModel | None, int]
+        The draft model, or None if speculative decoding is off, and the size in bytes of any weights it loaded
+
+    Raises
+    ------
+    ValueError
+        If draft_model mode is chosen for a model with no draft model
+    """
+    if mode == SpeculativeDecoding.NONE:
+        return None, 0
+    if mode == SpeculativeDecoding.PROMPT_LOOKUP:
+        return LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens or 10), 0
+
+    draft_name = draft_models.get(model.value)
+    if draft_name is None:
+        raise ValueError(f"{model.value} has no draft model for speculative decoding")
+    path = resolve_weights_path(LLMModel(draft_name), None, logger)
+    logger.info(f"Loading draft model {draft_name} for {model.value}")
+    runtime = runtime or resolve_runtime()
+    draft = Llama(model_path=path, **{**runtime.model_kwargs(gpu_layers(runtime)), "verbose": False})
+    return LlamaModelDraft(draft, num_pred_tokens=num_pred_tokens or 4), os.path.getsize(path)
+
+
+def resolve_speculative_decoding(
+    mode: SpeculativeDecoding | None, model: LLMModel
+) -> SpeculativeDecoding:
+    """
+    Choose the speculative decoding mode for a model
+
+    If no mode is given, the LLM_SPECULATIVE_DECODING environment variable decides.
+    It holds either one mode for every model, e.g. "prompt_lookup", or modes per model, e.g. "llama-3.1-8b=draft_model,mistral-7b=prompt_lookup".
+    Models it doesn't mention don't use speculative decoding.
+    """
+    if mode is not None:
+        return mode
+    setting = os.getenv("LLM_SPECULATIVE_DECODING", "").strip()
+    if not setting:
+        return SpeculativeDecoding.NONE
+    if "=" not in setting:
+        return SpeculativeDecoding(setting)
+    for pair in setting.split(","):
+        name, _, value = pair.partition("=")
+        if name.strip() == model.value:
+            return SpeculativeDecoding(value.strip())
+    return SpeculativeDecoding.NONE
@@ -6,9 +6,20 @@ from typing import List, Dict
 from haystack import Pipeline
 from haystack.components.routers import ConditionalRouter
 
-from components.embeddings import Embeddings, EmbeddingModelName
-from components.models import get_model
+from components.decoding import (
+    DecodingMode,
+    SpeculativeDecoding,
+    decoding_kwargs,
+    resolve_decoding_mode,
+)
+from components.embeddings import Embeddings, EmbeddingModelName, RetrieverBackend
+from omop.vector_index import DistanceMetric, RetrievalMode
+from components.model_pool import PooledGenerator
+from components.llama_runtime import LlamaRuntimeOptions, resolve_runtime
+from components.models import get_model, resolve_speculative_decoding
 from components.prompt import Prompts
+from components.vocabulary_grammar import vocabulary_grammar
+from components.response_cache import CachedGenerator
 from options.pipeline_options import LLMModel
 
 
@@ -26,6 +37,16 @@ class LLMPipeline:
         standard_concept: bool = False,
         embedding_model: EmbeddingModelName = EmbeddingModelName.BGESMALL,
         top_k: int=5,
+        retriever_backend: RetrieverBackend | None = None,
+        ef_search: int | None = None,
+        probes: int | None = None,
+        distance_metric: DistanceMetric | None = None,
+        retrieval_mode: RetrievalMode | None = None,
+        decoding_mode: DecodingMode | None = None,
+        max_tokens: int | None = None,
+        grammar_concept_class: list[str] | None = None,
+        speculative_decoding: SpeculativeDecoding | None = None,
+        llm_runtime: LlamaRuntimeOptions | None = None,
     ) -> None:
         """
         Initializes the LLMPipeline class
@@ -52,6 +73,36 @@ class LLMPipeline:
 
         top_k: int
             The number of RAG results to return
+
+        retriever_backend: RetrieverBackend | None
+            Where vector search runs. If None, the RETRIEVER_BACKEND environment variable decides
+
+        ef_search: int | None
+            hnsw.ef_search for RAG vector search. If None, the server default is used
+
+        probes: int | None
+            ivfflat.probes for RAG vector search. If None, the server default is used
+
+        distance_metric: DistanceMetric | None
+            The metric RAG vector search ranks by. Scores stay on the cosine distance scale, so the routing threshold is unaffected
+
+        retrieval_mode: RetrievalMode | None
+            Whether RAG vector search uses the full vectors, or a quantized index followed by an exact rerank
+
+        decoding_mode: DecodingMode | None
+            Whether replies are free text or constrained to a single-line drug name. If None, the LLM_DECODING_MODE environment variable decides
+
+        max_tokens: int | None
+            The most tokens the LLM generates per reply. If None, the decoding mode's default is used, except that free decoding sends OpenAI models no limit
+
+        grammar_concept_class: list[str] | None
+            In vocabulary decoding, replies are limited to names of concepts in embed_vocab. If supplied, only concepts of these classes, e.g. Ingredient, are allowed
+
+        speculative_decoding: SpeculativeDecoding | None
+            How a local LLM drafts tokens to verify in one batch. If None, the LLM_SPECULATIVE_DECODING environment variable decides
+
+        llm_runtime: LlamaRuntimeOptions | None
+            llama.cpp settings for a local LLM, applied over the tuned profile and LLAMA_* environment variables
         """
         self._model = llm_model
         self._logger = logger
@@ -60,6 +111,16 @@ class LLMPipeline:
         self._standard_concept = standard_concept
         self._embedding_model = embedding_model
         self._top_k=top_k
+        self._retriever_backend = retriever_backend
+        self._ef_search = ef_search
+        self._probes = probes
+        self._distance_metric = distance_metric
+        self._retrieval_mode = retrieval_mode
+        self._decoding_mode = resolve_decoding_mode(decoding_mode)
+        self._max_tokens = max_tokens
+        self._grammar_concept_class = grammar_concept_class
+        self._speculative_decoding = resolve_speculative_decoding(speculative_decoding, llm_model)
+        self._llm_runtime = llm_runtime
 
     @property
     def llm_model(self): 
@@ -69,13 +130,60 @@ class LLMPipeline:
     def llm_model(self, value): 
         self._model = value 
 
-    @property
-    def llm_model(self): 
-        return self._model 
+    def _get_llm(self, prompt_type: str = "simple"):
+        """
+        Get the generator for the pipeline
 
-    @llm_model.setter
-    def llm_model(self, value): 
-        self._model = value 
+        OpenAI models are reached over the network. Local models come from the process-wide model pool, so their weights are only loaded once per process.
+        Local models also reuse the evaluated few-shot prefix of the pipeline's prompt, so only the part that changes per query is evaluated.
+        Either way, deterministic replies are cached, so a prompt already answered by the same model and template isn't generated again.
+        """
+        path_to_local_model_weights = os.getenv("LOCAL_LLM")
+        prompts = Prompts(model=self._model, prompt_type=prompt_type)
+        remote = "gpt" in self._model.value.lower() and not path_to_local_model_weights
+        max_tokens = self._max_tokens
+        if remote:
+            generator = get_model(
+                model=self._model,
+                temperature=self._temperature,
+                logger=self._logger,
+            )
+        else:
+            runtime = resolve_runtime(self._llm_runtime)
+            generator = PooledGenerator(
+                model=self._model,
+                temperature=self._temperature,
+                weights_path=path_to_local_model_weights,
+                speculative_decoding=self._speculative_decoding,
+                prefix=prompts.get_static_prefix(),
+                runtime=runtime,
+            )
+            if max_tokens is None and self._decoding_mode == DecodingMode.FREE:
+                max_tokens = runtime.max_tokens
+        vocabulary_gbnf = None
+        if self._decoding_mode == DecodingMode.VOCABULARY and not remote:
+            vocabulary_gbnf = vocabulary_grammar(
+                self._embed_vocab,
+                concept_class_ids=self._grammar_concept_class,
+                standard_concept=self._standard_concept,
+            )
+        generation_kwargs = decoding_kwargs(
+            self._decoding_mode,
+            max_tokens=max_tokens,
+            eot_token=self._model.get_eot_token(),
+            grammar=not remote,
+            vocabulary_gbnf=vocabulary_gbnf,
+        )
+        if remote and self._decoding_mode == DecodingMode.FREE and max_tokens is None:
+            # OpenAI replies had no token limit before decoding modes, so free decoding keeps it that way
+            del generation_kwargs["max_tokens"]
+        return CachedGenerator(
+            generator,
+            model=f"{self._model.value}:{path_to_local_model_weights or ''}",
+            template_version=prompts.get_template_version(),
+            temperature=self._temperature,
+            generation_kwargs=generation_kwargs,
+        )
 
     def get_simple_assistant(self) -> Pipeline:
         """
@@ -98,13 +206,7 @@ class LLMPipeline:
         self._logger.info(f"Prompt added to pipeline in {time.time()-start} seconds")
         start = time.time()
 
-        path_to_local_model_weights = os.getenv("LOCAL_LLM")
-        llm = get_model(
-            model=self._model,
-            temperature=self._temperature,
-            logger=self._logger,
-            path_to_local_weights=path_to_local_model_weights
-        )
+        llm = self._get_llm()
         pipeline.add_component("llm", llm)
         self._logger.info(f"LLM added to pipeline in {time.time()-start} seconds")
         start = time.time()
@@ -133,6 +235,11 @@ class LLMPipeline:
             standard_concept=self._standard_concept,
             model_name=self._embedding_model,
             top_k=self._top_k,
+            retriever_backend=self._retriever_backend,
+            ef_search=self._ef_search,
+            probes=self._probes,
+            distance_metric=self._distance_metric,
+            retrieval_mode=self._retrieval_mode,
         )
 
         vec_embedder = vec_search.get_embedder()
@@ -154,13 +261,7 @@ class LLMPipeline:
             ]
         )
 
-        path_to_local_model_weights = os.getenv("LOCAL_LLM")
-        llm = get_model(
-            model=self._model,
-            temperature=self._temperature,
-            logger=self._logger,
-            path_to_local_weights=path_to_local_model_weights
-        )
+        llm = self._get_llm(prompt_type="top_n_RAG")
 
         pipeline.add_component("query_embedder", vec_embedder)
         pipeline.add_component("retriever", vec_retriever)
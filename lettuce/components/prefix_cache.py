@@ -0,0 +1,151 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from typing import Dict
+
+from llama_cpp import Llama, LlamaState
+
+from components.llama_runtime import LlamaRuntime
+from utils.logging_utils import logger
+
+
+class PrefixStateCache:
+    """
+    A cache of llama.cpp states with a prompt prefix already evaluated
+
+    Every prompt of a type starts with the same instructions and few-shot examples, so their tokens only need evaluating once per model.
+    Before a completion, the model is given the saved state for its prompt's prefix unless it already holds those tokens.
+    States are keyed by the runtime settings as well as the model, as a state can only be loaded into a context with the same KV cache layout.
+    llama.cpp then finds the tokens it has in common with the new prompt and only evaluates the rest.
+    States can also be written to a directory, so a restarted process loads them instead of evaluating the prefix again.
+
+    Parameters
+    ----------
+    directory: str | None
+        A directory the states are saved to and loaded from. If None, states are kept in memory only
+    """
+
+    def __init__(self, directory: str | None = None) -> None:
+        self._directory = directory
+        self._states: Dict[str, LlamaState] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens_saved = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(llama: Llama, prefix: str, runtime: LlamaRuntime | None = None) -> str:
+        raw = "\x1f".join(
+            [
+                str(llama.model_path),
+                str(llama.n_ctx()),
+                runtime.load_settings().model_dump_json() if runtime is not None else "",
+                prefix,
+            ]
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.state")
+
+    def _load_from_disk(self, key: str) -> LlamaState | None:
+        if not self._directory or not os.path.isfile(self._path(key)):
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable prefix state {self._path(key)}: {e}")
+            return None
+
+    def _save_to_disk(self, key: str, state: LlamaState) -> None:
+        if not self._directory:
+            return
+        # Write then rename, so other processes never read a partial file
+        with tempfile.NamedTemporaryFile(dir=self._directory, delete=False) as f:
+            pickle.dump(state, f)
+        os.replace(f.name, self._path(key))
+
+    def state(self, llama: Llama, prefix: str, runtime: LlamaRuntime | None = None) -> LlamaState:
+        """
+        Get the state with a prefix evaluated, evaluating it if neither memory nor disk holds it
+
+        The caller must have exclusive use of llama.
+        """
+        key = self.key(llama, prefix, runtime)
+        with self._lock:
+            state = self._states.get(key)
+        if state is not None:
+            return state
+        state = self._load_from_disk(key)
+        if state is None:
+            tokens = llama.tokenize(prefix.encode("utf-8"), special=True)
+            llama.reset()
+            llama.eval(tokens)
+            state = llama.save_state()
+            self._save_to_disk(key, state)
+        with self._lock:
+            self._states[key] = state
+        return state
+
+    def prepare(
+        self, llama: Llama, prefix: str, prompt: str, runtime: LlamaRuntime | None = None
+    ) -> int:
+        """
+        Make sure llama holds the evaluated prefix of a prompt before it is completed
+
+        The caller must have exclusive use of llama until the completion finishes.
+
+        Parameters
+        ----------
+        llama: Llama
+            The model the prompt will be completed with
+        prefix: str
+            The fixed start of the prompt
+        prompt: str
+            The full prompt
+        runtime: LlamaRuntime | None
+            The settings llama was loaded with. States saved under other settings, e.g. another KV cache type, are never loaded
+
+        Returns
+        -------
+        int
+            The number of prompt tokens llama.cpp will not need to evaluate
+        """
+        state = self.state(llama, prefix, runtime)
+        prompt_tokens = llama.tokenize(prompt.encode("utf-8"), special=True)
+        # llama.cpp always re-evaluates the last prompt token to get its logits
+        reusable = Llama.longest_token_prefix(llama._input_ids, prompt_tokens[:-1])
+        cached = Llama.longest_token_prefix(
+            state.input_ids[: state.n_tokens].tolist(), prompt_tokens[:-1]
+        )
+        if cached > reusable:
+            llama.load_state(state)
+            reusable = cached
+        with self._lock:
+            self.requests += 1
+            self.tokens_saved += reusable
+        return reusable
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report how many prefixes are cached and how many prompt tokens they have saved
+        """
+        with self._lock:
+            return {
+                "prefixes": len(self._states),
+                "requests": self.requests,
+                "tokens_saved": self.tokens_saved,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._states.clear()
+            self.requests = 0
+            self.tokens_saved = 0
+
+
+prefix_state_cache = PrefixStateCache(directory=os.getenv("LLM_PREFIX_CACHE_DIR") or None)
@@ -1,3 +1,5 @@
+import hashlib
+
 from haystack.components.builders import PromptBuilder
 from options.pipeline_options import LLMModel
 
@@ -88,3 +90,30 @@ Informal name: {{informal_name}}""",
             return PromptBuilder(template)
         except KeyError:
             print(f"No prompt named {self._prompt_type}")
+
+    def get_template_version(self) -> str:
+        """
+        Get an identifier that changes whenever the template for this prompt type and model changes
+
+        Returns
+        -------
+        str
+            A short hash of the template, including the end of turn token
+        """
+        template = self._prompt_templates[self._prompt_type] + self._eot_token
+        return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+    def get_static_prefix(self) -> str:
+        """
+        Get the start of the prompt that is the same for every query: the instructions and few-shot examples
+
+        Returns
+        -------
+        str
+            The template up to the last line break before its first variable or tag
+        """
+        template = self._prompt_templates[self._prompt_type]
+        starts = [i for i in (template.find("{{"), template.find("{%")) if i != -1]
+        if not starts:
+            return template
+        return template[: template.rfind("\n", 0, min(starts)) + 1]
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from haystack import component
+
+from utils.cache import TieredCache
+
+# Meta describing how a reply was generated that time, e.g. alongside which other prompts, so not stored with it
+UNCACHED_META = {"prompt_tokens_reused", "batch_size"}
+
+
+def grammar_digest(grammar: Any) -> str:
+    """
+    A short stand-in for a grammar in cache keys. Vocabulary grammars run to megabytes, so hashing one per request is too slow
+    """
+    return "sha256:" + hashlib.sha256(str(grammar).encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    A cache of LLM replies keyed by model, prompt template version and rendered prompt
+
+    Greedy decoding always gives the same reply to the same prompt, so replies are kept in a TieredCache: an in-memory LRU, optionally backed by SQLite so they survive restarts.
+    The generation settings are part of the key too, so changing e.g. max_tokens never returns a reply generated under the old settings.
+    Replies are stored without the meta in UNCACHED_META, which only described the request that generated them.
+
+    Parameters
+    ----------
+    max_entries: int
+        The number of replies held in memory
+    path: str | None
+        Path of a SQLite database for the persistent tier. If None, the cache is memory-only
+    """
+
+    def __init__(self, max_entries: int = 10000, path: str | None = None) -> None:
+        self._cache = TieredCache(max_entries=max_entries, path=path, table="llm_responses")
+        self._lock = threading.Lock()
+        self.bypassed = 0
+
+    @staticmethod
+    def key(
+        model: str,
+        template_version: str,
+        prompt: str,
+        generation_kwargs: Dict[str, Any] | None = None,
+    ) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        settings = json.dumps(generation_kwargs or {}, sort_keys=True, default=str)
+        raw = "\x1f".join([model, template_version, prompt_hash, settings])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Dict[str, List] | None:
+        value = self._cache.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def put(self, key: str, result: Dict[str, List]) -> None:
+        meta = [
+            {field: value for field, value in item.items() if field not in UNCACHED_META}
+            for item in result.get("meta", [])
+        ]
+        value = {"replies": result["replies"], "meta": meta}
+        self._cache.put(key, json.dumps(value, default=str).encode("utf-8"))
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self) -> None:
+        self._cache.clear()
+        with self._lock:
+            self.bypassed = 0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Report hit and miss counts for the cache, and how many sampled requests skipped it
+        """
+        with self._lock:
+            bypassed = self.bypassed
+        return {**self._cache.stats(), "bypassed": bypassed}
+
+
+llm_response_cache = LLMResponseCache(
+    max_entries=int(os.getenv("LLM_RESPONSE_CACHE_SIZE", "10000")),
+    path=os.getenv("LLM_RESPONSE_CACHE_PATH") or None,
+)
+
+
+@component
+class CachedGenerator:
+    """
+    A haystack component that answers prompts from an LLMResponseCache before falling back to a generator
+
+    Only deterministic requests are cached. If the temperature, including one sent in generation_kwargs, is above zero, the generator is always called.
+    Replies served from the cache have cache_hit set in their meta.
+    A grammar in the generation settings is keyed by its digest, worked out once here for the grammar the generator is built with.
+
+    Parameters
+    ----------
+    generator
+        The generator component to call on a miss. It must take prompt and generation_kwargs and return replies and meta
+    model: str
+        Identifies the model and weights, so replies from different models are never mixed
+    template_version: str
+        Identifies the prompt template the prompts were rendered from
+    temperature: float
+        The temperature the generator was configured with
+    cache: LLMResponseCache | None
+        The cache to use. Defaults to the process-wide LLM response cache
+    generation_kwargs: Dict[str, Any] | None
+        Sent to the generator with every prompt. Any given at run time take precedence
+    """
+
+    def __init__(
+        self,
+        generator,
+        model: str,
+        template_version: str,
+        temperature: float,
+        cache: LLMResponseCache | None = None,
+        generation_kwargs: Dict[str, Any] | None = None,
+    ) -> None:
+        self._generator = generator
+        self._model = model
+        self._template_version = template_version
+        self._temperature = temperature
+        self._cache = cache if cache is not None else llm_response_cache
+        self._generation_kwargs = generation_kwargs or {}
+        grammar = self._generation_kwargs.get("grammar")
+        self._grammar_digest = grammar_digest(grammar) if grammar is not None else None
+
+    def _key_settings(self, generation_kwargs: Dict[str, Any] | None) -> Dict[str, Any] | None:
+        grammar = (generation_kwargs or {}).get("grammar")
+        if grammar is None:
+            return generation_kwargs
+        if grammar is self._generation_kwargs.get("grammar"):
+            digest = self._grammar_digest
+        else:
+            digest = grammar_digest(grammar)
+        return {**generation_kwargs, "grammar": digest}
+
+    def warm_up(self) -> None:
+        if hasattr(self._generator, "warm_up"):
+            self._generator.warm_up()
+
+    @component.output_types(replies=List[str], meta=List[Dict[str, Any]])
+    def run(self, prompt: str, generation_kwargs: Optional[Dict[str, Any]] = None):
+        generation_kwargs = {**self._generation_kwargs, **(generation_kwargs or {})} or None
+        temperature = (generation_kwargs or {}).get("temperature", self._temperature)
+        if temperature > 0:
+            self._cache.record_bypass()
+            return self._generator.run(prompt, generation_kwargs=generation_kwargs)
+
+        key = self._cache.key(
+            self._model, self._template_version, prompt, self._key_settings(generation_kwargs)
+        )
+        cached = self._cache.get(key)
+        if cached is not None:
+            for meta in cached["meta"]:
+                meta["cache_hit"] = True
+            return cached
+        result = self._generator.run(prompt, generation_kwargs=generation_kwargs)
+        self._cache.put(key, result)
+        for meta in result["meta"]:
+            meta["cache_hit"] = False
+        return result
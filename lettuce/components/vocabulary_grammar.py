@@ -0,0 +1,141 @@
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+from omop.db_manager import get_session
+from omop.omop_queries import query_concept_names
+from utils.logging_utils import logger
+
+
+class _TrieNode:
+    __slots__ = ("children", "terminal")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.terminal = False
+
+
+def _build_trie(names: Iterable[str]) -> _TrieNode:
+    root = _TrieNode()
+    for name in names:
+        node = root
+        for char in name:
+            node = node.children.setdefault(char, _TrieNode())
+        node.terminal = True
+    return root
+
+
+def _literal(text: str) -> str:
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def names_to_gbnf(names: Iterable[str]) -> str:
+    """
+    Compile a set of strings into a GBNF grammar that matches exactly those strings, followed by a newline
+
+    The strings are put into a character trie and runs of nodes with a single child are merged, so shared prefixes like "Amoxicillin" are written once.
+    Each branching node becomes a rule, which keeps llama.cpp's grammar sampler from tracking every name at once.
+    A leading space is allowed because replies follow "Response:".
+
+    Parameters
+    ----------
+    names: Iterable[str]
+        The strings replies are constrained to. Empty strings and strings containing line breaks are skipped
+
+    Returns
+    -------
+    str
+        A GBNF grammar with root as its start rule
+    """
+    root = _build_trie(
+        name for name in names if name and "\n" not in name and "\r" not in name
+    )
+    if not root.children:
+        raise ValueError("Cannot build a grammar from no names")
+    rules: List[str] = []
+
+    def rule_for(node: _TrieNode) -> str:
+        name = f"n{len(rules)}"
+        rules.append("")
+        alternatives = []
+        for char, child in sorted(node.children.items()):
+            text = char
+            # Merge single-child chains into one literal
+            while len(child.children) == 1 and not child.terminal:
+                (next_char, child), = child.children.items()
+                text += next_char
+            if not child.children:
+                alternatives.append(_literal(text))
+            elif child.terminal:
+                alternatives.append(f"{_literal(text)} {rule_for(child)}?")
+            else:
+                alternatives.append(f"{_literal(text)} {rule_for(child)}")
+        rules[int(name[1:])] = f"{name} ::= " + " | ".join(alternatives)
+        return name
+
+    start = rule_for(root)
+    return "\n".join([f'root ::= " "? {start} "\\n"', *rules]) + "\n"
+
+
+def _key(values: List[str] | None) -> Tuple[str, ...] | None:
+    return tuple(sorted(set(values))) if values else None
+
+
+@lru_cache(maxsize=8)
+def _cached_grammar(
+    vocabulary_ids: Tuple[str, ...],
+    concept_class_ids: Tuple[str, ...] | None,
+    standard_concept: bool,
+    valid_concept: bool,
+) -> str:
+    start = time.time()
+    with get_session() as session:
+        names = session.execute(
+            query_concept_names(
+                list(vocabulary_ids),
+                concept_class_ids=list(concept_class_ids) if concept_class_ids else None,
+                standard_concept=standard_concept,
+                valid_concept=valid_concept,
+            )
+        ).scalars().all()
+    grammar = names_to_gbnf(names)
+    logger.info(
+        f"Built a grammar of {len(names)} concept names from {', '.join(vocabulary_ids)} "
+        f"({len(grammar)} characters) in {time.time() - start} seconds"
+    )
+    return grammar
+
+
+def vocabulary_grammar(
+    vocabulary_ids: List[str],
+    concept_class_ids: List[str] | None = None,
+    standard_concept: bool = False,
+    valid_concept: bool = True,
+) -> str:
+    """
+    Get a GBNF grammar that only allows replies naming a concept in the selected vocabularies
+
+    Building the grammar reads every matching concept name, so grammars are cached per vocabulary set and filters for the life of the process.
+    The vocabulary and class lists are order-insensitive.
+
+    Parameters
+    ----------
+    vocabulary_ids: List[str]
+        The vocabularies replies must come from
+    concept_class_ids: List[str] | None
+        If supplied, replies must name a concept in one of these classes, e.g. Ingredient
+    standard_concept: bool
+        If true, replies must name a standard concept
+    valid_concept: bool
+        If true, replies must name a concept that has not been invalidated
+
+    Returns
+    -------
+    str
+        The GBNF grammar
+    """
+    if not vocabulary_ids:
+        raise ValueError("Vocabulary-constrained decoding needs at least one vocabulary")
+    return _cached_grammar(
+        _key(vocabulary_ids), _key(concept_class_ids), standard_concept, valid_concept
+    )
@@ -0,0 +1,137 @@
+import re
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+_PARENTHESES = re.compile(r"\(.*?\)")
+
+
+def clean_concept_name(concept_name: str) -> str:
+    """
+    Remove anything in parentheses from a concept name, then strip and lowercase it
+    """
+    return _PARENTHESES.sub("", concept_name).strip().lower()
+
+
+def similarity_scores(
+    names: Sequence[str | None],
+    search_term: str,
+    score_cutoff: float | None = None,
+    workers: int = 1,
+) -> np.ndarray:
+    """
+    Score every name against a search term as OMOPMatcher.calculate_similarity_score does
+
+    Each distinct name is cleaned and scored once, in a single rapidfuzz cdist call. None scores 0.
+
+    Parameters
+    ----------
+    names: Sequence[str | None]
+        The concept or synonym names to score
+    search_term: str
+        The term to compare them with
+    score_cutoff: float | None
+        Scores below this are returned as 0, which lets rapidfuzz give up on a name early
+    workers: int
+        The threads cdist uses. -1 uses every core
+
+    Returns
+    -------
+    np.ndarray
+        A float64 score from 0 to 100 per name
+    """
+    unique_names = list(dict.fromkeys(name for name in names if name is not None))
+    if not unique_names:
+        return np.zeros(len(names))
+    unique_scores = process.cdist(
+        [search_term.lower()],
+        [clean_concept_name(name) for name in unique_names],
+        scorer=fuzz.ratio,
+        score_cutoff=score_cutoff,
+        dtype=np.float64,
+        workers=workers,
+    )[0]
+    position = {name: i for i, name in enumerate(unique_names)}
+    return np.array(
+        [0.0 if name is None else unique_scores[position[name]] for name in names],
+        dtype=np.float64,
+    )
+
+
+def _first(values: List[Any]) -> Any:
+    return next((value for value in values if value is not None), None)
+
+
+def select_concepts(
+    rows: Sequence[Sequence[Any]],
+    search_term: str,
+    search_threshold: float,
+    workers: int = 1,
+) -> List[Dict[str, Any]]:
+    """
+    Keep the concepts whose name or a synonym scores above the threshold, and format them with their synonyms
+
+    Rows hold (concept_id, concept_name, vocabulary_id, concept_code, concept_synonym_name), one per synonym.
+    A first pass with score_cutoff set to the threshold finds the concepts to keep. Only their rows are then scored exactly, as every kept synonym reports its score.
+
+    Concepts are returned in order of concept_id, and each concept's synonyms in order of score, highest first.
+
+    Parameters
+    ----------
+    rows: Sequence[Sequence[Any]]
+        Candidate rows from the full-text search
+    search_term: str
+        The term the candidates are scored against
+    search_threshold: float
+        A concept is kept if its name or any synonym scores above this
+    workers: int
+        The threads rapidfuzz uses
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The concepts with CONCEPT_SYNONYM filled in and empty CONCEPT_ANCESTOR and CONCEPT_RELATIONSHIP lists
+    """
+    concept_ids, names, vocabulary_ids, codes, synonyms = (list(column) for column in zip(*rows))
+    cutoff = min(max(search_threshold, 0), 100)
+    above = (similarity_scores(names, search_term, cutoff, workers) > search_threshold) | (
+        similarity_scores(synonyms, search_term, cutoff, workers) > search_threshold
+    )
+    kept_ids = {concept_ids[i] for i in np.flatnonzero(above)}
+    kept = [i for i, concept_id in enumerate(concept_ids) if concept_id in kept_ids]
+    if not kept:
+        return []
+
+    name_scores = similarity_scores([names[i] for i in kept], search_term, workers=workers)
+    synonym_scores = similarity_scores([synonyms[i] for i in kept], search_term, workers=workers)
+    # lexsort is stable, so rows with equal scores keep the database's order
+    order = np.lexsort((-synonym_scores, -name_scores))
+
+    rows_by_concept: Dict[Any, List[int]] = {}
+    for j in order:
+        rows_by_concept.setdefault(concept_ids[kept[j]], []).append(j)
+
+    concepts = []
+    for concept_id in sorted(rows_by_concept):
+        group = rows_by_concept[concept_id]
+        concepts.append(
+            {
+                "concept_name": _first([names[kept[j]] for j in group]),
+                "concept_id": concept_id,
+                "vocabulary_id": _first([vocabulary_ids[kept[j]] for j in group]),
+                "concept_code": _first([codes[kept[j]] for j in group]),
+                "concept_name_similarity_score": float(name_scores[group[0]]),
+                "CONCEPT_SYNONYM": [
+                    {
+                        "concept_synonym_name": synonyms[kept[j]],
+                        "concept_synonym_name_similarity_score": float(synonym_scores[j]),
+                    }
+                    for j in group
+                    if synonyms[kept[j]] is not None
+                ],
+                "CONCEPT_ANCESTOR": [],
+                "CONCEPT_RELATIONSHIP": [],
+            }
+        )
+    return concepts
@@ -1,13 +1,22 @@
-import re
-from typing import List
+from typing import Any, Dict, List, Sequence, Tuple
 
-import pandas as pd
 from rapidfuzz import fuzz
-from omop.omop_queries import text_search_query, query_ancestors_and_descendants_by_id, query_related_by_id
+from omop.fuzzy_scoring import clean_concept_name, select_concepts
+from omop.omop_queries import (
+    CandidateSearch,
+    TextRankFunction,
+    query_ancestors_and_descendants_by_ids,
+    query_related_by_ids,
+    text_search_query,
+    text_search_query_batch,
+    trigram_search_query,
+    trigram_search_query_batch,
+)
 
 from logging import Logger
 from omop.db_manager import get_session 
 from omop.preprocess import preprocess_search_term
+from omop.trigram_index import apply_trigram_threshold, trigram_threshold
 
 
 class OMOPMatcher:
@@ -43,6 +52,28 @@ class OMOPMatcher:
         
     max_separation_ancestor: int
         The maximum separation between a base concept and its ancestors
+
+    batch_size: int
+        The number of search terms sent to the database in each full-text query by run
+
+    scoring_workers: int
+        The threads used to fuzzy match candidates. -1 uses every core
+
+    max_candidates: int | None
+        The most concepts the full-text search returns per term, ranked in the database. If None, every match is returned
+
+    rank_function: TextRankFunction
+        The function full-text matches are ranked by when max_candidates is set
+
+    match_all_words_first: bool
+        Whether to first search for concepts matching every word of a term, only falling back to any word when that finds fewer than min_candidates concepts
+
+    min_candidates: int
+        The number of concepts a search for every word must find for its results to be used. Capped at max_candidates
+
+    candidate_search: CandidateSearch
+        Whether candidates are found by full-text search, or by trigram similarity in the database, which also finds misspelt names.
+        Trigram search matches names at a similarity of half search_threshold, and returns the max_candidates most similar concepts
     """
 
     def __init__(
@@ -55,7 +86,14 @@ class OMOPMatcher:
         concept_synonym: bool = False,
         standard_concept: bool = False, 
         max_separation_descendant: int = 1,
-        max_separation_ancestor: int = 1
+        max_separation_ancestor: int = 1,
+        batch_size: int = 500,
+        scoring_workers: int = 1,
+        max_candidates: int | None = None,
+        rank_function: TextRankFunction = TextRankFunction.TS_RANK,
+        match_all_words_first: bool = False,
+        min_candidates: int = 10,
+        candidate_search: CandidateSearch = CandidateSearch.FULL_TEXT,
     ):
         self.logger = logger
         self.vocabulary_id = vocabulary_id 
@@ -66,6 +104,13 @@ class OMOPMatcher:
         self.standard_concept = standard_concept 
         self.max_separation_descendant = max_separation_descendant
         self.max_separation_ancestor = max_separation_ancestor 
+        self.batch_size = batch_size
+        self.scoring_workers = scoring_workers
+        self.max_candidates = max_candidates
+        self.rank_function = rank_function
+        self.match_all_words_first = match_all_words_first
+        self.min_candidates = min_candidates
+        self.candidate_search = candidate_search
 
     @staticmethod 
     def calculate_similarity_score(concept_name, search_term):
@@ -91,9 +136,7 @@ class OMOPMatcher:
         """
         if concept_name is None:
             return 0  # Return a default score (e.g., 0) for null values
-        cleaned_concept_name = re.sub(r"\(.*?\)", "", concept_name).strip()
-        score = fuzz.ratio(search_term.lower(), cleaned_concept_name.lower())
-        return score
+        return fuzz.ratio(search_term.lower(), clean_concept_name(concept_name))
             
     def fetch_omop_concepts(self, search_term: str) -> list | None:
         """
@@ -106,6 +149,9 @@ class OMOPMatcher:
 
         If the concept_ancestor and concept_relationship arguments are 'y', the relevant methods are called on these concepts and the result added to the output.
 
+        If match_all_words_first is set, concepts matching every word are searched for first, and concepts matching any word only if too few are found.
+        If candidate_search is trigram, concepts are instead found by trigram similarity to the search term.
+
         Parameters
         ----------
         search_term: str
@@ -116,96 +162,188 @@ class OMOPMatcher:
         list | None
             A list of search results from the OMOP database if the query comes back with results, otherwise returns None. 
         """
-        query = text_search_query(
-            preprocess_search_term(search_term), self.vocabulary_id, self.standard_concept, self.concept_synonym
-        )
-        
         with get_session() as session:
-           results = session.execute(query).fetchall() 
-           results = pd.DataFrame(results)
-    
-        if results.empty:  
-            return None 
- 
-        # Apply the score function to 'concept_name' and 'concept_synonym_name' columns
-        results = self._apply_concept_similarity_score_to_columns(
-            results, 
-            search_term, 
-            source_cols=["concept_name", "concept_synonym_name"],
-            target_cols=["concept_name_similarity_score", "concept_synonym_name_similarity_score"]
-        )
+            if self.candidate_search == CandidateSearch.TRIGRAM:
+                apply_trigram_threshold(session, trigram_threshold(self.search_threshold))
+                query = trigram_search_query(
+                    search_term,
+                    self.vocabulary_id,
+                    self.standard_concept,
+                    self.concept_synonym,
+                    max_candidates=self.max_candidates,
+                )
+                results = session.execute(query).fetchall()
+            else:
+                for ts_query in self._ts_queries(search_term):
+                    query = text_search_query(
+                        ts_query,
+                        self.vocabulary_id,
+                        self.standard_concept,
+                        self.concept_synonym,
+                        max_candidates=self.max_candidates,
+                        rank_function=self.rank_function,
+                    )
+                    results = session.execute(query).fetchall()
+                    if self._enough_candidates(results):
+                        break
+
+        concepts = self._select_concepts(results, search_term)
+        self._add_related_concepts([concepts])
+        return concepts
+
+    def fetch_omop_concepts_batch(self, search_terms: List[str]) -> List[list | None]:
+        """
+        Fetch OMOP concepts for several search terms, with one full-text query per batch_size terms
 
-        # Filter the original DataFrame to include all rows with these concept_ids
-        # Sort the filtered results by the highest score (descending order)
-        results = self._filter_and_sort_by_concept_ids_above_similarity_score_threshold(
-            results, 
-            score_cols = ["concept_name_similarity_score", "concept_synonym_name_similarity_score"]  
-        )
+        The preprocessed terms are sent as an array, and the rows that come back are split by the ordinal of their term.
+        Terms that preprocess to the same query are only sent once.
+        Each term's rows are then scored and filtered exactly as fetch_omop_concepts does.
+        Ancestors, descendants and relationships are then fetched for the concepts of every term together.
 
-        return self._format_concept_results(results)
-    
-    def _apply_concept_similarity_score_to_columns(
-            self, 
-            results:  pd.DataFrame, 
-            search_term: str, 
-            source_cols: List[str], 
-            target_cols: List[str]
-    ): 
-        for col_src, col_target in zip(source_cols, target_cols): 
-            results[col_target] = results[col_src].apply(
-                lambda row: OMOPMatcher.calculate_similarity_score(row, search_term)
-            ) 
-        return results 
-    
-    def _filter_and_sort_by_concept_ids_above_similarity_score_threshold(
-        self, 
-        results: pd.DataFrame,
-        score_cols: List[str],
-        id_col: str = "concept_id" 
-    ):
-        concept_ids_above_threshold = set(
-            results.loc[(results[score_cols] > self.search_threshold).any(axis=1), id_col]
-        )
-        results = results[results[id_col].isin(concept_ids_above_threshold)]
-        results = results.sort_values(
-            by=score_cols,
-            ascending=False,
-        )
-        return results 
+        Parameters
+        ----------
+        search_terms: List[str]
+            Search terms for concepts
 
-    def _format_concept_results(self, results: pd.DataFrame): 
-        grouped_results = (
-            results.groupby("concept_id")
-            .agg(
-                {
-                    "concept_name": "first",
-                    "vocabulary_id": "first",
-                    "concept_code": "first",
-                    "concept_name_similarity_score": "first",
-                    "concept_synonym_name": list,
-                    "concept_synonym_name_similarity_score": list,
-                }
+        Returns
+        -------
+        List[list | None]
+            For each search term, what fetch_omop_concepts would return for it
+        """
+        return self._concepts_for_candidates(search_terms, self.fetch_candidates(search_terms))
+
+    def fetch_candidates(self, search_terms: List[str]) -> List[Tuple[str, list]]:
+        """
+        Run the full-text search for several search terms, with one query per batch_size distinct terms
+
+        If match_all_words_first is set, every term is first searched for with its words joined by '&'.
+        Only the terms that find fewer than min_candidates concepts are then searched for again with '|'.
+
+        If candidate_search is trigram, the terms are instead matched by trigram similarity, and the query reported for each is the term itself.
+
+        Parameters
+        ----------
+        search_terms: List[str]
+            Search terms for concepts
+
+        Returns
+        -------
+        List[Tuple[str, list]]
+            For each search term, the tsquery whose results were used and the candidate rows it found
+        """
+        if self.candidate_search == CandidateSearch.TRIGRAM:
+            with get_session() as session:
+                rows = self._trigram_search(session, search_terms)
+            return [(search_term, rows[search_term]) for search_term in search_terms]
+
+        any_word_queries = [preprocess_search_term(search_term) for search_term in search_terms]
+
+        with get_session() as session:
+            if not self.match_all_words_first:
+                rows = self._text_search(session, any_word_queries)
+                return [(query, rows[query]) for query in any_word_queries]
+
+            all_word_queries = [
+                preprocess_search_term(search_term, operator="&") for search_term in search_terms
+            ]
+            rows = self._text_search(session, all_word_queries)
+            queries = [
+                all_words if self._enough_candidates(rows[all_words]) else any_word
+                for all_words, any_word in zip(all_word_queries, any_word_queries)
+            ]
+            # Single-word terms have the same query either way, so are never searched for twice
+            rows.update(self._text_search(session, [query for query in queries if query not in rows]))
+
+        return [(query, rows[query]) for query in queries]
+
+    def _text_search(self, session, ts_queries: List[str]) -> Dict[str, list]:
+        unique_queries = list(dict.fromkeys(ts_queries))
+        rows_by_query = {query: [] for query in unique_queries}
+        for start in range(0, len(unique_queries), self.batch_size):
+            chunk = unique_queries[start : start + self.batch_size]
+            query = text_search_query_batch(
+                chunk,
+                self.vocabulary_id,
+                self.standard_concept,
+                self.concept_synonym,
+                max_candidates=self.max_candidates,
+                rank_function=self.rank_function,
             )
-            .reset_index()
+            for row in session.execute(query).fetchall():
+                rows_by_query[chunk[row.ordinal - 1]].append(row[1:])
+        return rows_by_query
+
+    def _trigram_search(self, session, search_terms: List[str]) -> Dict[str, list]:
+        apply_trigram_threshold(session, trigram_threshold(self.search_threshold))
+        unique_terms = list(dict.fromkeys(search_terms))
+        rows_by_term = {term: [] for term in unique_terms}
+        for start in range(0, len(unique_terms), self.batch_size):
+            chunk = unique_terms[start : start + self.batch_size]
+            query = trigram_search_query_batch(
+                chunk,
+                self.vocabulary_id,
+                self.standard_concept,
+                self.concept_synonym,
+                max_candidates=self.max_candidates,
+            )
+            for row in session.execute(query).fetchall():
+                rows_by_term[chunk[row.ordinal - 1]].append(row[1:])
+        return rows_by_term
+
+    def _ts_queries(self, search_term: str) -> List[str]:
+        """
+        The tsqueries to try for a search term, in order
+        """
+        queries = [preprocess_search_term(search_term)]
+        if self.match_all_words_first:
+            queries.insert(0, preprocess_search_term(search_term, operator="&"))
+        return list(dict.fromkeys(queries))
+
+    @staticmethod
+    def _candidate_count(rows: Sequence[Sequence[Any]]) -> int:
+        return len({row[0] for row in rows})
+
+    def _enough_candidates(self, rows: Sequence[Sequence[Any]]) -> bool:
+        min_candidates = self.min_candidates
+        if self.max_candidates is not None:
+            min_candidates = min(min_candidates, self.max_candidates)
+        return self._candidate_count(rows) >= min_candidates
+
+    def _concepts_for_candidates(
+        self, search_terms: List[str], candidates: List[Tuple[str, list]]
+    ) -> List[list | None]:
+        concepts = [
+            self._select_concepts(rows, search_term)
+            for search_term, (_, rows) in zip(search_terms, candidates)
+        ]
+        self._add_related_concepts(concepts)
+        return concepts
+
+    def _select_concepts(self, results: Sequence[Sequence[Any]], search_term: str) -> list | None:
+        if not results:
+            return None
+        return select_concepts(
+            results, search_term, self.search_threshold, workers=self.scoring_workers
         )
 
-        formatted_results = []
-        for _, row in grouped_results.iterrows():
-            result = self._format_base_concept(row)
-            result["CONCEPT_SYNONYM"] = self._format_concept_synonyms(row)
-            result["CONCEPT_ANCESTOR"] = []  
-            result["CONCEPT_RELATIONSHIP"] = []  
-            formatted_results.append(result)
+    def _add_related_concepts(self, concept_lists: List[list | None]) -> None:
+        """
+        Fill in CONCEPT_ANCESTOR and CONCEPT_RELATIONSHIP, if requested, for the concepts of every list, with one query per batch_size concepts
+        """
+        concepts = [concept for concept_list in concept_lists if concept_list for concept in concept_list]
+        concept_ids = list(dict.fromkeys(int(concept["concept_id"]) for concept in concepts))
+        if not concept_ids:
+            return
 
         if self.concept_ancestor:
-            for i, (_, row) in enumerate(grouped_results.iterrows()):
-                formatted_results[i]["CONCEPT_ANCESTOR"] = self.fetch_concept_ancestors_and_descendants(row["concept_id"])
-        
+            hierarchy = self.fetch_concept_ancestors_and_descendants_batch(concept_ids)
+            for concept in concepts:
+                concept["CONCEPT_ANCESTOR"] = hierarchy.get(int(concept["concept_id"]), [])
+
         if self.concept_relationship:
-            for i, (_, row) in enumerate(grouped_results.iterrows()):
-                formatted_results[i]["CONCEPT_RELATIONSHIP"] = self.fetch_concept_relationships(row["concept_id"])
-                
-        return formatted_results
+            relationships = self.fetch_concept_relationships_batch(concept_ids)
+            for concept in concepts:
+                concept["CONCEPT_RELATIONSHIP"] = relationships.get(int(concept["concept_id"]), [])
     
     def _format_base_concept(self, row):
         """Format the base concept information from a row."""
@@ -248,40 +386,52 @@ class OMOPMatcher:
         list
             A list of retrieved concepts and their relationships to the provided concept_id
         """
-        min_separation_ancestor = 1
-        min_separation_descendant = 1
-
-        query = query_ancestors_and_descendants_by_id(
-            concept_id, 
-            min_separation_ancestor=min_separation_ancestor, 
-            max_separation_ancestor=self.max_separation_ancestor,   
-            min_separation_descendant=min_separation_descendant, 
-            max_separation_descendant=self.max_separation_descendant
-        )
-        
-        with get_session() as session: 
-            results = session.execute(query).fetchall()
-            columns = ['relationship_type', 'concept_id', 'ancestor_concept_id', 
-                       'descendant_concept_id', 'concept_name', 'vocabulary_id', 
-                       'concept_code', 'min_levels_of_separation', 'max_levels_of_separation']
-            results = pd.DataFrame(results, columns=columns)
+        return self.fetch_concept_ancestors_and_descendants_batch([concept_id])[int(concept_id)]
 
-        return [
-            {
-                "concept_name": row["concept_name"],
-                "concept_id": row["concept_id"],
-                "vocabulary_id": row["vocabulary_id"],
-                "concept_code": row["concept_code"],
-                "relationship": {
-                    "relationship_type": row["relationship_type"],
-                    "ancestor_concept_id": row["ancestor_concept_id"],
-                    "descendant_concept_id": row["descendant_concept_id"],
-                    "min_levels_of_separation": row["min_levels_of_separation"],
-                    "max_levels_of_separation": row["max_levels_of_separation"],
-                },
-            }
-            for _, row in results.iterrows()
-        ]
+    def fetch_concept_ancestors_and_descendants_batch(self, concept_ids: List[int]) -> Dict[int, list]:
+        """
+        Fetch concept ancestors and descendants for several concept_ids, with one query per batch_size ids in a single session
+
+        Parameters
+        ----------
+        concept_ids: List[int]
+            The concept_ids used to find ancestors and descendants.
+
+        Returns
+        -------
+        Dict[int, list]
+            For each concept_id, what fetch_concept_ancestors_and_descendants would return for it
+        """
+        concept_ids = [int(concept_id) for concept_id in concept_ids]
+        hierarchy = {concept_id: [] for concept_id in concept_ids}
+
+        with get_session() as session: 
+            for start in range(0, len(concept_ids), self.batch_size):
+                query = query_ancestors_and_descendants_by_ids(
+                    concept_ids[start : start + self.batch_size], 
+                    min_separation_ancestor=1, 
+                    max_separation_ancestor=self.max_separation_ancestor,   
+                    min_separation_descendant=1, 
+                    max_separation_descendant=self.max_separation_descendant
+                )
+                for row in session.execute(query).fetchall():
+                    hierarchy[row.source_concept_id].append(
+                        {
+                            "concept_name": row.concept_name,
+                            "concept_id": row.concept_id,
+                            "vocabulary_id": row.vocabulary_id,
+                            "concept_code": row.concept_code,
+                            "relationship": {
+                                "relationship_type": row.relationship_type,
+                                "ancestor_concept_id": row.ancestor_concept_id,
+                                "descendant_concept_id": row.descendant_concept_id,
+                                "min_levels_of_separation": row.min_levels_of_separation,
+                                "max_levels_of_separation": row.max_levels_of_separation,
+                            },
+                        }
+                    )
+
+        return hierarchy
 
     def fetch_concept_relationships(self, concept_id):
         """
@@ -300,29 +450,44 @@ class OMOPMatcher:
         list
             A list of related concepts from the OMOP database
         """
-        with get_session() as session: 
-            query = query_related_by_id(concept_id)
-            results = session.execute(query).fetchall()
-            columns = [
-                'concept_id', 'concept_id_1', 'relationship_id', 'concept_id_2',
-                'concept_name', 'vocabulary_id', 'concept_code'
-            ]
-            results = pd.DataFrame(results, columns=columns)
+        return self.fetch_concept_relationships_batch([concept_id])[int(concept_id)]
 
-        return [
-            {
-                "concept_name": row["concept_name"],
-                "concept_id": row["concept_id"],
-                "vocabulary_id": row["vocabulary_id"],
-                "concept_code": row["concept_code"],
-                "relationship": {
-                    "concept_id_1": row["concept_id_1"],
-                    "relationship_id": row["relationship_id"],
-                    "concept_id_2": row["concept_id_2"],
-                },
-            }
-            for _, row in results.iterrows()
-        ]
+    def fetch_concept_relationships_batch(self, concept_ids: List[int]) -> Dict[int, list]:
+        """
+        Fetch concept relationships for several concept_ids, with one query per batch_size ids in a single session
+
+        Parameters
+        ----------
+        concept_ids: List[int]
+            The ids of the concepts to find relationships for
+
+        Returns
+        -------
+        Dict[int, list]
+            For each concept_id, what fetch_concept_relationships would return for it
+        """
+        concept_ids = [int(concept_id) for concept_id in concept_ids]
+        relationships = {concept_id: [] for concept_id in concept_ids}
+
+        with get_session() as session: 
+            for start in range(0, len(concept_ids), self.batch_size):
+                query = query_related_by_ids(concept_ids[start : start + self.batch_size])
+                for row in session.execute(query).fetchall():
+                    relationships[row.concept_id_1].append(
+                        {
+                            "concept_name": row.concept_name,
+                            "concept_id": row.concept_id,
+                            "vocabulary_id": row.vocabulary_id,
+                            "concept_code": row.concept_code,
+                            "relationship": {
+                                "concept_id_1": row.concept_id_1,
+                                "relationship_id": row.relationship_id,
+                                "concept_id_2": row.concept_id_2,
+                            },
+                        }
+                    )
+
+        return relationships
 
     def run(self, search_terms: List[str]):
         """
@@ -330,7 +495,8 @@ class OMOPMatcher:
         
         Runs queries against the OMOP database for the user defined
         search terms and then performs fuzzy pattern matching on each one before selecting the best 
-        OMOP concept matches for each search term. Calls fetch_OMOP_concepts on every item in search_terms.
+        OMOP concept matches for each search term. The full-text search for every term runs in one query per batch_size terms, through fetch_candidates.
+        Each result reports the tsquery, or for trigram search the term, used and the number of candidate concepts it found under CANDIDATES.
 
         Parameters
         ----------
@@ -348,14 +514,26 @@ class OMOPMatcher:
                 raise ValueError("No valid search_term values provided")
 
             self.logger.info(f"Calculating best OMOP matches for {search_terms}")
-            overall_results = []
-
-            for search_term in search_terms:
-                OMOP_concepts = self.fetch_omop_concepts(search_term)
-
-                overall_results.append(
-                    {"search_term": search_term, "CONCEPT": OMOP_concepts}
+            candidates = self.fetch_candidates(search_terms)
+            overall_results = [
+                {
+                    "search_term": search_term,
+                    "CONCEPT": OMOP_concepts,
+                    "CANDIDATES": {"query": ts_query, "count": self._candidate_count(rows)},
+                }
+                for search_term, OMOP_concepts, (ts_query, rows) in zip(
+                    search_terms,
+                    self._concepts_for_candidates(search_terms, candidates),
+                    candidates,
                 )
+            ]
+            self.logger.info(
+                f"Candidates from {self.candidate_search.value} search: "
+                + ", ".join(
+                    f"{result['search_term']!r}: {result['CANDIDATES']['count']}"
+                    for result in overall_results
+                )
+            )
 
             self.logger.info(f"Best OMOP matches for {search_terms} calculated")
             self.logger.info(f"OMOP Output: {overall_results}")
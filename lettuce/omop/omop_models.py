@@ -98,3 +98,37 @@ class Embedding(Base):
     concept_id = Column(Integer)
     embedding = mapped_column(Vector(DB_VECSIZE))
     dummy_primary = Column(Integer, primary_key=True)
+
+
+class FilteredEmbedding(Base):
+    """
+    This class represents an ORM mapping to the denormalized embeddings table, which carries the concept filter columns next to each vector
+
+    The table is list-partitioned by vocabulary_id, so a vocabulary-restricted search only scans the partitions, and their indexes, for those vocabularies.
+    """
+
+    __tablename__ = f"{DB_VECTABLE}_filtered"
+    __table_args__ = {"schema": DB_SCHEMA}
+
+    concept_id = Column(Integer, primary_key=True)
+    vocabulary_id = Column(String, primary_key=True)
+    concept_name = Column(String)
+    domain_id = Column(String)
+    standard_concept = Column(String)
+    invalid_reason = Column(String)
+    embedding = mapped_column(Vector(DB_VECSIZE))
+
+
+class EmbeddingBuildState(Base):
+    """
+    This class represents an ORM mapping to the table recording which concept names have been embedded, and how
+
+    The embeddings builder writes a row here in the same transaction as each concept's embedding, so the table is both its checkpoint and its record of what needs re-embedding after a vocabulary release.
+    """
+
+    __tablename__ = f"{DB_VECTABLE}_build_state"
+    __table_args__ = {"schema": DB_SCHEMA}
+
+    concept_id = Column(Integer, primary_key=True)
+    model = Column(String, nullable=False)
+    text_hash = Column(String, nullable=False)
@@ -4,14 +4,81 @@ from omop.omop_models import (
     ConceptSynonym,
     ConceptAncestor,
     Embedding,
+    FilteredEmbedding,
+    DB_VECSIZE,
 )
 
 import sqlalchemy as sa
-from sqlalchemy import select, or_, func, literal, distinct
+from sqlalchemy import select, or_, func, literal, distinct, union_all
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import aliased
 from sqlalchemy.sql import Select, CompoundSelect, text, null
-from typing import List, Optional
+from sqlalchemy.sql.elements import ColumnElement
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
+from enum import Enum
+from typing import List, Optional, Sequence
 
 from omop.preprocess import preprocess_search_term
+from omop.vector_index import DistanceMetric, EmbeddingLayout, RetrievalMode
+
+class TextRankFunction(str, Enum):
+    """
+    This enum holds the PostgreSQL functions full-text candidates can be ranked by
+
+    ts_rank weighs how often the query's lexemes appear. ts_rank_cd, cover density, also rewards them appearing close together
+    """
+
+    TS_RANK = "ts_rank"
+    TS_RANK_CD = "ts_rank_cd"
+
+    def rank(self, tsvector: ColumnElement, tsquery: ColumnElement) -> ColumnElement:
+        return getattr(func, self.value)(tsvector, tsquery)
+
+
+class CandidateSearch(str, Enum):
+    """
+    This enum holds the ways OMOPMatcher can find candidate concepts for fuzzy matching
+
+    FULL_TEXT matches the words of a term against concept names, so misspelt words find nothing.
+    TRIGRAM matches names by pg_trgm similarity in the database, which finds misspellings too. It needs the indexes built by lettuce-trigram-index to be fast
+    """
+
+    FULL_TEXT = "full_text"
+    TRIGRAM = "trigram"
+
+
+# The columns of a full-text candidate, one row per matching synonym
+CANDIDATE_COLUMNS = ["concept_id", "concept_name", "vocabulary_id", "concept_code", "concept_synonym_name"]
+
+
+def _synonym_rank(rank_function: TextRankFunction, ts_query: ColumnElement) -> ColumnElement:
+    return rank_function.rank(
+        func.to_tsvector(sa.literal_column("'english'::regconfig"), ConceptSynonym.concept_synonym_name),
+        ts_query,
+    ).label("synonym_rank")
+
+
+def _top_candidates(matches: Select, rank: ColumnElement, max_candidates: int) -> Select:
+    """
+    Keep the rows of the max_candidates concepts ranked highest, each concept ranking as its best row
+
+    Ties are broken by concept_id, so the same candidates are kept every time
+    """
+    scored = matches.add_columns(rank.label("candidate_rank")).subquery("scored")
+    ranked = select(
+        *[scored.c[name] for name in CANDIDATE_COLUMNS],
+        func.max(scored.c.candidate_rank).over(partition_by=scored.c.concept_id).label("concept_rank"),
+    ).subquery("ranked")
+    numbered = select(
+        *[ranked.c[name] for name in CANDIDATE_COLUMNS],
+        func.dense_rank().over(
+            order_by=(ranked.c.concept_rank.desc(), ranked.c.concept_id)
+        ).label("position"),
+    ).subquery("numbered")
+    return select(*[numbered.c[name] for name in CANDIDATE_COLUMNS]).where(
+        numbered.c.position <= max_candidates
+    )
+
 
 def count_concepts() -> Select:
     return select(sa.func.count(distinct(Concept.concept_id)))
@@ -56,13 +123,21 @@ def ts_rank_query(
 
 
 def text_search_query(
-        search_term: str, vocabulary_id: list[str] | None, standard_concept:bool, concept_synonym: bool
+        search_term: str,
+        vocabulary_id: list[str] | None,
+        standard_concept:bool,
+        concept_synonym: bool,
+        max_candidates: int | None = None,
+        rank_function: TextRankFunction = TextRankFunction.TS_RANK,
 ) -> Select:
     """
     Builds an OMOP query to search for concepts
 
     Uses the ORM models for the concept and concept_synonym tables to build a query
 
+    If max_candidates is given, matches are ranked in the database and only the rows of the best max_candidates concepts are returned.
+    A concept ranks as the better of its name and its matching synonyms.
+
     Parameters
     ----------
     search_term: str
@@ -71,12 +146,18 @@ def text_search_query(
         A list of vocabulary_ids in the concepts table. The returned concepts will have one of these vocabulary_ids
     concept_synonym: str
         If 'y', then the query is expanded to find matches using the concept_synonym table
+    max_candidates: int | None
+        The most concepts returned. If None, every match is returned, unranked
+    rank_function: TextRankFunction
+        The function matches are ranked by when max_candidates is given
 
     Returns
     -------
     Select
         An SQLAlchemy Select for the desired query
     """
+    ts_query = func.to_tsquery(sa.literal_column("'english'::regconfig"), search_term)
+    rank = rank_function.rank(Concept.concept_name_tsv, ts_query)
     concept_ts_condition = text(
         "concept_name_tsv @@ to_tsquery('english', :search_term)"
     )
@@ -114,7 +195,12 @@ def text_search_query(
                 Concept.vocabulary_id.in_(vocabulary_id)
             )
 
+        if max_candidates is not None:
+            synonym_matches = synonym_matches.add_columns(_synonym_rank(rank_function, ts_query))
+
         synonym_matches_cte = synonym_matches.cte("synonym_matches")
+        if max_candidates is not None:
+            rank = func.greatest(rank, func.coalesce(synonym_matches_cte.c.synonym_rank, 0))
 
         # Use the CTE in the main query
         query = query.add_columns(synonym_matches_cte.c.concept_synonym_name)
@@ -132,9 +218,345 @@ def text_search_query(
         query = query.add_columns(null().label("concept_synonym_name"))
         query = query.where(concept_ts_condition.bindparams(search_term=search_term))
 
+    if max_candidates is not None:
+        return _top_candidates(query, rank, max_candidates)
     return query
 
 
+def _search_terms_table(search_terms: Sequence[str]):
+    """
+    Unnest search terms sent as one array parameter, numbering them from 1 in a column named ordinal
+    """
+    return (
+        func.unnest(literal(list(search_terms), ARRAY(sa.Text)))
+        .table_valued(sa.column("search_term", sa.Text), with_ordinality="ordinal")
+        .render_derived(name="search_terms")
+    )
+
+
+def text_search_query_batch(
+        search_terms: Sequence[str],
+        vocabulary_id: list[str] | None,
+        standard_concept: bool,
+        concept_synonym: bool,
+        max_candidates: int | None = None,
+        rank_function: TextRankFunction = TextRankFunction.TS_RANK,
+) -> Select:
+    """
+    Builds one OMOP query that runs text_search_query for several search terms
+
+    The terms are sent as one array parameter and unnested WITH ORDINALITY, then a LATERAL subquery runs the full-text match for each one.
+    This takes one round trip to the database however many terms there are.
+    If max_candidates is given, each term's matches are ranked and capped as in text_search_query.
+
+    Parameters
+    ----------
+    search_terms: Sequence[str]
+        The terms, already preprocessed into tsquery syntax
+    vocabulary_id: list[str]
+        A list of vocabulary_ids in the concepts table. The returned concepts will have one of these vocabulary_ids
+    standard_concept: bool
+        If true, only standard concepts are returned
+    concept_synonym: bool
+        If true, the query is expanded to find matches using the concept_synonym table
+    max_candidates: int | None
+        The most concepts returned per term. If None, every match is returned, unranked
+    rank_function: TextRankFunction
+        The function matches are ranked by when max_candidates is given
+
+    Returns
+    -------
+    Select
+        A query returning the columns of text_search_query after an ordinal column, the 1-based position of the search term in search_terms
+    """
+    terms = _search_terms_table(search_terms)
+    ts_query = func.to_tsquery(sa.literal_column("'english'::regconfig"), terms.c.search_term)
+    rank = rank_function.rank(Concept.concept_name_tsv, ts_query)
+
+    matches = select(
+        Concept.concept_id,
+        Concept.concept_name,
+        Concept.vocabulary_id,
+        Concept.concept_code,
+    )
+
+    if standard_concept:
+        matches = matches.where(Concept.standard_concept == "S")
+
+    if vocabulary_id:
+        matches = matches.where(Concept.vocabulary_id.in_(vocabulary_id))
+
+    concept_ts_condition = Concept.concept_name_tsv.op("@@")(ts_query)
+    if concept_synonym:
+        # Aliased so the lateral subquery doesn't correlate to the outer concept table
+        synonym_concept = aliased(Concept, name="synonym_concept")
+        synonym_matches = (
+            select(
+                ConceptSynonym.concept_id.label("synonym_concept_id"),
+                ConceptSynonym.concept_synonym_name,
+            )
+            .join(synonym_concept, ConceptSynonym.concept_id == synonym_concept.concept_id)
+            .where(synonym_concept.standard_concept == "S")
+            .where(
+                func.to_tsvector(
+                    sa.literal_column("'english'::regconfig"), ConceptSynonym.concept_synonym_name
+                ).op("@@")(ts_query)
+            )
+        )
+        if vocabulary_id:
+            synonym_matches = synonym_matches.where(
+                synonym_concept.vocabulary_id.in_(vocabulary_id)
+            )
+        if max_candidates is not None:
+            synonym_matches = synonym_matches.add_columns(_synonym_rank(rank_function, ts_query))
+        # Two levels down from search_terms, so correlation isn't automatic
+        synonym_matches = synonym_matches.correlate(terms).lateral("synonym_matches")
+
+        if max_candidates is not None:
+            rank = func.greatest(rank, func.coalesce(synonym_matches.c.synonym_rank, 0))
+        matches = matches.add_columns(synonym_matches.c.concept_synonym_name)
+        matches = matches.outerjoin(
+            synonym_matches,
+            Concept.concept_id == synonym_matches.c.synonym_concept_id,
+        )
+        matches = matches.where(
+            or_(
+                concept_ts_condition,
+                Concept.concept_id == synonym_matches.c.synonym_concept_id,
+            )
+        )
+    else:
+        matches = matches.add_columns(null().label("concept_synonym_name"))
+        matches = matches.where(concept_ts_condition)
+
+    if max_candidates is not None:
+        # Ranked and capped inside the lateral, so every term gets its own max_candidates
+        matches = _top_candidates(matches.correlate(terms), rank, max_candidates)
+    matches = matches.lateral("matches")
+    return (
+        select(
+            terms.c.ordinal,
+            matches.c.concept_id,
+            matches.c.concept_name,
+            matches.c.vocabulary_id,
+            matches.c.concept_code,
+            matches.c.concept_synonym_name,
+        )
+        .select_from(terms)
+        .join(matches, sa.true())
+        .order_by(terms.c.ordinal)
+    )
+
+
+def _concept_filters(
+        vocabulary_id: list[str] | None,
+        domain_id: list[str] | None,
+        valid_concept: bool,
+) -> List[ColumnElement]:
+    filters = []
+    if vocabulary_id:
+        filters.append(Concept.vocabulary_id.in_(vocabulary_id))
+    if domain_id:
+        filters.append(Concept.domain_id.in_(domain_id))
+    if valid_concept:
+        filters.append(Concept.invalid_reason == None)
+    return filters
+
+
+def _trigram_matches(
+        search_term: ColumnElement,
+        filters: List[ColumnElement],
+        standard_concept: bool,
+        concept_synonym: bool,
+) -> Select | CompoundSelect:
+    """
+    The concept_id, matching synonym name and similarity of each concept name, and synonym, similar to the search term
+
+    Names are matched with pg_trgm's % operator, which a gin_trgm_ops index serves, against the pg_trgm.similarity_threshold setting.
+    A concept matched by its name has a row with a null synonym name, and a row for each synonym matched.
+    As in the full-text search, synonyms only match standard concepts, whatever standard_concept is.
+    """
+    name_matches = select(
+        Concept.concept_id,
+        null().label("concept_synonym_name"),
+        func.similarity(Concept.concept_name, search_term).label("similarity"),
+    ).where(Concept.concept_name.bool_op("%")(search_term), *filters)
+    if standard_concept:
+        name_matches = name_matches.where(Concept.standard_concept == "S")
+    if not concept_synonym:
+        return name_matches
+
+    synonym_matches = (
+        select(
+            ConceptSynonym.concept_id,
+            ConceptSynonym.concept_synonym_name,
+            func.similarity(ConceptSynonym.concept_synonym_name, search_term).label("similarity"),
+        )
+        .join(Concept, ConceptSynonym.concept_id == Concept.concept_id)
+        .where(ConceptSynonym.concept_synonym_name.bool_op("%")(search_term), *filters)
+        .where(Concept.standard_concept == "S")
+    )
+    return union_all(name_matches, synonym_matches)
+
+
+def _trigram_candidates(matches: Select | CompoundSelect, max_candidates: int | None) -> Select:
+    matches = matches.subquery("trigram_matches")
+    candidates = select(
+        Concept.concept_id,
+        Concept.concept_name,
+        Concept.vocabulary_id,
+        Concept.concept_code,
+        matches.c.concept_synonym_name,
+    ).join_from(matches, Concept, matches.c.concept_id == Concept.concept_id)
+    if max_candidates is not None:
+        return _top_candidates(candidates, matches.c.similarity, max_candidates)
+    return candidates
+
+
+def trigram_search_query(
+        search_term: str,
+        vocabulary_id: list[str] | None,
+        standard_concept: bool,
+        concept_synonym: bool,
+        max_candidates: int | None = None,
+) -> Select:
+    """
+    Builds an OMOP query to search for concepts by trigram similarity, returning the same columns as text_search_query
+
+    Unlike the full-text search, this finds names with misspelt words, as a misspelling shares most of its trigrams with the correct spelling.
+    Only names at least as similar as the pg_trgm.similarity_threshold setting match, so set it with apply_trigram_threshold in the same transaction.
+
+    Parameters
+    ----------
+    search_term: str
+        The term to compare concept names with. pg_trgm lowercases it and ignores punctuation, so it needs no preprocessing
+    vocabulary_id: list[str]
+        A list of vocabulary_ids in the concepts table. The returned concepts will have one of these vocabulary_ids
+    standard_concept: bool
+        If true, only standard concepts are returned
+    concept_synonym: bool
+        If true, concepts are also matched by their synonyms
+    max_candidates: int | None
+        The most concepts returned, those with the most similar name or synonym. If None, every match is returned, unranked
+
+    Returns
+    -------
+    Select
+        An SQLAlchemy Select for the desired query
+    """
+    matches = _trigram_matches(
+        literal(search_term),
+        _concept_filters(vocabulary_id, None, False),
+        standard_concept,
+        concept_synonym,
+    )
+    return _trigram_candidates(matches, max_candidates)
+
+
+def trigram_search_query_batch(
+        search_terms: Sequence[str],
+        vocabulary_id: list[str] | None,
+        standard_concept: bool,
+        concept_synonym: bool,
+        max_candidates: int | None = None,
+) -> Select:
+    """
+    Builds one OMOP query that runs trigram_search_query for several search terms
+
+    The terms are unnested WITH ORDINALITY and matched in a LATERAL subquery, as in text_search_query_batch, so max_candidates applies to each term.
+
+    Parameters
+    ----------
+    search_terms: Sequence[str]
+        The terms to compare concept names with
+    vocabulary_id: list[str]
+        A list of vocabulary_ids in the concepts table. The returned concepts will have one of these vocabulary_ids
+    standard_concept: bool
+        If true, only standard concepts are returned
+    concept_synonym: bool
+        If true, concepts are also matched by their synonyms
+    max_candidates: int | None
+        The most concepts returned per term. If None, every match is returned, unranked
+
+    Returns
+    -------
+    Select
+        A query returning the columns of trigram_search_query after an ordinal column, the 1-based position of the search term in search_terms
+    """
+    terms = _search_terms_table(search_terms)
+    matches = _trigram_matches(
+        terms.c.search_term,
+        _concept_filters(vocabulary_id, None, False),
+        standard_concept,
+        concept_synonym,
+    )
+    # The branches are two levels down from search_terms, so correlation isn't automatic
+    if isinstance(matches, CompoundSelect):
+        matches = union_all(*[branch.correlate(terms) for branch in matches.selects])
+    else:
+        matches = matches.correlate(terms)
+    matches = _trigram_candidates(matches, max_candidates).lateral("matches")
+    return (
+        select(
+            terms.c.ordinal,
+            matches.c.concept_id,
+            matches.c.concept_name,
+            matches.c.vocabulary_id,
+            matches.c.concept_code,
+            matches.c.concept_synonym_name,
+        )
+        .select_from(terms)
+        .join(matches, sa.true())
+        .order_by(terms.c.ordinal)
+    )
+
+
+def trigram_rank_query(
+        search_term: str,
+        vocabulary_id: Optional[List[str]],
+        domain_id: Optional[List[str]],
+        standard_concept: bool,
+        valid_concept: bool,
+        top_k: int,
+        concept_synonym: bool = True,
+) -> Select:
+    """
+    Builds a query for the top_k concepts most similar to a search term by trigram similarity, with the columns of ts_rank_query
+
+    A concept scores the similarity of its name or, if concept_synonym is true, its most similar synonym, whichever is higher.
+    As with trigram_search_query, only names as similar as pg_trgm.similarity_threshold are considered.
+
+    Returns
+    -------
+    Select
+        A query for the concepts, most similar first, with the score in a similarity column
+    """
+    matches = _trigram_matches(
+        literal(search_term),
+        _concept_filters(vocabulary_id, domain_id, valid_concept),
+        standard_concept,
+        concept_synonym,
+    ).subquery("trigram_matches")
+    concept_columns = [
+        Concept.concept_name,
+        Concept.concept_id,
+        Concept.concept_code,
+        Concept.domain_id,
+        Concept.vocabulary_id,
+        Concept.concept_class_id,
+        Concept.standard_concept,
+        Concept.invalid_reason,
+    ]
+    similarity = func.max(matches.c.similarity).label("similarity")
+    return (
+        select(*concept_columns, similarity)
+        .join_from(matches, Concept, matches.c.concept_id == Concept.concept_id)
+        .group_by(*concept_columns)
+        .order_by(similarity.desc(), Concept.concept_id)
+        .limit(top_k)
+    )
+
+
 def get_all_vocabs() -> Select:
     return select(Concept.vocabulary_id.distinct())
 
@@ -142,7 +564,8 @@ def get_all_vocabs() -> Select:
 def query_ids_matching_name(
         query_concept,
         vocabulary_ids: list[str] | None,
-        full_concept: bool = False
+        full_concept: bool = False,
+        exact_case: bool = False,
         ) -> Select:
     if full_concept:
         base_query = select(
@@ -157,13 +580,57 @@ def query_ids_matching_name(
             )
     else:
         base_query = select(Concept.concept_id)
-    base_query = base_query.where(func.lower(Concept.concept_name) == query_concept.lower())
+    if exact_case:
+        # Replies constrained to concept names match exactly, so an index on concept_name can be used
+        base_query = base_query.where(Concept.concept_name == query_concept)
+    else:
+        base_query = base_query.where(func.lower(Concept.concept_name) == query_concept.lower())
     if vocabulary_ids:
         return base_query.where(Concept.vocabulary_id.in_(vocabulary_ids))
     else:
         return base_query
 
 
+def query_concept_names(
+        vocabulary_ids: list[str],
+        concept_class_ids: list[str] | None = None,
+        standard_concept: bool = False,
+        valid_concept: bool = True,
+        ) -> Select:
+    """
+    Select the distinct names of the concepts an LLM reply may be constrained to
+
+    Parameters
+    ----------
+    vocabulary_ids: list[str]
+        The vocabularies to take names from
+    concept_class_ids: list[str] | None
+        If supplied, only names of concepts in these classes, e.g. Ingredient, are selected
+    standard_concept: bool
+        If true, only names of standard concepts are selected
+    valid_concept: bool
+        If true, only names of concepts that have not been invalidated are selected
+
+    Returns
+    -------
+    Select
+        A query returning concept_name, ordered by name
+    """
+    query = (
+        select(Concept.concept_name)
+        .distinct()
+        .where(Concept.vocabulary_id.in_(vocabulary_ids))
+        .where(Concept.concept_name.is_not(None))
+    )
+    if concept_class_ids:
+        query = query.where(Concept.concept_class_id.in_(concept_class_ids))
+    if standard_concept:
+        query = query.where(Concept.standard_concept == "S")
+    if valid_concept:
+        query = query.where(Concept.invalid_reason == None)
+    return query.order_by(Concept.concept_name)
+
+
 def query_ancestors_by_name(
     query_concept: str,
     vocabulary_ids: list[str] | None,
@@ -302,6 +769,99 @@ def query_ancestors_and_descendants_by_id(
     return ancestors.union(descendants)
 
 
+def _id_array(concept_ids: Sequence[int]):
+    return literal([int(concept_id) for concept_id in concept_ids], ARRAY(sa.Integer))
+
+
+def query_ancestors_and_descendants_by_ids(
+    concept_ids: Sequence[int],
+    min_separation_ancestor: int = 1,
+    max_separation_ancestor: int | None = 1,
+    min_separation_descendant: int = 1,
+    max_separation_descendant: int | None = 1
+) -> CompoundSelect:
+    """
+    Build one query to find the ancestors and descendants of several concepts
+
+    The concept ids are sent as one array parameter. Each row has the columns of query_ancestors_and_descendants_by_id after a source_concept_id column naming the concept it was found for.
+
+    Parameters
+    ----------
+    concept_ids: Sequence[int]
+        The concept_ids to find hierarchy for
+    min_separation_ancestor: int
+        Minimum levels of separation for ancestors
+    max_separation_ancestor: int
+        Maximum levels of separation for ancestors
+    min_separation_descendant: int
+        Minimum levels of separation for descendants
+    max_separation_descendant: int
+        Maximum levels of separation for descendants
+
+    Returns
+    -------
+    CompoundSelect
+        SQLAlchemy CompoundSelect object representing the query
+    """
+    if max_separation_ancestor is None:
+        max_separation_ancestor = 1000
+    if max_separation_descendant is None: 
+        max_separation_descendant = 1000 
+    ids = _id_array(concept_ids)
+
+    ancestors = (
+        select(
+            ConceptAncestor.descendant_concept_id.label('source_concept_id'),
+            literal('Ancestor').label('relationship_type'),
+            ConceptAncestor.ancestor_concept_id.label('concept_id'),
+            ConceptAncestor.ancestor_concept_id,
+            ConceptAncestor.descendant_concept_id,
+            Concept.concept_name,
+            Concept.vocabulary_id,
+            Concept.concept_code,
+            ConceptAncestor.min_levels_of_separation,
+            ConceptAncestor.max_levels_of_separation
+        )
+        .select_from(ConceptAncestor)
+        .join(
+            Concept, 
+            ConceptAncestor.ancestor_concept_id == Concept.concept_id
+        )
+        .where(
+            ConceptAncestor.descendant_concept_id == sa.any_(ids),
+            ConceptAncestor.min_levels_of_separation >= min_separation_ancestor,
+            ConceptAncestor.max_levels_of_separation <= max_separation_ancestor
+        )
+    )
+
+    descendants = (
+        select(
+            ConceptAncestor.ancestor_concept_id.label('source_concept_id'),
+            literal('Descendant').label('relationship_type'),
+            ConceptAncestor.descendant_concept_id.label('concept_id'),
+            ConceptAncestor.ancestor_concept_id,
+            ConceptAncestor.descendant_concept_id,
+            Concept.concept_name,
+            Concept.vocabulary_id,
+            Concept.concept_code,
+            ConceptAncestor.min_levels_of_separation,
+            ConceptAncestor.max_levels_of_separation
+        )
+        .select_from(ConceptAncestor)
+        .join(
+            Concept, 
+            ConceptAncestor.descendant_concept_id == Concept.concept_id
+        )
+        .where(
+            ConceptAncestor.ancestor_concept_id == sa.any_(ids),
+            ConceptAncestor.min_levels_of_separation >= min_separation_descendant,
+            ConceptAncestor.max_levels_of_separation <= max_separation_descendant
+        )
+    )
+
+    return ancestors.union(descendants)
+
+
 def query_related_by_name(
     query_concept: str, vocabulary_ids: list[str] | None
 ) -> Select:
@@ -360,6 +920,150 @@ def query_related_by_id(concept_id: int) -> Select:
     return related 
 
 
+def query_related_by_ids(concept_ids: Sequence[int]) -> Select:
+    """
+    Build one query to find the concepts related to several concepts
+
+    The concept ids are sent as one array parameter. Rows have the same columns as query_related_by_id, and concept_id_1 names the concept each was found for.
+
+    Parameters
+    ----------
+    concept_ids : Sequence[int]
+        The source concept IDs for which to find related concepts
+
+    Returns
+    -------
+    Select 
+        SQLAlchemy Select object representing the query
+    """
+    return (
+        select(
+            ConceptRelationship.concept_id_2.label("concept_id"), 
+            ConceptRelationship.concept_id_1, 
+            ConceptRelationship.relationship_id, 
+            ConceptRelationship.concept_id_2, 
+            Concept.concept_name,
+            Concept.vocabulary_id,
+            Concept.concept_code
+        )
+        .select_from(ConceptRelationship)
+        .join(
+            Concept, 
+            ConceptRelationship.concept_id_2 == Concept.concept_id 
+        )
+        .where(
+            (ConceptRelationship.concept_id_1 == sa.any_(_id_array(concept_ids))) &
+            (ConceptRelationship.valid_end_date > func.now()) & 
+            (ConceptRelationship.concept_id_2 != ConceptRelationship.concept_id_1) 
+        )
+    )
+
+
+def _filter_vector_query(
+        query: Select,
+        embed_vocab: List[str] | None,
+        domain_id: List[str] | None,
+        standard_concept: bool,
+        valid_concept: bool,
+        source=Concept,
+        ) -> Select:
+    if embed_vocab is not None:
+        query = query.where(source.vocabulary_id.in_(embed_vocab))
+    if domain_id is not None:
+        query = query.where(source.domain_id.in_(domain_id))
+    if standard_concept:
+        query = query.where(source.standard_concept == "S")
+    if valid_concept:
+        query = query.where(source.invalid_reason == None)
+    return query
+
+
+def _vector_sources(layout: EmbeddingLayout):
+    """
+    The table holding the vectors and the table the filters apply to, for a layout
+    """
+    if layout == EmbeddingLayout.DENORMALIZED:
+        return FilteredEmbedding, FilteredEmbedding
+    return Embedding, Concept
+
+
+def _compact_distance(
+        mode: RetrievalMode,
+        metric: DistanceMetric,
+        embedding,
+        query_embedding,
+        ):
+    """
+    The first-pass distance for a quantized retrieval mode, written to match the expression indexes lettuce-vector-index builds
+    """
+    if mode == RetrievalMode.HALFVEC:
+        return metric.distance(
+            sa.cast(embedding, HALFVEC(DB_VECSIZE)),
+            sa.cast(query_embedding, HALFVEC(DB_VECSIZE)),
+        )
+    return sa.cast(func.binary_quantize(embedding), BIT(DB_VECSIZE)).hamming_distance(
+        sa.cast(func.binary_quantize(query_embedding), BIT(DB_VECSIZE))
+    )
+
+
+def _nearest(
+        query_embedding,
+        embed_vocab: List[str] | None,
+        domain_id: List[str] | None,
+        standard_concept: bool,
+        valid_concept: bool,
+        n: int,
+        metric: DistanceMetric,
+        layout: EmbeddingLayout,
+        ) -> Select:
+    """
+    Select the nearest n concepts by exact distance, as id, content and score
+    """
+    vectors, filtered = _vector_sources(layout)
+    distance = metric.distance(vectors.embedding, query_embedding)
+    if layout == EmbeddingLayout.DENORMALIZED:
+        query = select(
+            vectors.concept_id.label("id"),
+            vectors.concept_name.label("content"),
+            metric.score(distance).label("score"),
+        )
+    else:
+        query = select(
+            Concept.concept_id.label("id"),
+            Concept.concept_name.label("content"),
+            metric.score(distance).label("score"),
+        ).join(Embedding, Concept.concept_id == Embedding.concept_id)
+    query = query.order_by(distance).limit(n)
+    return _filter_vector_query(
+        query, embed_vocab, domain_id, standard_concept, valid_concept, filtered
+    )
+
+
+def _quantized_candidates(
+        query_embedding,
+        mode: RetrievalMode,
+        metric: DistanceMetric,
+        n_candidates: int,
+        embed_vocab: List[str] | None,
+        domain_id: List[str] | None,
+        standard_concept: bool,
+        valid_concept: bool,
+        layout: EmbeddingLayout,
+        ) -> Select:
+    vectors, filtered = _vector_sources(layout)
+    query = select(vectors.concept_id, vectors.embedding)
+    if layout == EmbeddingLayout.JOINED:
+        query = query.join(Concept, Concept.concept_id == Embedding.concept_id)
+    query = (
+        query
+        .order_by(_compact_distance(mode, metric, vectors.embedding, query_embedding))
+        .limit(n_candidates)
+    )
+    return _filter_vector_query(
+        query, embed_vocab, domain_id, standard_concept, valid_concept, filtered
+    )
+
+
 def query_vector(
         query_embedding,
         embed_vocab: List[str] | None = None,
@@ -368,32 +1072,170 @@ def query_vector(
         valid_concept: bool = False,
         n: int = 5,
         describe_concept:bool = False,
+        metric: DistanceMetric = DistanceMetric.COSINE,
+        mode: RetrievalMode = RetrievalMode.EXACT,
+        rerank_factor: int = 4,
+        layout: EmbeddingLayout = EmbeddingLayout.JOINED,
         ) -> Select:
+    if mode != RetrievalMode.EXACT:
+        query_vector_expression = sa.cast(
+            literal(_vector_literal(query_embedding)), Vector(DB_VECSIZE)
+        )
+        candidates = _quantized_candidates(
+            query_vector_expression,
+            mode,
+            metric,
+            n * rerank_factor,
+            embed_vocab,
+            domain_id,
+            standard_concept,
+            valid_concept,
+            layout,
+        ).subquery("candidates")
+        distance = metric.distance(candidates.c.embedding, query_vector_expression)
+        columns = (
+            [Concept]
+            if describe_concept
+            else [Concept.concept_id.label("id"), Concept.concept_name.label("content")]
+        )
+        return (
+            select(*columns, metric.score(distance).label("score"))
+            .join(candidates, candidates.c.concept_id == Concept.concept_id)
+            .order_by(distance)
+            .limit(n)
+        )
+
     if describe_concept:
+        vectors, filtered = _vector_sources(layout)
+        distance = metric.distance(vectors.embedding, query_embedding)
         query = (
-            select(Concept, Embedding.embedding.cosine_distance(query_embedding).label("score"))
-            .join(Embedding, Concept.concept_id == Embedding.concept_id)
-            .order_by(Embedding.embedding.cosine_distance(query_embedding))
+            select(Concept, metric.score(distance).label("score"))
+            .join(vectors, Concept.concept_id == vectors.concept_id)
+            .order_by(distance)
             .limit(n)
         )
+        return _filter_vector_query(
+            query, embed_vocab, domain_id, standard_concept, valid_concept, filtered
+        )
+    return _nearest(
+        query_embedding,
+        embed_vocab,
+        domain_id,
+        standard_concept,
+        valid_concept,
+        n,
+        metric,
+        layout,
+    )
+
+
+def _vector_literal(embedding: Sequence[float]) -> str:
+    return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
+
+def query_vector_batch(
+        query_embeddings: Sequence[Sequence[float]],
+        embed_vocab: List[str] | None = None,
+        domain_id: List[str] | None = None,
+        standard_concept: bool = False,
+        valid_concept: bool = False,
+        n: int = 5,
+        metric: DistanceMetric = DistanceMetric.COSINE,
+        mode: RetrievalMode = RetrievalMode.EXACT,
+        rerank_factor: int = 4,
+        layout: EmbeddingLayout = EmbeddingLayout.JOINED,
+        ) -> Select:
+    """
+    Build a single query that finds the nearest concepts for several query embeddings
+
+    The embeddings are sent as one array parameter and unnested WITH ORDINALITY, then a LATERAL subquery fetches the top n concepts for each one.
+    This takes one round trip to the database however many embeddings there are.
+    In the quantized retrieval modes, the LATERAL subquery first takes n * rerank_factor candidates by the compact distance, then reranks them by exact distance on the full vectors.
+
+    Parameters
+    ----------
+    query_embeddings: Sequence[Sequence[float]]
+        The embeddings to search with
+    embed_vocab: List[str] | None
+        If supplied, only concepts from these vocabularies are returned
+    domain_id: List[str] | None
+        If supplied, only concepts from these domains are returned
+    standard_concept: bool
+        If true, only standard concepts are returned
+    valid_concept: bool
+        If true, only valid concepts are returned
+    n: int
+        The number of concepts returned for each embedding
+    metric: DistanceMetric
+        The metric concepts are ranked by. Scores are on the cosine distance scale whichever metric is used
+    mode: RetrievalMode
+        Whether to search the full vectors, or a halfvec or binary-quantized copy followed by an exact rerank
+    rerank_factor: int
+        In the quantized modes, how many candidates per result are reranked
+    layout: EmbeddingLayout
+        Whether to read the embeddings table joined to concept, or the denormalized table partitioned by vocabulary
+
+    Returns
+    -------
+    Select
+        A query returning ordinal, id, content and score columns, where ordinal is the 1-based position of the query embedding in query_embeddings
+    """
+    vector_array = sa.cast(
+        literal([_vector_literal(e) for e in query_embeddings], ARRAY(sa.Text)),
+        ARRAY(Vector(DB_VECSIZE)),
+    )
+    query_vectors = (
+        func.unnest(vector_array)
+        .table_valued(
+            sa.column("query_embedding", Vector(DB_VECSIZE)),
+            with_ordinality="ordinal",
+        )
+        .render_derived(name="query_vectors")
+    )
+    if mode == RetrievalMode.EXACT:
+        matches = _nearest(
+            query_vectors.c.query_embedding,
+            embed_vocab,
+            domain_id,
+            standard_concept,
+            valid_concept,
+            n,
+            metric,
+            layout,
+        ).lateral("matches")
     else:
-        query = (
+        candidates = _quantized_candidates(
+            query_vectors.c.query_embedding,
+            mode,
+            metric,
+            n * rerank_factor,
+            embed_vocab,
+            domain_id,
+            standard_concept,
+            valid_concept,
+            layout,
+        ).lateral("candidates")
+        distance = metric.distance(candidates.c.embedding, query_vectors.c.query_embedding)
+        matches = (
             select(
                 Concept.concept_id.label("id"),
                 Concept.concept_name.label("content"),
-                Embedding.embedding.cosine_distance(query_embedding).label("score"),
+                metric.score(distance).label("score"),
             )
-            .join(Embedding, Concept.concept_id == Embedding.concept_id)
-            .order_by(Embedding.embedding.cosine_distance(query_embedding))
+            .join(candidates, candidates.c.concept_id == Concept.concept_id)
+            .order_by(distance)
             .limit(n)
+            .lateral("matches")
         )
-    if embed_vocab is not None:
-        query = query.where(Concept.vocabulary_id.in_(embed_vocab))
-    if domain_id is not None:
-        query = query.where(Concept.domain_id.in_(domain_id))
-    if standard_concept:
-        query = query.where(Concept.standard_concept == "S")
-    if valid_concept:
-        query = query.where(Concept.invalid_reason == None)
 
-    return query
+    return (
+        select(
+            query_vectors.c.ordinal,
+            matches.c.id,
+            matches.c.content,
+            matches.c.score,
+        )
+        .select_from(query_vectors)
+        .join(matches, sa.true())
+        .order_by(query_vectors.c.ordinal, matches.c.score)
+    )
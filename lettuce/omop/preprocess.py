@@ -1,7 +1,7 @@
 import re
 
 
-def preprocess_search_term(term) -> str:
+def preprocess_search_term(term, operator: str = "|") -> str:
     """
     Preprocess a search term for use in a full-text search query.
 
@@ -14,6 +14,7 @@ def preprocess_search_term(term) -> str:
 
     Args:
         term (str): The original search term.
+        operator (str): The tsquery operator joining the words. '|' matches any of them, '&' all of them.
 
     Returns:
         str: A preprocessed string ready for use in a full-text search query.
@@ -27,4 +28,4 @@ def preprocess_search_term(term) -> str:
     terms = re.findall(r"\w+", term.lower())
     terms = [t for t in terms if t not in stop_words]
     # Join terms with ' | ' for OR operation in to_tsquery
-    return " | ".join(terms)
+    return f" {operator} ".join(terms)
@@ -0,0 +1,131 @@
+from typing import List, Tuple
+
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from omop.omop_models import DB_SCHEMA
+from omop.vector_index import _autocommit
+
+# The (table, column) pairs trigram search matches names in
+TRIGRAM_INDEXED_COLUMNS: List[Tuple[str, str]] = [
+    ("concept", "concept_name"),
+    ("concept_synonym", "concept_synonym_name"),
+]
+
+
+def trigram_threshold(search_threshold: float) -> float:
+    """
+    Map a fuzzy match threshold, from 0 to 100, to a pg_trgm similarity threshold, from 0 to 1
+
+    Trigram similarity runs well below rapidfuzz's ratio for the same pair, as one wrong letter changes up to three trigrams.
+    "asprin" and "aspirin" have a ratio of 92, but a trigram similarity of 0.5.
+    Halving the threshold keeps the names the fuzzy match would, so candidates are only cut by the fuzzy match that follows.
+    """
+    return min(max(search_threshold, 0), 100) / 200
+
+
+def apply_trigram_threshold(connection: Session | Connection, threshold: float) -> None:
+    """
+    Set pg_trgm.similarity_threshold, the similarity the % operator matches at, for the current transaction
+
+    This is SET LOCAL, as in apply_search_settings, so the threshold can't leak into other requests sharing a pooled connection.
+
+    Parameters
+    ----------
+    connection: Session | Connection
+        The session or connection the trigram query will run on
+    threshold: float
+        The similarity, from 0 to 1, names must reach to match
+    """
+    connection.execute(
+        select(func.set_config("pg_trgm.similarity_threshold", str(float(threshold)), True))
+    )
+
+
+def trigram_index_name(table: str, column: str) -> str:
+    return f"{table}_{column}_trgm_idx"
+
+
+def create_trigram_index_ddl(table: str, column: str, concurrently: bool = True) -> str:
+    """
+    Build the CREATE INDEX statement for a GIN trigram index on a name column
+
+    A gin_trgm_ops index serves the % operator trigram search filters with, so only names sharing trigrams with the search term are read
+
+    Parameters
+    ----------
+    table: str
+        The table indexed
+    column: str
+        The name column indexed
+    concurrently: bool
+        If true, the index is built without locking the table against writes
+
+    Returns
+    -------
+    str
+        The DDL statement
+    """
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+        f'"{trigram_index_name(table, column)}" '
+        f'ON "{DB_SCHEMA}"."{table}" '
+        f'USING gin ("{column}" gin_trgm_ops)'
+    )
+
+
+def build_trigram_indexes(
+    engine: Engine,
+    rebuild: bool = False,
+    concurrently: bool = True,
+    maintenance_work_mem: str | None = None,
+) -> List[str]:
+    """
+    Create the pg_trgm extension, if needed, and build the trigram indexes on concept and synonym names
+
+    Parameters
+    ----------
+    engine: Engine
+        An engine connected to the OMOP database
+    rebuild: bool
+        If true, existing indexes are dropped first
+    concurrently: bool
+        If true, the indexes are built without locking the tables against writes
+    maintenance_work_mem: str | None
+        If supplied, e.g. "2GB", sets maintenance_work_mem for the builds
+
+    Returns
+    -------
+    List[str]
+        The names of the indexes
+    """
+    names = []
+    with _autocommit(engine) as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        if maintenance_work_mem:
+            connection.execute(
+                select(func.set_config("maintenance_work_mem", maintenance_work_mem, False))
+            )
+        for table, column in TRIGRAM_INDEXED_COLUMNS:
+            name = trigram_index_name(table, column)
+            if rebuild:
+                connection.execute(
+                    text(
+                        f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS "
+                        f'"{DB_SCHEMA}"."{name}"'
+                    )
+                )
+            connection.execute(text(create_trigram_index_ddl(table, column, concurrently)))
+            names.append(name)
+        if maintenance_work_mem:
+            connection.execute(text("RESET maintenance_work_mem"))
+    return names
+
+
+def drop_trigram_indexes(engine: Engine) -> List[str]:
+    names = [trigram_index_name(table, column) for table, column in TRIGRAM_INDEXED_COLUMNS]
+    with _autocommit(engine) as connection:
+        for name in names:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{DB_SCHEMA}"."{name}"'))
+    return names
@@ -0,0 +1,567 @@
+import math
+import os
+import time
+from enum import Enum
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import ColumnElement
+
+from omop.omop_models import (
+    DB_SCHEMA,
+    DB_VECSIZE,
+    DB_VECTABLE,
+    Embedding,
+    FilteredEmbedding,
+)
+
+
+class DistanceMetric(str, Enum):
+    """
+    This enum holds the distance metrics pgvector can order embeddings by
+
+    Queries order by the metric's own operator, so an index built with the matching operator class is used.
+    Scores are reported on the cosine distance scale, 0 for identical directions to 2 for opposite ones, whichever metric ranked the results.
+    For L2-normalized embeddings, like those from the BGE and E5 models, all three metrics then rank and score identically, and inner product is the cheapest to compute.
+    """
+
+    COSINE = "cosine"
+    INNER_PRODUCT = "inner_product"
+    L2 = "l2"
+
+    def operator_class(self) -> str:
+        """
+        The pgvector operator class an index needs for queries using this metric
+        """
+        return {
+            DistanceMetric.COSINE: "vector_cosine_ops",
+            DistanceMetric.INNER_PRODUCT: "vector_ip_ops",
+            DistanceMetric.L2: "vector_l2_ops",
+        }[self]
+
+    def distance(self, column, other) -> ColumnElement:
+        """
+        The pgvector distance expression for this metric, to order by
+        """
+        if self == DistanceMetric.COSINE:
+            return column.cosine_distance(other)
+        if self == DistanceMetric.INNER_PRODUCT:
+            return column.max_inner_product(other)
+        return column.l2_distance(other)
+
+    def score(self, distance: ColumnElement) -> ColumnElement:
+        """
+        Convert a distance from this metric to the cosine distance scale
+
+        pgvector's <#> operator returns the negative inner product, so 1 - a.b is 1 + distance.
+        For unit vectors, the squared L2 distance is 2 - 2 a.b, so 1 - a.b is distance squared over 2.
+        """
+        if self == DistanceMetric.COSINE:
+            return distance
+        if self == DistanceMetric.INNER_PRODUCT:
+            return 1 + distance
+        return distance * distance / 2
+
+
+class RetrievalMode(str, Enum):
+    """
+    This enum holds the ways vector search can use the embeddings
+
+    EXACT ranks by the full vectors.
+    HALFVEC and BINARY make a first pass over a compact copy of each embedding, then rerank the best candidates by exact distance on the full vectors.
+    The compact copies are held in expression indexes, so the table keeps one column and only the index, which is the part that needs to stay in RAM, shrinks.
+    HALFVEC stores 16-bit floats, halving the size. BINARY stores one bit per dimension, a 32x reduction, and ranks its first pass by Hamming distance.
+    """
+
+    EXACT = "exact"
+    HALFVEC = "halfvec"
+    BINARY = "binary"
+
+    def index_expression(self, metric: "DistanceMetric") -> str:
+        """
+        The indexed expression and operator class for an index serving this mode
+        """
+        if self == RetrievalMode.HALFVEC:
+            return f"(embedding::halfvec({DB_VECSIZE})) {metric.operator_class().replace('vector', 'halfvec')}"
+        if self == RetrievalMode.BINARY:
+            return f"(binary_quantize(embedding)::bit({DB_VECSIZE})) bit_hamming_ops"
+        return f"embedding {metric.operator_class()}"
+
+
+class EmbeddingLayout(str, Enum):
+    """
+    This enum holds the layouts vector search can read embeddings from
+
+    JOINED is the embeddings table, joined to the concept table to apply filters after the nearest neighbour scan.
+    DENORMALIZED is the table built by build_filtered_embeddings, which holds the filter columns itself and is partitioned by vocabulary.
+    """
+
+    JOINED = "joined"
+    DENORMALIZED = "denormalized"
+
+
+class VectorIndexMethod(str, Enum):
+    """
+    This enum holds the approximate nearest neighbour index types pgvector provides
+    """
+
+    HNSW = "hnsw"
+    IVFFLAT = "ivfflat"
+
+
+def vector_index_name(
+    method: VectorIndexMethod,
+    metric: DistanceMetric,
+    mode: RetrievalMode = RetrievalMode.EXACT,
+    table: str = DB_VECTABLE,
+) -> str:
+    if mode == RetrievalMode.BINARY:
+        return f"{table}_embedding_{method.value}_binary_idx"
+    if mode == RetrievalMode.HALFVEC:
+        return f"{table}_embedding_{method.value}_halfvec_{metric.value}_idx"
+    return f"{table}_embedding_{method.value}_{metric.value}_idx"
+
+
+def default_ivfflat_lists(n_rows: int) -> int:
+    """
+    The number of IVFFlat lists pgvector recommends: rows / 1000 up to a million rows, then sqrt(rows)
+    """
+    if n_rows <= 1_000_000:
+        return max(1, n_rows // 1000)
+    return int(math.sqrt(n_rows))
+
+
+def create_vector_index_ddl(
+    method: VectorIndexMethod,
+    metric: DistanceMetric,
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int = 100,
+    concurrently: bool = True,
+    mode: RetrievalMode = RetrievalMode.EXACT,
+    table: str = DB_VECTABLE,
+) -> str:
+    """
+    Build the CREATE INDEX statement for an index on the embeddings table
+
+    Parameters
+    ----------
+    method: VectorIndexMethod
+        HNSW or IVFFlat
+    metric: DistanceMetric
+        The distance metric the index serves, which decides its operator class
+    m: int
+        HNSW: the number of links per node
+    ef_construction: int
+        HNSW: the size of the candidate list used while building
+    lists: int
+        IVFFlat: the number of lists vectors are clustered into
+    concurrently: bool
+        If true, the index is built without locking the table against writes
+    mode: RetrievalMode
+        Whether the index holds the full vectors, or a halfvec or binary-quantized copy of them
+    table: str
+        The table indexed. An index on a partitioned table is created on each partition
+
+    Returns
+    -------
+    str
+        The DDL statement
+    """
+    if method == VectorIndexMethod.HNSW:
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    else:
+        options = f"lists = {int(lists)}"
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS "
+        f'"{vector_index_name(method, metric, mode, table)}" '
+        f'ON "{DB_SCHEMA}"."{table}" '
+        f"USING {method.value} ({mode.index_expression(metric)}) "
+        f"WITH ({options})"
+    )
+
+
+def _autocommit(engine: Engine) -> Connection:
+    # CREATE/DROP INDEX CONCURRENTLY can't run inside a transaction block
+    return engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+
+def build_vector_index(
+    engine: Engine,
+    method: VectorIndexMethod,
+    metric: DistanceMetric,
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int | None = None,
+    rebuild: bool = False,
+    concurrently: bool = True,
+    maintenance_work_mem: str | None = None,
+    mode: RetrievalMode = RetrievalMode.EXACT,
+) -> str:
+    """
+    Build, or rebuild, a vector index on the embeddings table
+
+    Parameters
+    ----------
+    engine: Engine
+        An engine connected to the OMOP database
+    method: VectorIndexMethod
+        HNSW or IVFFlat
+    metric: DistanceMetric
+        The distance metric the index serves
+    m: int
+        HNSW: the number of links per node
+    ef_construction: int
+        HNSW: the size of the candidate list used while building
+    lists: int | None
+        IVFFlat: the number of lists. If None, it is chosen from the table size
+    rebuild: bool
+        If true, an existing index of the same name is dropped first, so new parameters take effect
+    concurrently: bool
+        If true, the index is built without locking the table against writes
+    maintenance_work_mem: str | None
+        If supplied, e.g. "2GB", sets maintenance_work_mem for the build, which keeps HNSW builds in memory
+    mode: RetrievalMode
+        Whether the index holds the full vectors, or a halfvec or binary-quantized copy of them
+
+    Returns
+    -------
+    str
+        The name of the index
+    """
+    name = vector_index_name(method, metric, mode)
+    with _autocommit(engine) as connection:
+        if maintenance_work_mem:
+            connection.execute(
+                select(func.set_config("maintenance_work_mem", maintenance_work_mem, False))
+            )
+        if method == VectorIndexMethod.IVFFLAT and lists is None:
+            n_rows = connection.execute(
+                select(func.count()).select_from(Embedding)
+            ).scalar_one()
+            lists = default_ivfflat_lists(n_rows)
+        if rebuild:
+            connection.execute(
+                text(
+                    f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS "
+                    f'"{DB_SCHEMA}"."{name}"'
+                )
+            )
+        connection.execute(
+            text(
+                create_vector_index_ddl(
+                    method,
+                    metric,
+                    m=m,
+                    ef_construction=ef_construction,
+                    lists=lists or 100,
+                    concurrently=concurrently,
+                    mode=mode,
+                )
+            )
+        )
+        if maintenance_work_mem:
+            connection.execute(text("RESET maintenance_work_mem"))
+    return name
+
+
+def drop_vector_index(
+    engine: Engine,
+    method: VectorIndexMethod,
+    metric: DistanceMetric,
+    mode: RetrievalMode = RetrievalMode.EXACT,
+) -> str:
+    name = vector_index_name(method, metric, mode)
+    with _autocommit(engine) as connection:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{DB_SCHEMA}"."{name}"'))
+    return name
+
+
+def report_vector_indexes(session: Session) -> List[Dict[str, Any]]:
+    """
+    List the indexes on the embeddings table with their definitions, sizes and validity
+
+    An index left invalid by a failed concurrent build is ignored by the planner, so the report includes pg_index.indisvalid.
+
+    Parameters
+    ----------
+    session: Session
+        A session connected to the OMOP database
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        One dictionary per index, with name, definition, size and valid keys
+    """
+    query = text(
+        """
+        SELECT
+            i.indexname AS name,
+            i.indexdef AS definition,
+            pg_size_pretty(pg_relation_size(c.oid)) AS size,
+            x.indisvalid AS valid
+        FROM pg_indexes i
+        JOIN pg_namespace n ON n.nspname = i.schemaname
+        JOIN pg_class c ON c.relname = i.indexname AND c.relnamespace = n.oid
+        JOIN pg_index x ON x.indexrelid = c.oid
+        WHERE i.schemaname = :schema AND i.tablename = :table
+        ORDER BY i.indexname
+        """
+    )
+    return [
+        dict(row)
+        for row in session.execute(
+            query, {"schema": DB_SCHEMA, "table": DB_VECTABLE}
+        ).mappings()
+    ]
+
+
+def apply_search_settings(
+    connection: Session | Connection,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> None:
+    """
+    Set pgvector's search effort for the current transaction
+
+    This is SET LOCAL, through set_config(..., true), so the settings end with the transaction and can't leak into other requests sharing a pooled connection.
+
+    Parameters
+    ----------
+    connection: Session | Connection
+        The session or connection the vector query will run on
+    ef_search: int | None
+        hnsw.ef_search: the HNSW candidate list size. Larger values raise recall and latency
+    probes: int | None
+        ivfflat.probes: the number of IVFFlat lists searched. Larger values raise recall and latency
+    """
+    if ef_search is not None:
+        connection.execute(select(func.set_config("hnsw.ef_search", str(int(ef_search)), True)))
+    if probes is not None:
+        connection.execute(select(func.set_config("ivfflat.probes", str(int(probes)), True)))
+
+
+# Seconds a detected layout is used before looking for the denormalized table again
+LAYOUT_TTL = float(os.getenv("VECTOR_LAYOUT_TTL", "30"))
+
+# The detected layout and when it was detected
+_detected_layout: Tuple[EmbeddingLayout, float] | None = None
+
+
+def detect_embedding_layout(connection: Session | Connection) -> EmbeddingLayout:
+    """
+    Find which embeddings layout vector search should use
+
+    The VECTOR_TABLE_LAYOUT environment variable can force a layout. Otherwise the denormalized table is used if it exists.
+    The answer is cached in each process for LAYOUT_TTL seconds, set by VECTOR_LAYOUT_TTL, so searches don't each pay for the lookup.
+    build_filtered_embeddings and drop_filtered_embeddings clear the cache of the process they run in.
+    Other processes, e.g. API workers, see the change once their cache expires, so searches can fail for up to LAYOUT_TTL seconds after the table is dropped.
+
+    Parameters
+    ----------
+    connection: Session | Connection
+        A session or connection to the OMOP database
+
+    Returns
+    -------
+    EmbeddingLayout
+        The layout to query
+    """
+    global _detected_layout
+    configured = os.getenv("VECTOR_TABLE_LAYOUT", "auto")
+    if configured != "auto":
+        return EmbeddingLayout(configured)
+    now = time.monotonic()
+    if _detected_layout is None or now - _detected_layout[1] >= LAYOUT_TTL:
+        table = connection.execute(
+            select(func.to_regclass(f'"{DB_SCHEMA}"."{FilteredEmbedding.__tablename__}"'))
+        ).scalar()
+        _detected_layout = (
+            EmbeddingLayout.DENORMALIZED if table is not None else EmbeddingLayout.JOINED,
+            now,
+        )
+    return _detected_layout[0]
+
+
+def reset_embedding_layout() -> None:
+    """
+    Forget the layout detected in this process, so its next search looks for the denormalized table again
+    """
+    global _detected_layout
+    _detected_layout = None
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def build_filtered_embeddings(
+    engine: Engine,
+    method: VectorIndexMethod = VectorIndexMethod.HNSW,
+    metric: DistanceMetric = DistanceMetric.COSINE,
+    mode: RetrievalMode = RetrievalMode.EXACT,
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int | None = None,
+    vocabularies: List[str] | None = None,
+    maintenance_work_mem: str | None = None,
+) -> int:
+    """
+    Build the denormalized embeddings table, replacing it if it exists
+
+    Each embedding is copied with its concept's name, vocabulary_id, domain_id, standard_concept and invalid_reason, so filters are applied to the same rows the nearest neighbour scan reads.
+    The table is list-partitioned by vocabulary_id and the vector index is created on every partition.
+    A search restricted to some vocabularies is pruned to their partitions, whose indexes hold nothing else, so filtered top-k needs no deep scan.
+    The new table is built under a staging name, then swapped in by dropping the old table and renaming it.
+    Everything runs in one transaction, and nothing locks the old table until the swap, so searches keep using it while the new one is copied and indexed.
+
+    Parameters
+    ----------
+    engine: Engine
+        An engine connected to the OMOP database
+    method: VectorIndexMethod
+        HNSW or IVFFlat
+    metric: DistanceMetric
+        The distance metric the index serves
+    mode: RetrievalMode
+        Whether the index holds the full vectors, or a halfvec or binary-quantized copy of them
+    m: int
+        HNSW: the number of links per node
+    ef_construction: int
+        HNSW: the size of the candidate list used while building
+    lists: int | None
+        IVFFlat: the number of lists per partition. If None, it is chosen from the size of the largest partition
+    vocabularies: List[str] | None
+        The vocabularies given their own partition. If None, every vocabulary with embeddings gets one. Others share a default partition
+    maintenance_work_mem: str | None
+        If supplied, e.g. "2GB", sets maintenance_work_mem for the index build
+
+    Returns
+    -------
+    int
+        The number of embeddings copied
+    """
+    table = FilteredEmbedding.__tablename__
+    qualified = f'"{DB_SCHEMA}"."{table}"'
+    staging = f"{table}_staging"
+    staging_qualified = f'"{DB_SCHEMA}"."{staging}"'
+    with engine.begin() as connection:
+        if maintenance_work_mem:
+            connection.execute(
+                select(func.set_config("maintenance_work_mem", maintenance_work_mem, True))
+            )
+        if vocabularies is None:
+            vocabularies = list(
+                connection.execute(
+                    text(
+                        f"""
+                        SELECT DISTINCT c.vocabulary_id
+                        FROM "{DB_SCHEMA}"."{DB_VECTABLE}" e
+                        JOIN "{DB_SCHEMA}".concept c ON c.concept_id = e.concept_id
+                        ORDER BY c.vocabulary_id
+                        """
+                    )
+                ).scalars()
+            )
+        connection.execute(text(f"DROP TABLE IF EXISTS {staging_qualified}"))
+        connection.execute(
+            text(
+                f"""
+                CREATE TABLE {staging_qualified} (
+                    concept_id integer NOT NULL,
+                    vocabulary_id varchar NOT NULL,
+                    concept_name varchar,
+                    domain_id varchar,
+                    standard_concept varchar,
+                    invalid_reason varchar,
+                    embedding vector({DB_VECSIZE})
+                ) PARTITION BY LIST (vocabulary_id)
+                """
+            )
+        )
+        for i, vocabulary in enumerate(vocabularies):
+            connection.execute(
+                text(
+                    f'CREATE TABLE "{DB_SCHEMA}"."{staging}_p{i}" PARTITION OF {staging_qualified} '
+                    f"FOR VALUES IN ({_quote(vocabulary)})"
+                )
+            )
+        connection.execute(
+            text(f'CREATE TABLE "{DB_SCHEMA}"."{staging}_default" PARTITION OF {staging_qualified} DEFAULT')
+        )
+        count = connection.execute(
+            text(
+                f"""
+                INSERT INTO {staging_qualified}
+                    (concept_id, vocabulary_id, concept_name, domain_id, standard_concept, invalid_reason, embedding)
+                SELECT c.concept_id, c.vocabulary_id, c.concept_name, c.domain_id, c.standard_concept, c.invalid_reason, e.embedding
+                FROM "{DB_SCHEMA}"."{DB_VECTABLE}" e
+                JOIN "{DB_SCHEMA}".concept c ON c.concept_id = e.concept_id
+                """
+            )
+        ).rowcount
+        if method == VectorIndexMethod.IVFFLAT and lists is None:
+            largest = connection.execute(
+                text(
+                    f"SELECT count(*) FROM {staging_qualified} GROUP BY vocabulary_id ORDER BY count(*) DESC LIMIT 1"
+                )
+            ).scalar()
+            lists = default_ivfflat_lists(largest or 0)
+        connection.execute(
+            text(
+                create_vector_index_ddl(
+                    method,
+                    metric,
+                    m=m,
+                    ef_construction=ef_construction,
+                    lists=lists or 100,
+                    concurrently=False,
+                    mode=mode,
+                    table=staging,
+                )
+            )
+        )
+        connection.execute(text(f"ANALYZE {staging_qualified}"))
+
+        # The swap takes an exclusive lock on the old table, held only until the commit that follows
+        connection.execute(text(f"DROP TABLE IF EXISTS {qualified}"))
+        connection.execute(text(f'ALTER TABLE {staging_qualified} RENAME TO "{table}"'))
+        for partition in [f"p{i}" for i in range(len(vocabularies))] + ["default"]:
+            connection.execute(
+                text(f'ALTER TABLE "{DB_SCHEMA}"."{staging}_{partition}" RENAME TO "{table}_{partition}"')
+            )
+            # Partition indexes are named after the staging partitions, so are renamed to free those names for the next build
+            partition_index = connection.execute(
+                text(
+                    "SELECT c.relname FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid "
+                    "WHERE x.indrelid = CAST(:partition AS regclass)"
+                ),
+                {"partition": f'"{DB_SCHEMA}"."{table}_{partition}"'},
+            ).scalar_one()
+            connection.execute(
+                text(
+                    f'ALTER INDEX "{DB_SCHEMA}"."{partition_index}" '
+                    f'RENAME TO "{table}_{partition}_embedding_idx"'
+                )
+            )
+        connection.execute(
+            text(
+                f'ALTER INDEX "{DB_SCHEMA}"."{vector_index_name(method, metric, mode, staging)}" '
+                f'RENAME TO "{vector_index_name(method, metric, mode, table)}"'
+            )
+        )
+    reset_embedding_layout()
+    return count
+
+
+def drop_filtered_embeddings(engine: Engine) -> str:
+    """
+    Drop the denormalized embeddings table, so vector search goes back to the joined layout
+    """
+    table = FilteredEmbedding.__tablename__
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP TABLE IF EXISTS "{DB_SCHEMA}"."{table}"'))
+    reset_embedding_layout()
+    return table
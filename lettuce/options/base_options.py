@@ -1,6 +1,10 @@
 import argparse
 from typing import Dict
-from components.embeddings import EmbeddingModelName
+from components.decoding import DecodingMode, SpeculativeDecoding
+from components.llama_runtime import KVCacheType, LlamaRuntimeOptions
+from components.embeddings import EmbeddingModelName, RetrieverBackend
+from omop.omop_queries import CandidateSearch, TextRankFunction
+from omop.vector_index import DistanceMetric, RetrievalMode
 from options.pipeline_options import LLMModel
 
 
@@ -139,6 +143,48 @@ class BaseOptions:
             help="max separation ancestor",
         )
 
+        self._parser.add_argument(
+                "--max-text-candidates",
+                type=int,
+                required=False,
+                default=None,
+                help="The most concepts the full-text search passes to fuzzy matching per name, ranked in the database. Defaults to every match."
+         )
+
+        self._parser.add_argument(
+                "--text-rank-function",
+                type=TextRankFunction,
+                required=False,
+                default=TextRankFunction.TS_RANK,
+                choices=list(TextRankFunction),
+                help="How full-text matches are ranked when --max-text-candidates is set."
+         )
+
+        self._parser.add_argument(
+                "--match-all-words-first",
+                action=argparse.BooleanOptionalAction,
+                required=False,
+                default=False,
+                help="Search for concepts matching every word of a name first, and only for any word if too few are found."
+         )
+
+        self._parser.add_argument(
+                "--min-text-candidates",
+                type=int,
+                required=False,
+                default=10,
+                help="The number of concepts a search for every word must find for its results to be used."
+         )
+
+        self._parser.add_argument(
+                "--candidate-search",
+                type=CandidateSearch,
+                required=False,
+                default=CandidateSearch.FULL_TEXT,
+                choices=list(CandidateSearch),
+                help="Find candidate concepts by full-text search, or by trigram similarity, which also finds misspelt names. Trigram search needs the lettuce-trigram-index indexes."
+         )
+
         self._parser.add_argument(
             "--vector_search",
             action=argparse.BooleanOptionalAction,
@@ -163,8 +209,139 @@ class BaseOptions:
                 help="Number of suggestions to return from vector search for RAG."
          )
 
+        self._parser.add_argument(
+                "--embedding-batch-size",
+                type=int,
+                required=False,
+                default=256,
+                help="Number of informal names embedded per inference call in vector search."
+         )
+
+        self._parser.add_argument(
+                "--retriever-backend",
+                type=RetrieverBackend,
+                required=False,
+                default=None,
+                choices=list(RetrieverBackend),
+                help="Where vector search runs. Defaults to the RETRIEVER_BACKEND environment variable, or pgvector."
+         )
+
+        self._parser.add_argument(
+                "--distance-metric",
+                type=DistanceMetric,
+                required=False,
+                default=None,
+                choices=list(DistanceMetric),
+                help="The metric pgvector ranks concepts by. Defaults to the VECTOR_DISTANCE_METRIC environment variable, or cosine."
+         )
+
+        self._parser.add_argument(
+                "--retrieval-mode",
+                type=RetrievalMode,
+                required=False,
+                default=None,
+                choices=list(RetrievalMode),
+                help="Search the full vectors, or a halfvec or binary-quantized index with an exact rerank. Defaults to the VECTOR_RETRIEVAL_MODE environment variable, or exact."
+         )
+
+        self._parser.add_argument(
+                "--decoding-mode",
+                type=DecodingMode,
+                required=False,
+                default=None,
+                choices=list(DecodingMode),
+                help="Let the LLM reply freely, or constrain replies to a single-line drug name. Defaults to the LLM_DECODING_MODE environment variable, or free."
+         )
+
+        self._parser.add_argument(
+                "--llm-max-tokens",
+                type=int,
+                required=False,
+                default=None,
+                help="The most tokens the LLM generates per reply. Defaults to 128 in free decoding and 24 in constrained decoding."
+         )
+
+        self._parser.add_argument(
+                "--speculative-decoding",
+                type=SpeculativeDecoding,
+                required=False,
+                default=None,
+                choices=list(SpeculativeDecoding),
+                help="How a local LLM drafts tokens to verify in one batch. Defaults to the LLM_SPECULATIVE_DECODING environment variable, or none."
+         )
+
+        # llama.cpp runtime settings. Any left unset come from LLAMA_RUNTIME_PROFILE, then LLAMA_* environment variables, then defaults
+        self._parser.add_argument(
+                "--llm-n-ctx", type=int, required=False, default=None, help="llama.cpp context size"
+         )
+        self._parser.add_argument(
+                "--llm-n-batch", type=int, required=False, default=None, help="llama.cpp prompt processing batch size"
+         )
+        self._parser.add_argument(
+                "--llm-n-gpu-layers",
+                type=int,
+                required=False,
+                default=None,
+                help="Layers offloaded to a GPU, -1 for all. Defaults to all when CUDA or MPS is available"
+         )
+        self._parser.add_argument(
+                "--llm-n-threads", type=int, required=False, default=None, help="Threads used for generation"
+         )
+        self._parser.add_argument(
+                "--llm-n-threads-batch", type=int, required=False, default=None, help="Threads used for prompt processing"
+         )
+        self._parser.add_argument(
+                "--llm-use-mmap",
+                action=argparse.BooleanOptionalAction,
+                default=None,
+                help="Memory-map the weights file rather than reading it into memory"
+         )
+        self._parser.add_argument(
+                "--llm-use-mlock",
+                action=argparse.BooleanOptionalAction,
+                default=None,
+                help="Lock the weights in RAM"
+         )
+        self._parser.add_argument(
+                "--llm-type-k",
+                type=KVCacheType,
+                required=False,
+                default=None,
+                choices=list(KVCacheType),
+                help="Data type of the K cache"
+         )
+        self._parser.add_argument(
+                "--llm-type-v",
+                type=KVCacheType,
+                required=False,
+                default=None,
+                choices=list(KVCacheType),
+                help="Data type of the V cache. Quantized types need flash attention"
+         )
+        self._parser.add_argument(
+                "--llm-flash-attn",
+                action=argparse.BooleanOptionalAction,
+                default=None,
+                help="Use flash attention"
+         )
+
         self._initialized = True
 
+    @staticmethod
+    def llm_runtime(args: argparse.Namespace) -> LlamaRuntimeOptions:
+        """
+        Collect the llama.cpp runtime settings from parsed arguments
+
+        The token budget is set by --llm-max-tokens with the decoding mode, so it isn't collected here.
+        """
+        return LlamaRuntimeOptions(
+            **{
+                field: getattr(args, f"llm_{field}")
+                for field in LlamaRuntimeOptions.model_fields
+                if field != "max_tokens"
+            }
+        )
+
     def parse(self) -> argparse.Namespace:
         """
         Parses the arguments passed to the script
@@ -1,6 +1,10 @@
 from enum import Enum
 from pydantic import BaseModel
-from components.embeddings import EmbeddingModelName
+from components.decoding import DecodingMode, SpeculativeDecoding
+from components.embeddings import EmbeddingModelName, RetrieverBackend
+from components.llama_runtime import LlamaRuntimeOptions
+from omop.omop_queries import CandidateSearch, TextRankFunction
+from omop.vector_index import DistanceMetric, RetrievalMode
 
 
 class LLMModel(str, Enum):
@@ -77,6 +81,54 @@ class PipelineOptions(BaseModel):
 
     max_separation_ancestor: int
         The maximum separation to search for concept ancestors
+
+    max_text_candidates: int | None
+        The most concepts the full-text search passes to fuzzy matching per name, ranked in the database. If None, every match is passed
+
+    text_rank_function: TextRankFunction
+        ts_rank or ts_rank_cd, the function full-text matches are ranked by when max_text_candidates is set
+
+    match_all_words_first: bool (Defaults to false)
+        If true, the full-text search first looks for concepts matching every word of a name, and only for any word if that finds fewer than min_text_candidates
+
+    min_text_candidates: int
+        The number of concepts a search for every word must find for its results to be used
+
+    candidate_search: CandidateSearch
+        full_text or trigram, how candidate concepts are found for fuzzy matching. Trigram search also finds misspelt names, matching at a similarity of half search_threshold
+
+    embeddings_batch_size: int
+        The number of search terms embedded per inference call in vector search
+
+    retriever_backend: RetrieverBackend | None
+        Where vector search runs: pgvector, or an in-process ANN index. If None, the RETRIEVER_BACKEND environment variable decides
+
+    hnsw_ef_search: int | None
+        hnsw.ef_search for pgvector queries. Higher values raise recall at the cost of latency. If None, the server default is used
+
+    ivfflat_probes: int | None
+        ivfflat.probes for pgvector queries. Higher values raise recall at the cost of latency. If None, the server default is used
+
+    distance_metric: DistanceMetric | None
+        The metric pgvector ranks concepts by: cosine, inner_product or l2. Inner product is cheapest for the normalized embeddings our models produce. Scores are reported as cosine distance whichever is used. If None, the VECTOR_DISTANCE_METRIC environment variable decides
+
+    retrieval_mode: RetrievalMode | None
+        exact searches the full vectors. halfvec and binary search a compact index built with lettuce-vector-index --mode, then rerank by exact distance. If None, the VECTOR_RETRIEVAL_MODE environment variable decides
+
+    decoding_mode: DecodingMode | None
+        free lets the LLM reply with anything. constrained limits replies to a single line holding a drug name, with a GBNF grammar for local models and stop sequences for all. vocabulary limits local models to the exact name of a concept in embed_vocab. If None, the LLM_DECODING_MODE environment variable decides
+
+    llm_max_tokens: int | None
+        The most tokens the LLM generates per reply. If None, the decoding mode's default is used: 128 for free, 24 for constrained, 48 for vocabulary
+
+    grammar_concept_class: list[str] | None
+        In vocabulary decoding, only names of concepts in these classes, e.g. Ingredient, are allowed. If None, concepts of every class in embed_vocab are allowed
+
+    speculative_decoding: SpeculativeDecoding | None
+        How a local LLM drafts tokens to verify in one batch: none, prompt_lookup, or draft_model. prompt_lookup copies continuations from the prompt, which suits the RAG prompt. draft_model uses a smaller model with the same vocabulary. If None, the LLM_SPECULATIVE_DECODING environment variable decides
+
+    llm_runtime: LlamaRuntimeOptions | None
+        llama.cpp settings for a local LLM: context and batch sizes, GPU layers, threads, mmap/mlock, KV cache types and flash attention. Settings left out come from the LLAMA_RUNTIME_PROFILE file written by lettuce-autotune-llama, then LLAMA_* environment variables, then defaults
     """
 
     llm_model: LLMModel = LLMModel.LLAMA_3_1_8B
@@ -89,8 +141,24 @@ class PipelineOptions(BaseModel):
     search_threshold: int = 80
     max_separation_descendants: int = 1
     max_separation_ancestor: int = 1
+    max_text_candidates: int | None = None
+    text_rank_function: TextRankFunction = TextRankFunction.TS_RANK
+    match_all_words_first: bool = False
+    min_text_candidates: int = 10
+    candidate_search: CandidateSearch = CandidateSearch.FULL_TEXT
     embeddings_path: str = "concept_embeddings.qdrant"
     force_rebuild: bool = False
     embed_vocab: list[str] = ["RxNorm", "RxNorm Extension"]
     embedding_model: EmbeddingModelName = EmbeddingModelName.BGESMALL
     embeddings_top_k: int = 5
+    embeddings_batch_size: int = 256
+    retriever_backend: RetrieverBackend | None = None
+    hnsw_ef_search: int | None = None
+    ivfflat_probes: int | None = None
+    distance_metric: DistanceMetric | None = None
+    retrieval_mode: RetrievalMode | None = None
+    decoding_mode: DecodingMode | None = None
+    llm_max_tokens: int | None = None
+    grammar_concept_class: list[str] | None = None
+    speculative_decoding: SpeculativeDecoding | None = None
+    llm_runtime: LlamaRuntimeOptions | None = None
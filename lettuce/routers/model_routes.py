@@ -0,0 +1,87 @@
+import os
+from typing import Any, Dict, List
+
+from fastapi import APIRouter
+
+from api_models.requests import ModelPoolRequest
+from components.executor import inference_executor
+from components.llama_runtime import resolve_runtime
+from components.model_pool import ModelKey, llm_batcher, llm_pool, temperature_profile
+from components.response_cache import llm_response_cache
+
+router = APIRouter()
+
+
+def _key(request: ModelPoolRequest) -> ModelKey:
+    runtime = resolve_runtime(request.llm_runtime)
+    return ModelKey(
+        model=request.llm_model,
+        weights_path=request.weights_path or os.getenv("LOCAL_LLM"),
+        n_ctx=request.n_ctx or runtime.n_ctx,
+        n_batch=request.n_batch or runtime.n_batch,
+        temperature_profile=temperature_profile(request.temperature),
+        speculative_decoding=request.speculative_decoding,
+        runtime=runtime.load_settings(),
+    )
+
+
+@router.get("/")
+async def list_models() -> List[Dict[str, Any]]:
+    """
+    List the models loaded in the LLM model pool, least recently used first
+    """
+    return llm_pool.loaded()
+
+
+@router.post("/load")
+async def load_model(request: ModelPoolRequest) -> List[Dict[str, Any]]:
+    """
+    Load a model into the pool ahead of the requests that will use it
+    """
+    await inference_executor.run(llm_pool.get, _key(request))
+    return llm_pool.loaded()
+
+
+@router.post("/reload")
+async def reload_model(request: ModelPoolRequest) -> List[Dict[str, Any]]:
+    """
+    Swap in a freshly loaded instance of a model, e.g. after replacing its weights file
+
+    Requests in progress finish on the old instance.
+    """
+    await inference_executor.run(llm_pool.reload, _key(request))
+    return llm_pool.loaded()
+
+
+@router.post("/unload")
+async def unload_model(request: ModelPoolRequest) -> List[Dict[str, Any]]:
+    """
+    Unload a model from the pool once its current request finishes
+    """
+    await inference_executor.run(llm_pool.unload, _key(request))
+    return llm_pool.loaded()
+
+
+@router.get("/batching")
+async def batching_stats() -> Dict[str, Any]:
+    """
+    Report the LLM micro-batching settings, with histograms of queue depth and batch size
+    """
+    return llm_batcher.stats()
+
+
+@router.get("/response-cache")
+async def response_cache_stats() -> Dict[str, float]:
+    """
+    Report hits, misses and the hit rate of the LLM response cache
+    """
+    return llm_response_cache.stats()
+
+
+@router.delete("/response-cache")
+async def clear_response_cache() -> Dict[str, float]:
+    """
+    Empty the LLM response cache, e.g. after changing a model's weights file without renaming it
+    """
+    llm_response_cache.clear()
+    return llm_response_cache.stats()
@@ -1,5 +1,5 @@
 from os import pipe
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, status
 from collections.abc import AsyncGenerator
 import json
 from typing import List, Dict, Any
@@ -10,7 +10,9 @@ from sse_starlette.sse import EventSourceResponse
 
 import assistant
 from omop.omop_match import OMOPMatcher
+from components.decoding import DecodingMode, resolve_decoding_mode
 from components.embeddings import Embeddings
+from components.executor import QueueFullError, database_executor, inference_executor
 from components.pipeline import LLMPipeline
 from options.pipeline_options import PipelineOptions
 from utils.logging_utils import logger
@@ -34,6 +36,17 @@ class PipelineRequest(BaseModel):
     pipeline_options: PipelineOptions = Field(default_factory=PipelineOptions)
 
 
+def _check_decoding_options(pipeline_opts: PipelineOptions) -> None:
+    """
+    Reject vocabulary decoding without a vocabulary with a 400, as ai_search does, rather than failing while the grammar is built
+    """
+    if resolve_decoding_mode(pipeline_opts.decoding_mode) == DecodingMode.VOCABULARY and not pipeline_opts.embed_vocab:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Vocabulary decoding needs at least one vocabulary",
+        )
+
+
 async def generate_events(request: PipelineRequest) -> AsyncGenerator[str]:
     """
     Generate LLM output and OMOP results for a list of informal names
@@ -68,6 +81,7 @@ async def generate_events(request: PipelineRequest) -> AsyncGenerator[str]:
         JSON encoded strings of the event results. Two types are yielded:
         1. "llm_output": The result from the language model processing.
         2. "omop_output": The result from the OMOP database matching.
+        If the inference or database queue is full, a single "error" event is yielded instead.
     """
     informal_names = request.names
 
@@ -76,12 +90,23 @@ async def generate_events(request: PipelineRequest) -> AsyncGenerator[str]:
     # Use LLM to find the formal name and query OMOP for the LLM output
     pipeline_opts = request.pipeline_options
 
-    llm_outputs = assistant.run(
-        llm_model=pipeline_opts.llm_model,
-        temperature=pipeline_opts.temperature,
-        informal_names=informal_names,
-        logger=logger,
-    )
+    try:
+        llm_outputs = await inference_executor.run(
+            assistant.run,
+            llm_model=pipeline_opts.llm_model,
+            temperature=pipeline_opts.temperature,
+            informal_names=informal_names,
+            logger=logger,
+            decoding_mode=pipeline_opts.decoding_mode,
+            max_tokens=pipeline_opts.llm_max_tokens,
+            embed_vocab=pipeline_opts.embed_vocab,
+            grammar_concept_class=pipeline_opts.grammar_concept_class,
+            speculative_decoding=pipeline_opts.speculative_decoding,
+            llm_runtime=pipeline_opts.llm_runtime,
+        )
+    except QueueFullError as e:
+        yield json.dumps({"event": "error", "data": str(e)})
+        return
     for llm_output in llm_outputs:
 
         logger.info(
@@ -93,7 +118,7 @@ async def generate_events(request: PipelineRequest) -> AsyncGenerator[str]:
         output = {"event": "llm_output", "data": llm_output}
         yield json.dumps(output)
 
-    omop_output = OMOPMatcher(
+    matcher = OMOPMatcher(
         logger, 
         vocabulary_id=pipeline_opts.vocabulary_id,
         standard_concept=pipeline_opts.standard_concept,
@@ -102,8 +127,20 @@ async def generate_events(request: PipelineRequest) -> AsyncGenerator[str]:
         concept_synonym=pipeline_opts.concept_synonym,
         search_threshold=pipeline_opts.search_threshold,
         max_separation_descendant=pipeline_opts.max_separation_descendants,
-        max_separation_ancestor=pipeline_opts.max_separation_ancestor
-    ).run(search_terms=[llm_output["reply"] for llm_output in llm_outputs])
+        max_separation_ancestor=pipeline_opts.max_separation_ancestor,
+        max_candidates=pipeline_opts.max_text_candidates,
+        rank_function=pipeline_opts.text_rank_function,
+        match_all_words_first=pipeline_opts.match_all_words_first,
+        min_candidates=pipeline_opts.min_text_candidates,
+        candidate_search=pipeline_opts.candidate_search,
+    )
+    try:
+        omop_output = await database_executor.run(
+            matcher.run, search_terms=[llm_output["reply"] for llm_output in llm_outputs]
+        )
+    except QueueFullError as e:
+        yield json.dumps({"event": "error", "data": str(e)})
+        return
 
     output = [{"event": "omop_output", "data": result} for result in omop_output]
     yield json.dumps(output)
@@ -123,6 +160,8 @@ async def run_pipeline(request: PipelineRequest) -> EventSourceResponse:
     EventSourceResponse
         The response containing the events
     """
+    # Checked before the response starts streaming, so the error is a status code rather than an event
+    _check_decoding_options(request.pipeline_options)
     return EventSourceResponse(generate_events(request))
 
 
@@ -146,7 +185,7 @@ async def run_db(request: PipelineRequest) -> List[Dict[str, Any]]:
     search_terms = request.names
     pipeline_opts = request.pipeline_options
 
-    omop_output = OMOPMatcher(
+    matcher = OMOPMatcher(
         logger, 
         vocabulary_id=pipeline_opts.vocabulary_id,
         standard_concept=pipeline_opts.standard_concept,
@@ -155,8 +194,14 @@ async def run_db(request: PipelineRequest) -> List[Dict[str, Any]]:
         concept_synonym=pipeline_opts.concept_synonym,
         search_threshold=pipeline_opts.search_threshold,
         max_separation_descendant=pipeline_opts.max_separation_descendants,
-        max_separation_ancestor=pipeline_opts.max_separation_ancestor
-    ).run(search_terms=search_terms)
+        max_separation_ancestor=pipeline_opts.max_separation_ancestor,
+        max_candidates=pipeline_opts.max_text_candidates,
+        rank_function=pipeline_opts.text_rank_function,
+        match_all_words_first=pipeline_opts.match_all_words_first,
+        min_candidates=pipeline_opts.min_text_candidates,
+        candidate_search=pipeline_opts.candidate_search,
+    )
+    omop_output = await database_executor.run(matcher.run, search_terms=search_terms)
     return [{"event": "omop_output", "content": result} for result in omop_output]
 
 
@@ -166,7 +211,7 @@ async def run_vector_search(request: PipelineRequest):
     Search a vector database for a name
 
     Default options can be overridden by pipeline_options
-    A warning: if you don't have a vector database set up under the embeddings_path, this method will build one for you. This takes a while, an hour using 2.8 GHz intel I7, 16 Gb RAM.
+    The embeddings table must already be built. lettuce-build-embeddings builds it, and refreshes it after a vocabulary release by embedding only new or changed concepts.
 
     Parameters
     ----------
@@ -184,8 +229,17 @@ async def run_vector_search(request: PipelineRequest):
         model_name=request.pipeline_options.embedding_model,
         standard_concept=request.pipeline_options.standard_concept,
         top_k=request.pipeline_options.embeddings_top_k,
+        batch_size=request.pipeline_options.embeddings_batch_size,
+        retriever_backend=request.pipeline_options.retriever_backend,
+        ef_search=request.pipeline_options.hnsw_ef_search,
+        probes=request.pipeline_options.ivfflat_probes,
+        distance_metric=request.pipeline_options.distance_metric,
+        retrieval_mode=request.pipeline_options.retrieval_mode,
     )
-    return {"event": "vector_search_output", "content": embeddings.search(search_terms)}
+    return {
+        "event": "vector_search_output",
+        "content": await inference_executor.run(embeddings.search, search_terms),
+    }
 
 
 @router.post("/vector_llm")
@@ -206,8 +260,10 @@ async def vector_llm_pipeline(request: PipelineRequest) -> List:
     list
     """
     informal_names = request.names
+    _check_decoding_options(request.pipeline_options)
 
-    pl = LLMPipeline(
+    # Building the pipeline may read concept names for a vocabulary grammar
+    pl = await inference_executor.run(LLMPipeline(
         llm_model=request.pipeline_options.llm_model,
         temperature=request.pipeline_options.temperature,
         embed_vocab=request.pipeline_options.embed_vocab,
@@ -215,9 +271,19 @@ async def vector_llm_pipeline(request: PipelineRequest) -> List:
         logger=logger,
         standard_concept=request.pipeline_options.standard_concept,
         top_k=request.pipeline_options.embeddings_top_k,
-    ).get_rag_assistant()
+        retriever_backend=request.pipeline_options.retriever_backend,
+        ef_search=request.pipeline_options.hnsw_ef_search,
+        probes=request.pipeline_options.ivfflat_probes,
+        distance_metric=request.pipeline_options.distance_metric,
+        retrieval_mode=request.pipeline_options.retrieval_mode,
+        decoding_mode=request.pipeline_options.decoding_mode,
+        max_tokens=request.pipeline_options.llm_max_tokens,
+        grammar_concept_class=request.pipeline_options.grammar_concept_class,
+        speculative_decoding=request.pipeline_options.speculative_decoding,
+        llm_runtime=request.pipeline_options.llm_runtime,
+    ).get_rag_assistant)
     start = time.time()
-    pl.warm_up()
+    await inference_executor.run(pl.warm_up)
     logger.info(f"Pipeline warmup in {time.time()-start} seconds")
 
     results = []
@@ -225,7 +291,8 @@ async def vector_llm_pipeline(request: PipelineRequest) -> List:
 
     for informal_name in informal_names:
         start = time.time()
-        res = pl.run(
+        res = await inference_executor.run(
+            pl.run,
             {
                 "query_embedder": {"text": informal_name},
                 "prompt": {"informal_name": informal_name},
@@ -242,6 +309,10 @@ async def vector_llm_pipeline(request: PipelineRequest) -> List:
             }
             if "llm" in result.keys():
                 output["llm_output"] = result["llm"]["replies"][0].strip()
+                output["prompt_tokens_reused"] = result["llm"]["meta"][0].get(
+                    "prompt_tokens_reused", 0
+                )
+                output["cache_hit"] = result["llm"]["meta"][0].get("cache_hit", False)
             output["vector_search_output"] = [
                 {"content": doc.content, "score": doc.score}
                 for doc in result["retriever"]["documents"]
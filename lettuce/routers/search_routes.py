@@ -1,16 +1,38 @@
 from typing import Annotated, List
 from components.embeddings import EmbeddingModelName, Embeddings
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, HTTPException, Query, status
 
 from api_models.responses import ConceptSuggestionResponse, Suggestion, SuggestionsMetaData
+from components.decoding import DecodingMode, resolve_decoding_mode
+from components.executor import database_executor, inference_executor
 from components.pipeline import LLMPipeline
 from omop.db_manager import get_session
-from omop.omop_queries import count_concepts, query_ids_matching_name, ts_rank_query
+from omop.omop_queries import count_concepts, query_ids_matching_name, trigram_rank_query, ts_rank_query
+from omop.trigram_index import apply_trigram_threshold, trigram_threshold
+from omop.vector_index import DistanceMetric, RetrievalMode
 from options.pipeline_options import LLMModel
 from utils.logging_utils import logger
 
 router = APIRouter()
 
+
+def _fetch_all(query):
+    with get_session() as session:
+        return session.execute(query).fetchall()
+
+
+def _fetch_trigram_matches(query, threshold: float):
+    # The threshold is only set for this session's transaction, so it must run on the same session
+    with get_session() as session:
+        apply_trigram_threshold(session, threshold)
+        return session.execute(query).fetchall()
+
+
+def _retrieve(embedding_handler: Embeddings, embedding: List[float]):
+    # Building a retriever can query the database or read an ANN index, so it runs on the executor too
+    return embedding_handler.get_retriever().run(embedding, describe_concept=True)
+
+
 @router.get("/")
 def check_db():
     with get_session() as session:
@@ -37,8 +59,7 @@ async def text_search(
             valid_concept=valid_concept,
             top_k=top_k,
             )
-    with get_session() as session:
-        results = session.execute(query).fetchall()
+    results = await database_executor.run(_fetch_all, query)
 
     metadata = SuggestionsMetaData(pipeline="Full-text search")
     response = ConceptSuggestionResponse(
@@ -60,6 +81,53 @@ async def text_search(
             )
     return response
 
+@router.get("/trigram-search/{search_term}")
+async def trigram_search(
+        search_term: str,
+        vocabulary: Annotated[List[str] | None, Query()]=None,
+        domain: Annotated[List[str] | None, Query()]=None,
+        standard_concept: bool=True,
+        valid_concept: bool=True,
+        concept_synonym: bool=True,
+        top_k: Annotated[int, Query(title="The number of responses to fetch", ge=1)]=5,
+        search_threshold: Annotated[int, Query(title="The fuzzy match threshold the trigram similarity threshold is derived from", ge=0, le=100)]=80,
+        ) -> ConceptSuggestionResponse:
+    """
+    Suggest the concepts whose names, or synonyms, are most similar to a search term by pg_trgm trigram similarity
+
+    Unlike text search, this finds concepts for misspelt terms. Names match at a similarity of half search_threshold, as in OMOPMatcher's trigram candidate search.
+    """
+    query = trigram_rank_query(
+            search_term=search_term,
+            vocabulary_id=vocabulary,
+            domain_id=domain,
+            standard_concept=standard_concept,
+            valid_concept=valid_concept,
+            top_k=top_k,
+            concept_synonym=concept_synonym,
+            )
+    results = await database_executor.run(
+            _fetch_trigram_matches, query, trigram_threshold(search_threshold)
+            )
+
+    return ConceptSuggestionResponse(
+            recommendations=[
+                Suggestion(
+                    conceptName=r.concept_name,
+                    conceptId=r.concept_id,
+                    conceptCode=r.concept_code,
+                    domain=r.domain_id,
+                    vocabulary=r.vocabulary_id,
+                    conceptClass=r.concept_class_id,
+                    standard_concept=r.standard_concept,
+                    invalid_reason=r.invalid_reason,
+                    ranks={"trigram_search": i+1},
+                    scores={"trigram_search": r.similarity},
+                    ) for i, r in enumerate(results)
+                ],
+            metadata=SuggestionsMetaData(pipeline="Trigram search")
+            )
+
 @router.get("/vector-search/{search_term}")
 async def vector_search(
         search_term: str,
@@ -68,6 +136,10 @@ async def vector_search(
         standard_concept: bool=True,
         valid_concept: bool=False,
         top_k: Annotated[int, Query(title="The number of responses to fetch", ge=1)]=5,
+        ef_search: Annotated[int | None, Query(title="hnsw.ef_search for this query", ge=1)]=None,
+        probes: Annotated[int | None, Query(title="ivfflat.probes for this query", ge=1)]=None,
+        distance_metric: DistanceMetric | None = None,
+        retrieval_mode: RetrievalMode | None = None,
         ) -> ConceptSuggestionResponse:
     embedding_handler = Embeddings(
             model_name=EmbeddingModelName.BGESMALL,
@@ -75,12 +147,17 @@ async def vector_search(
             domain_id=domain,
             standard_concept=standard_concept,
             valid_concept=valid_concept,
-            top_k=top_k
+            top_k=top_k,
+            ef_search=ef_search,
+            probes=probes,
+            distance_metric=distance_metric,
+            retrieval_mode=retrieval_mode,
             )
     embedder = embedding_handler.get_embedder()
-    embedding = embedder.run(search_term)
-    retriever = embedding_handler.get_retriever()
-    result = retriever.run(embedding["embedding"], describe_concept=True)
+    embedding = await inference_executor.run(embedder.run, search_term)
+    result = await database_executor.run(
+            _retrieve, embedding_handler, embedding["embedding"]
+            )
     return ConceptSuggestionResponse(
             recommendations=[
                 Suggestion(
@@ -109,15 +186,33 @@ async def ai_search(
         standard_concept: bool=True,
         valid_concept: bool=False,
         top_k: Annotated[int, Query(title="The number of responses to fetch", ge=1)]=5,
+        decoding_mode: DecodingMode | None = None,
+        concept_class: Annotated[List[str] | None, Query()]=None,
         ) -> ConceptSuggestionResponse:
-    assistant = LLMPipeline(
+    """
+    Suggest concepts for a search term with the RAG pipeline
+
+    In vocabulary decoding, the LLM can only reply with the name of a concept in the requested vocabularies and concept classes, so the reply resolves with one exact lookup.
+    """
+    decoding_mode = resolve_decoding_mode(decoding_mode)
+    if decoding_mode == DecodingMode.VOCABULARY and not vocabulary:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Vocabulary decoding needs at least one vocabulary",
+        )
+    assistant = await inference_executor.run(LLMPipeline(
             llm_model=LLMModel.LLAMA_3_1_8B,
             temperature=0,
             logger=logger,
             embed_vocab=vocabulary,
             standard_concept=standard_concept,
-            ).get_rag_assistant()
-    answer = assistant.run({"prompt": {"informal_name": search_term}, "query_embedder": {"text": search_term}})
+            decoding_mode=decoding_mode,
+            grammar_concept_class=concept_class,
+            ).get_rag_assistant)
+    answer = await inference_executor.run(
+            assistant.run,
+            {"prompt": {"informal_name": search_term}, "query_embedder": {"text": search_term}},
+            )
     reply = answer["llm"]["replies"][0].strip()
     meta = answer["llm"]["meta"]
     logger.info(f"Reply: {reply}")
@@ -125,7 +220,8 @@ async def ai_search(
     query = query_ids_matching_name(
             query_concept=reply,
             vocabulary_ids=vocabulary,
-            full_concept=True
+            full_concept=True,
+            exact_case=decoding_mode == DecodingMode.VOCABULARY,
             )
     metadata = SuggestionsMetaData(
             pipeline="LLM RAG pipeline",
@@ -134,8 +230,7 @@ async def ai_search(
                 "LLM reply": reply,
                 }
             )
-    with get_session() as session:
-        results = session.execute(query).fetchall()
+    results = await database_executor.run(_fetch_all, query)
     if len(results) == 0:
         ts_query = ts_rank_query(
                 search_term=reply,
@@ -145,8 +240,7 @@ async def ai_search(
                 valid_concept=valid_concept,
                 top_k=top_k,
                 )
-        with get_session() as session:
-            results = session.execute(ts_query).fetchall()
+        results = await database_executor.run(_fetch_all, ts_query)
         response = ConceptSuggestionResponse(
             recommendations=[
                 Suggestion(
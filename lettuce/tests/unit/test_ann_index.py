@@ -0,0 +1,96 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from components.ann_index import (
+    ANNIndex,
+    ANNVectorQuery,
+    CATEGORIES_FILE,
+    METADATA_FILE,
+    VECTORS_FILE,
+)
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    """
+    Write a small exported index: four concepts along the axes of a 3-d space
+    """
+    vectors = np.array(
+        [
+            [1.0, 0.0, 0.0],
+            [0.9, 0.1, 0.0],
+            [0.0, 1.0, 0.0],
+            [0.0, 0.0, 1.0],
+        ],
+        dtype=np.float32,
+    )
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.save(os.path.join(tmp_path, VECTORS_FILE), vectors.astype(np.float16))
+    np.savez(
+        os.path.join(tmp_path, METADATA_FILE),
+        concept_ids=np.array([10, 11, 12, 13]),
+        concept_names=np.array(["Aspirin", "Aspirin 100 MG", "Ibuprofen", "Headache"], dtype=object),
+        vocabulary_codes=np.array([0, 1, 0, 2]),
+        domain_codes=np.array([0, 0, 0, 1]),
+        standard=np.array([True, False, True, True]),
+        valid=np.array([True, True, False, True]),
+    )
+    with open(os.path.join(tmp_path, CATEGORIES_FILE), "w") as f:
+        json.dump(
+            {
+                "vocabulary_id": {"RxNorm": 0, "RxNorm Extension": 1, "SNOMED": 2},
+                "domain_id": {"Drug": 0, "Condition": 1},
+            },
+            f,
+        )
+    return str(tmp_path)
+
+
+class TestANNIndex:
+    def test_nearest_first_with_cosine_distance(self, index_dir):
+        index = ANNIndex(index_dir)
+        hits = index.search([[1.0, 0.0, 0.0]], k=2)[0]
+
+        assert [index.concept_ids[row] for row, _ in hits] == [10, 11]
+        assert hits[0][1] == pytest.approx(0.0, abs=1e-3)
+        assert hits[0][1] <= hits[1][1]
+
+    def test_filters(self, index_dir):
+        index = ANNIndex(index_dir)
+
+        hits = index.search([[1.0, 0.0, 0.0]], k=2, embed_vocab=["RxNorm Extension"])[0]
+        assert [index.concept_ids[row] for row, _ in hits] == [11]
+
+        hits = index.search([[1.0, 0.0, 0.0]], k=4, standard_concept=True, valid_concept=True)[0]
+        assert [index.concept_ids[row] for row, _ in hits] == [10, 13]
+
+        hits = index.search([[1.0, 0.0, 0.0]], k=4, domain_id=["Condition"])[0]
+        assert [index.concept_ids[row] for row, _ in hits] == [13]
+
+    def test_unknown_vocabulary_returns_nothing(self, index_dir):
+        index = ANNIndex(index_dir)
+        assert index.search([[1.0, 0.0, 0.0]], k=2, embed_vocab=["ICD10"]) == [[]]
+
+    def test_chunked_exact_search_matches_single_chunk(self, index_dir):
+        whole = ANNIndex(index_dir).search([[0.2, 0.9, 0.1]], k=3)
+        chunked = ANNIndex(index_dir, chunk_size=1).search([[0.2, 0.9, 0.1]], k=3)
+
+        assert [row for row, _ in whole[0]] == [row for row, _ in chunked[0]]
+
+
+class TestANNVectorQuery:
+    def test_run_batch(self, index_dir):
+        retriever = ANNVectorQuery(ANNIndex(index_dir), top_k=1)
+        documents = retriever.run_batch(np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]))["documents"]
+
+        assert [docs[0].content for docs in documents] == ["Aspirin", "Ibuprofen"]
+        assert documents[0][0].id == "10"
+
+    def test_run(self, index_dir):
+        retriever = ANNVectorQuery(ANNIndex(index_dir), top_k=2, embed_vocab=["SNOMED"])
+        result = retriever.run([0.0, 0.0, 1.0])
+
+        assert [doc.content for doc in result["documents"]] == ["Headache"]
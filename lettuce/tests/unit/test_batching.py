@@ -0,0 +1,107 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from components.batched_decoding import _shared_prefix, plan_batches
+from utils.batching import MicroBatcher
+
+
+def run_concurrently(batcher, items, run_batch, group="group"):
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        futures = [pool.submit(batcher.submit, group, item, run_batch) for item in items]
+        return [future.result() for future in futures]
+
+
+class TestMicroBatcher:
+    def test_concurrent_calls_share_a_batch(self):
+        batcher = MicroBatcher(max_batch_size=4, max_wait_ms=500)
+        batches = []
+
+        def run_batch(items):
+            batches.append(list(items))
+            return [item * 2 for item in items]
+
+        results = run_concurrently(batcher, [1, 2, 3, 4], run_batch)
+
+        assert results == [2, 4, 6, 8]
+        assert len(batches) == 1
+        assert sorted(batches[0]) == [1, 2, 3, 4]
+        assert batcher.stats()["batch_size"]["buckets"]["4"] == 1
+
+    def test_full_batches_leave_the_rest_for_the_next(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=200)
+        sizes = []
+
+        def run_batch(items):
+            sizes.append(len(items))
+            return list(items)
+
+        results = run_concurrently(batcher, list(range(5)), run_batch)
+
+        assert results == list(range(5))
+        assert sum(sizes) == 5
+        assert max(sizes) <= 2
+
+    def test_groups_are_batched_separately(self):
+        batcher = MicroBatcher(max_batch_size=4, max_wait_ms=50)
+        batches = []
+        lock = threading.Lock()
+
+        def run_batch(items):
+            with lock:
+                batches.append(sorted(items))
+            return list(items)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [
+                pool.submit(batcher.submit, item % 2, item, run_batch) for item in range(4)
+            ]
+            assert [future.result() for future in futures] == [0, 1, 2, 3]
+
+        assert all(len({item % 2 for item in batch}) == 1 for batch in batches)
+
+    def test_errors_go_to_their_caller(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=500)
+
+        def run_batch(items):
+            return [ValueError("too long") if item == "bad" else item for item in items]
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            good = pool.submit(batcher.submit, "group", "good", run_batch)
+            bad = pool.submit(batcher.submit, "group", "bad", run_batch)
+            assert good.result() == "good"
+            with pytest.raises(ValueError):
+                bad.result()
+
+    def test_batch_failure_raised_to_every_caller(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=500)
+
+        def run_batch(items):
+            raise RuntimeError("llama_decode returned 1")
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(batcher.submit, "group", item, run_batch) for item in range(2)]
+            for future in futures:
+                with pytest.raises(RuntimeError):
+                    future.result()
+
+    def test_disabled_runs_alone(self):
+        batcher = MicroBatcher(max_batch_size=1, max_wait_ms=500)
+
+        assert not batcher.enabled
+        assert batcher.submit("group", 3, lambda items: [item + 1 for item in items]) == 4
+
+
+class TestBatchPlanning:
+    def test_shared_prefix_leaves_a_token(self):
+        assert _shared_prefix([[1, 2, 3, 4], [1, 2, 3, 5]]) == 3
+        assert _shared_prefix([[1, 2, 3], [1, 2, 3]]) == 2
+        assert _shared_prefix([[1, 2], [3, 4]]) == 0
+
+    def test_groups_fit_the_context(self):
+        prompts = [[1, 2, 3, 10 + i] for i in range(4)]
+
+        # 3 shared cells, then 1 prompt cell and 10 generated cells per sequence
+        assert plan_batches(prompts, max_tokens=10, n_ctx=40, n_batch=32) == [[0, 1, 2], [3]]
+        assert plan_batches(prompts, max_tokens=10, n_ctx=1024, n_batch=2) == [[0, 1], [2, 3]]
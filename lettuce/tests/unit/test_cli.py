@@ -47,9 +47,31 @@ def mock_args():
         'concept_synonym': False,
         'max_separation_descendants': None,
         'max_separation_ancestor': None,
+        'max_text_candidates': None,
+        'text_rank_function': 'ts_rank',
+        'match_all_words_first': False,
+        'min_text_candidates': 10,
+        'candidate_search': 'full_text',
         'embed_vocab': None,
         'standard_concept': False,
         'embedding_top_k': 5,
+        'embedding_batch_size': 256,
+        'retriever_backend': None,
+        'distance_metric': None,
+        'retrieval_mode': None,
+        'decoding_mode': None,
+        'llm_max_tokens': None,
+        'speculative_decoding': None,
+        'llm_n_ctx': None,
+        'llm_n_batch': None,
+        'llm_n_gpu_layers': None,
+        'llm_n_threads': None,
+        'llm_n_threads_batch': None,
+        'llm_use_mmap': None,
+        'llm_use_mlock': None,
+        'llm_type_k': None,
+        'llm_type_v': None,
+        'llm_flash_attn': None,
     }
 
 @pytest.fixture
@@ -0,0 +1,129 @@
+import re
+from unittest.mock import Mock, patch
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from llama_cpp import LlamaGrammar
+
+from components.decoding import (
+    FORMAL_NAME_GRAMMAR,
+    DecodingMode,
+    decoding_kwargs,
+    resolve_decoding_mode,
+)
+from components.pipeline import LLMPipeline
+from options.pipeline_options import LLMModel
+from routers import pipeline_routes
+
+
+def test_free_decoding_only_sets_budget():
+    assert decoding_kwargs(DecodingMode.FREE) == {"max_tokens": 128}
+    assert decoding_kwargs(DecodingMode.FREE, max_tokens=64) == {"max_tokens": 64}
+
+
+def test_constrained_decoding_sets_grammar_and_stops():
+    kwargs = decoding_kwargs(DecodingMode.CONSTRAINED, eot_token="<|eot_id|>")
+
+    assert kwargs["max_tokens"] == 24
+    assert kwargs["grammar"] == FORMAL_NAME_GRAMMAR
+    assert "\n" in kwargs["stop"]
+    assert "<|eot_id|>" in kwargs["stop"]
+
+
+def test_constrained_decoding_without_grammar_support():
+    kwargs = decoding_kwargs(DecodingMode.CONSTRAINED, max_tokens=8, grammar=False)
+
+    assert kwargs["max_tokens"] == 8
+    assert "grammar" not in kwargs
+    assert "\n" in kwargs["stop"]
+
+
+def test_mode_from_environment(monkeypatch):
+    monkeypatch.setenv("LLM_DECODING_MODE", "constrained")
+
+    assert resolve_decoding_mode(None) == DecodingMode.CONSTRAINED
+    assert resolve_decoding_mode(DecodingMode.FREE) == DecodingMode.FREE
+
+
+def test_grammar_parses():
+    assert LlamaGrammar.from_string(FORMAL_NAME_GRAMMAR, verbose=False) is not None
+
+
+def name_pattern() -> re.Pattern:
+    """
+    The grammar's name rule as a regular expression. Its character classes are valid in both
+    """
+    rule = FORMAL_NAME_GRAMMAR.split("name ::=")[1].strip()
+    first, rest = re.findall(r"\[[^\]]*\]", rule)
+    return re.compile(first + rest + "*")
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "Acetaminophen 325 MG Oral Tablet [Tylenol]",
+        "Insulin, Regular, Human 100 UNT/ML Injectable Solution [Humulin R]",
+        "Sjögren's syndrome",
+        "Ménière's disease",
+        "Hepatitis B virus surface Ag [Presence] in Serum",
+        "Body temperature:Temp:Pt:Body:Qn",
+        "Vitamin D3 1,000 UNIT Oral Capsule",
+        "5-HT3 antagonist",
+    ],
+)
+def test_grammar_accepts_concept_names(name):
+    assert name_pattern().fullmatch(name)
+
+
+@pytest.mark.parametrize("reply", [" Acetaminophen", "Acetaminophen\nResponse: Aspirin", ""])
+def test_grammar_rejects_more_than_one_name(reply):
+    assert not name_pattern().fullmatch(reply)
+
+
+def test_free_decoding_sends_openai_models_no_limit(monkeypatch):
+    monkeypatch.delenv("LOCAL_LLM", raising=False)
+    with patch("components.pipeline.get_model"):
+        free = LLMPipeline(LLMModel.GPT_4, 0, Mock(), decoding_mode=DecodingMode.FREE)._get_llm()
+        limited = LLMPipeline(
+            LLMModel.GPT_4, 0, Mock(), decoding_mode=DecodingMode.FREE, max_tokens=64
+        )._get_llm()
+        constrained = LLMPipeline(
+            LLMModel.GPT_4, 0, Mock(), decoding_mode=DecodingMode.CONSTRAINED
+        )._get_llm()
+
+    assert "max_tokens" not in free._generation_kwargs
+    assert limited._generation_kwargs["max_tokens"] == 64
+    assert constrained._generation_kwargs["max_tokens"] == 24
+
+
+def test_vocabulary_decoding_uses_concept_grammar():
+    kwargs = decoding_kwargs(DecodingMode.VOCABULARY, vocabulary_gbnf='root ::= "Aspirin"')
+
+    assert kwargs["grammar"] == 'root ::= "Aspirin"'
+    assert kwargs["max_tokens"] == 48
+
+
+def test_vocabulary_decoding_falls_back_without_grammar_support():
+    kwargs = decoding_kwargs(DecodingMode.VOCABULARY, grammar=False)
+
+    assert "grammar" not in kwargs
+    assert "\n" in kwargs["stop"]
+
+
+@pytest.mark.parametrize("route", ["/", "/vector_llm"])
+def test_pipeline_rejects_vocabulary_decoding_without_vocabulary(route):
+    app = FastAPI()
+    app.include_router(pipeline_routes.router)
+
+    with patch("routers.pipeline_routes.LLMPipeline") as pipeline:
+        response = TestClient(app).post(
+            route,
+            json={
+                "names": ["Panadol"],
+                "pipeline_options": {"decoding_mode": "vocabulary", "embed_vocab": []},
+            },
+        )
+
+    assert response.status_code == 400
+    pipeline.assert_not_called()
@@ -1,6 +1,8 @@
 import os
-from unittest.mock import Mock
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, Mock, patch
 
+import numpy as np
 import pytest
 from haystack.dataclasses import Document
 from sqlalchemy.orm import Session
@@ -9,7 +11,18 @@ pytestmark = pytest.mark.skipif(
     os.getenv("SKIP_DATABASE_TESTS") == "true", reason="Skipping database tests"
 )
 
-from components.embeddings import PGVectorQuery
+import components.embeddings as embeddings_module
+from components.embedding_cache import QueryEmbeddingCache
+from components.embeddings import (
+    EmbedderRegistry,
+    EmbeddingModelName,
+    Embeddings,
+    PGVectorQuery,
+    RegisteredTextEmbedder,
+    embed_batch,
+    get_embedding_model,
+)
+from utils.batching import MicroBatcher
 
 
 class TestPGVectorQuery:
@@ -113,3 +126,305 @@ class TestPGVectorQuery:
 
         with pytest.raises(TypeError):
             query_component.run(query_embedding=[1, "invalid", 3])
+
+    def test_run_batch_groups_by_ordinal(self):
+        """
+        Test that batch retrieval runs one query and returns documents for each embedding in order
+        """
+        mock_session = Mock(spec=Session)
+        mock_execute = Mock()
+        mock_execute.mappings.return_value.all.return_value = [
+            {"ordinal": 1, "id": "concept1", "content": "Sample Concept 1", "score": 0.1},
+            {"ordinal": 1, "id": "concept2", "content": "Sample Concept 2", "score": 0.2},
+            {"ordinal": 3, "id": "concept3", "content": "Sample Concept 3", "score": 0.3},
+        ]
+        mock_session.execute.return_value = mock_execute
+
+        query_component = PGVectorQuery(connection=mock_session, top_k=2)
+        result = query_component.run_batch([[0.1, 0.2], [0.3, 0.4], [0.5, 0.6]])
+
+        mock_session.execute.assert_called_once()
+        documents = result["documents"]
+        assert len(documents) == 3
+        assert [doc.id for doc in documents[0]] == ["concept1", "concept2"]
+        assert documents[1] == []
+        assert documents[2][0].content == "Sample Concept 3"
+
+    def test_run_batch_empty(self):
+        mock_session = Mock(spec=Session)
+        query_component = PGVectorQuery(connection=mock_session)
+
+        assert query_component.run_batch([]) == {"documents": []}
+        mock_session.execute.assert_not_called()
+
+    def test_search_settings_applied_before_query(self):
+        """
+        Test that ef_search and probes are set for the transaction before the vector query runs
+        """
+        mock_session = Mock(spec=Session)
+        mock_session.execute.return_value.mappings.return_value.all.return_value = []
+
+        query_component = PGVectorQuery(connection=mock_session, ef_search=100, probes=10)
+        query_component.run(query_embedding=[0.1, 0.2, 0.3])
+
+        calls = mock_session.execute.call_args_list
+        assert len(calls) == 3
+        ef_search, probes = [
+            call.args[0].compile(compile_kwargs={"literal_binds": True}).string
+            for call in calls[:2]
+        ]
+        assert "hnsw.ef_search" in ef_search and "'100'" in ef_search
+        assert "ivfflat.probes" in probes and "'10'" in probes
+        assert "LIMIT" in str(calls[2].args[0])
+
+    def test_query_runs_in_its_own_transaction(self):
+        """
+        Test that the search settings and vector query share a transaction that ends once the results are read
+        """
+        mock_session = Mock(spec=Session)
+        mock_session.in_transaction.return_value = False
+        mock_session.begin.return_value = MagicMock()
+        transaction = mock_session.begin.return_value
+        executed_in_transaction = []
+        transaction.__exit__.side_effect = lambda *args: executed_in_transaction.append(
+            mock_session.execute.call_count
+        )
+        mock_session.execute.return_value.mappings.return_value.all.return_value = []
+
+        query_component = PGVectorQuery(connection=mock_session, ef_search=100, probes=10)
+        query_component.run(query_embedding=[0.1, 0.2, 0.3])
+
+        mock_session.begin.assert_called_once()
+        transaction.__enter__.assert_called_once()
+        assert executed_in_transaction == [3]
+
+
+class TestEmbedderRegistry:
+    @patch("components.embeddings.FastembedTextEmbedder")
+    def test_model_loaded_once_per_prefix(self, mock_embedder):
+        """
+        Test that repeated requests for the same model and prefix reuse one warm embedder
+        """
+        registry = EmbedderRegistry(idle_timeout=None)
+        model = get_embedding_model(EmbeddingModelName.BGESMALL)
+
+        first = registry.get(model)
+        second = registry.get(model)
+        query = registry.get(model, prefix="query:")
+
+        assert first is second
+        assert mock_embedder.call_count == 2
+        assert mock_embedder.return_value.warm_up.call_count == 2
+        assert query is mock_embedder.return_value
+        assert set(registry.loaded()) == {
+            (EmbeddingModelName.BGESMALL, ""),
+            (EmbeddingModelName.BGESMALL, "query:"),
+        }
+
+    @patch("components.embeddings.time.monotonic")
+    @patch("components.embeddings.FastembedTextEmbedder")
+    def test_idle_embedders_evicted(self, mock_embedder, mock_time):
+        """
+        Test that embedders unused for longer than the idle timeout are dropped
+        """
+        registry = EmbedderRegistry(idle_timeout=10)
+        model = get_embedding_model(EmbeddingModelName.BGESMALL)
+
+        mock_time.return_value = 0
+        registry.get(model)
+        mock_time.return_value = 5
+        assert registry.evict_idle() == []
+        mock_time.return_value = 20
+        assert registry.evict_idle() == [(EmbeddingModelName.BGESMALL, "")]
+        assert registry.loaded() == []
+        assert registry._key_locks == {}
+
+    @patch("components.embeddings.FastembedTextEmbedder")
+    def test_preload(self, mock_embedder):
+        """
+        Test that preloading loads every requested model and prefix
+        """
+        registry = EmbedderRegistry(idle_timeout=None)
+        registry.preload([EmbeddingModelName.BGESMALL, EmbeddingModelName.MINILM])
+
+        assert len(registry.loaded()) == 4
+
+    def test_registered_embedder_delegates(self):
+        """
+        Test that pipeline components embed with the embedder held by the registry
+        """
+        registry = Mock(spec=EmbedderRegistry)
+        registry.get.return_value.run.return_value = {"embedding": [0.1, 0.2]}
+        model = get_embedding_model(EmbeddingModelName.BGESMALL)
+
+        embedder = RegisteredTextEmbedder(
+            model, registry=registry, cache=QueryEmbeddingCache()
+        )
+        result = embedder.run("aspirin")
+
+        assert result == {"embedding": [0.1, 0.2]}
+        registry.get.assert_called_with(model, "")
+        registry.get.return_value.run.assert_called_once_with("aspirin")
+
+    def test_registered_embedder_embeds_normalized_text(self):
+        """
+        Test that the text embedded is the normalized text the cache keys it by
+        """
+        registry = Mock(spec=EmbedderRegistry)
+        registry.get.return_value.run.return_value = {"embedding": [0.1, 0.2]}
+        model = get_embedding_model(EmbeddingModelName.BGESMALL)
+
+        embedder = RegisteredTextEmbedder(
+            model, registry=registry, cache=QueryEmbeddingCache()
+        )
+        embedder.run(" Panadol\u00a0 500\uff4dg ")
+
+        registry.get.return_value.run.assert_called_once_with("Panadol 500mg")
+
+
+class TestBatchedEmbedding:
+    def test_embed_batch_single_call(self):
+        """
+        Test that a list of texts is embedded in one call to the model, with the prefix applied
+        """
+        embedder = Mock()
+        embedder.prefix = "query:"
+        embedder.suffix = ""
+        embedder.parallel = 0
+        embedder.embedding_backend.model.embed.return_value = iter(
+            [np.array([0.1, 0.2]), np.array([0.3, 0.4])]
+        )
+
+        result = embed_batch(embedder, ["aspirin", "tylenol"], batch_size=64)
+
+        embedder.embedding_backend.model.embed.assert_called_once_with(
+            ["query:aspirin", "query:tylenol"], batch_size=64, parallel=0
+        )
+        assert isinstance(result, np.ndarray)
+        assert result.dtype == np.float32
+        assert result.shape == (2, 2)
+
+    @patch("components.embeddings.embed_batch")
+    def test_concurrent_queries_embedded_together(self, mock_embed_batch):
+        """
+        Test that queries from concurrent requests are merged into one inference and each gets its own vector back
+        """
+        mock_embed_batch.side_effect = lambda embedder, texts, batch_size: np.array(
+            [[float(len(text)), 0.0] for text in texts], dtype=np.float32
+        )
+        registry = Mock(spec=EmbedderRegistry)
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=500)
+        model = get_embedding_model(EmbeddingModelName.BGESMALL)
+        embedders = [
+            RegisteredTextEmbedder(model, registry=registry, cache=QueryEmbeddingCache(), batcher=batcher)
+            for _ in range(2)
+        ]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(lambda args: args[0].run(args[1]), zip(embedders, ["ab", "abcd"])))
+
+        mock_embed_batch.assert_called_once()
+        assert sorted(mock_embed_batch.call_args.args[1]) == ["ab", "abcd"]
+        assert results == [{"embedding": [2.0, 0.0]}, {"embedding": [4.0, 0.0]}]
+        registry.get.return_value.run.assert_not_called()
+
+    def test_embed_batch_rejects_non_strings(self):
+        with pytest.raises(TypeError):
+            embed_batch(Mock(), ["aspirin", 1])
+
+    @patch("components.embeddings.embed_batch")
+    def test_search_embeds_all_terms_at_once(self, mock_embed_batch):
+        """
+        Test that Embeddings.search embeds the whole query list in a single batch
+        """
+        mock_embed_batch.return_value = np.zeros((3, 384), dtype=np.float32)
+        registry = Mock(spec=EmbedderRegistry)
+        registry.get.return_value.prefix = "query:"
+        embeddings = Embeddings(
+            model_name=EmbeddingModelName.BGESMALL,
+            batch_size=2,
+            registry=registry,
+            cache=QueryEmbeddingCache(),
+        )
+        retriever = Mock()
+        retriever.run_batch.return_value = {
+            "documents": [[Document(id="1", content="Aspirin", score=0.1)], [], []]
+        }
+
+        with patch.object(embeddings, "get_retriever", return_value=retriever):
+            result = embeddings.search(["a", "b", "c"])
+
+        mock_embed_batch.assert_called_once_with(
+            registry.get.return_value, ["a", "b", "c"], batch_size=2
+        )
+        assert len(result) == 3
+        assert result[0] == [{"concept_id": "1", "concept": "Aspirin", "score": 0.1}]
+        assert result[1] == []
+        retriever.run_batch.assert_called_once()
+        assert retriever.run_batch.call_args.args[0].shape == (3, 384)
+
+
+class TestQueryEmbeddingCache:
+    @patch("components.embeddings.embed_batch")
+    def test_only_unseen_terms_embedded(self, mock_embed_batch):
+        """
+        Test that cached terms are not re-embedded and duplicates are embedded once
+        """
+        cache = QueryEmbeddingCache()
+        embedder = Mock()
+        embedder.prefix = "query:"
+        model = get_embedding_model(EmbeddingModelName.BGESMALL)
+        mock_embed_batch.return_value = np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32)
+
+        first = embeddings_module.cached_embed_batch(
+            embedder, model, [" aspirin", "tylenol", "aspirin "], cache
+        )
+        mock_embed_batch.assert_called_once_with(embedder, ["aspirin", "tylenol"], batch_size=256)
+        np.testing.assert_array_equal(first[0], first[2])
+
+        mock_embed_batch.reset_mock()
+        second = embeddings_module.cached_embed_batch(embedder, model, ["tylenol"], cache)
+        mock_embed_batch.assert_not_called()
+        np.testing.assert_array_equal(second[0], [0.0, 1.0])
+        assert cache.stats()["misses"] == 3
+
+    def test_keys_separate_models_and_prefixes(self):
+        cache = QueryEmbeddingCache()
+        cache.put("BGESMALL", "query:", "aspirin", [1.0, 2.0])
+
+        assert cache.get("BGESMALL", "query:", "  aspirin") is not None
+        assert cache.get("BGESMALL", "", "aspirin") is None
+        assert cache.get("MINILM", "query:", "aspirin") is None
+        assert cache.get("BGESMALL", "query:", "Aspirin") is None
+
+    def test_lru_eviction(self):
+        cache = QueryEmbeddingCache(max_entries=2)
+        cache.put("m", "", "a", [1.0])
+        cache.put("m", "", "b", [2.0])
+        cache.get("m", "", "a")
+        cache.put("m", "", "c", [3.0])
+
+        assert cache.get("m", "", "b") is None
+        assert cache.get("m", "", "a") is not None
+        assert cache.stats()["memory_entries"] == 2
+
+    def test_disk_tier_survives_restart(self, tmp_path):
+        path = str(tmp_path / "embeddings.sqlite")
+        QueryEmbeddingCache(path=path).put("m", "", "aspirin", [0.5, 0.25])
+
+        restarted = QueryEmbeddingCache(path=path)
+        np.testing.assert_array_equal(restarted.get("m", "", "aspirin"), [0.5, 0.25])
+        assert restarted.stats()["disk_hits"] == 1
+
+    def test_batch_written_to_disk_in_one_transaction(self, tmp_path):
+        path = str(tmp_path / "embeddings.sqlite")
+        cache = QueryEmbeddingCache(path=path)
+        db = Mock(wraps=cache._cache._db)
+        cache._cache._db = db
+
+        cache.put_many("m", "", ["aspirin", "tylenol", "ibuprofen"], np.eye(3, dtype=np.float32))
+
+        db.executemany.assert_called_once()
+        db.commit.assert_called_once()
+        restarted = QueryEmbeddingCache(path=path)
+        np.testing.assert_array_equal(restarted.get("m", "", "tylenol"), [0.0, 1.0, 0.0])
@@ -0,0 +1,50 @@
+from unittest.mock import Mock
+
+import numpy as np
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from components.embeddings import (
+    EmbeddingModel,
+    EmbeddingModelInfo,
+    EmbeddingModelName,
+    get_embedding_model,
+)
+from components.embeddings_builder import (
+    build_embeddings,
+    copy_rows,
+    pending_concepts_query,
+)
+from omop.omop_models import DB_VECSIZE
+
+
+class TestPendingConcepts:
+    def test_selects_new_and_changed_concepts(self):
+        query = pending_concepts_query(
+            get_embedding_model(EmbeddingModelName.BGESMALL), vocabularies=["RxNorm"]
+        )
+        sql = str(query.compile(dialect=postgresql.dialect()))
+
+        assert "LEFT OUTER JOIN" in sql
+        assert "md5(" in sql
+        assert "IS NULL" in sql
+        assert "vocabulary_id IN" in sql
+        assert "ORDER BY" in sql
+
+
+class TestCopyRows:
+    def test_one_line_per_concept(self):
+        buffer = copy_rows([1, 2], np.array([[0.5, -1.0], [0.25, 2.0]], dtype=np.float32))
+
+        assert buffer.read() == "1\t[0.5,-1.0]\n2\t[0.25,2.0]\n"
+
+
+class TestBuildEmbeddings:
+    def test_rejects_model_of_wrong_size(self):
+        model = EmbeddingModel(
+            name=EmbeddingModelName.BGESMALL,
+            info=EmbeddingModelInfo(path="BAAI/bge-small-en-v1.5", dimensions=DB_VECSIZE + 1),
+        )
+
+        with pytest.raises(ValueError):
+            build_embeddings(Mock(), model)
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+import pytest
+
+from components.executor import BoundedExecutor, QueueFullError
+
+
+def test_run_returns_result():
+    executor = BoundedExecutor("test", max_workers=1, max_queue=0)
+
+    assert asyncio.run(executor.run(lambda a, b=0: a + b, 1, b=2)) == 3
+    assert executor.stats()["completed"] == 1
+
+
+def test_run_raises_call_errors():
+    executor = BoundedExecutor("test", max_workers=1, max_queue=0)
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        asyncio.run(executor.run(fail))
+
+
+def test_full_queue_refuses_calls():
+    executor = BoundedExecutor("test", max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def main():
+        running = asyncio.ensure_future(executor.run(release.wait))
+        queued = asyncio.ensure_future(executor.run(release.wait))
+        await asyncio.sleep(0.05)
+        with pytest.raises(QueueFullError):
+            await executor.run(release.wait)
+        stats = executor.stats()
+        release.set()
+        await asyncio.gather(running, queued)
+        return stats
+
+    stats = asyncio.run(main())
+
+    assert stats["running"] == 1
+    assert stats["queued"] == 1
+    assert stats["rejected"] == 1
+    assert executor.stats()["completed"] == 2
+    assert executor.stats()["queued"] == 0
+
+
+def test_event_loop_stays_responsive():
+    executor = BoundedExecutor("test", max_workers=1, max_queue=0)
+    release = threading.Event()
+
+    async def main():
+        blocked = asyncio.ensure_future(executor.run(release.wait))
+        # Runs while the worker is blocked
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        release.set()
+        return await blocked
+
+    assert asyncio.run(main()) is True
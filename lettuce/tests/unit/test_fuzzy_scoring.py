@@ -0,0 +1,59 @@
+import pytest
+
+from omop.fuzzy_scoring import select_concepts, similarity_scores
+from omop.omop_match import OMOPMatcher
+
+
+class TestSimilarityScores:
+    def test_matches_calculate_similarity_score(self):
+        names = ["Paracetamol (oral)", "acetaminophen", None, "PARACETAMOL 500 MG", "acetaminophen"]
+
+        scores = similarity_scores(names, "Paracetamol")
+
+        assert scores.tolist() == [
+            OMOPMatcher.calculate_similarity_score(name, "Paracetamol") for name in names
+        ]
+
+    def test_cutoff_zeroes_low_scores(self):
+        scores = similarity_scores(["paracetamol", "aspirin"], "paracetamol", score_cutoff=80)
+
+        assert scores.tolist() == [100, 0]
+
+    def test_no_names(self):
+        assert similarity_scores([None, None], "paracetamol").tolist() == [0, 0]
+
+
+class TestSelectConcepts:
+    rows = [
+        (2, "Aspirin", "RxNorm", "A2", "aspirin tablet"),
+        (1, "Paracetamol", "RxNorm", "P1", "acetaminophen"),
+        (1, "Paracetamol", "RxNorm", "P1", "paracetamol"),
+        (1, "Paracetamol", "RxNorm", "P1", None),
+        (3, "Ibuprofen", "RxNorm", "I3", "paracetamol"),
+    ]
+
+    def test_keeps_concepts_with_a_name_or_synonym_above_threshold(self):
+        concepts = select_concepts(self.rows, "paracetamol", 80)
+
+        # Ordered by concept_id, as the pandas groupby was
+        assert [c["concept_id"] for c in concepts] == [1, 3]
+        assert concepts[1]["concept_name_similarity_score"] == pytest.approx(
+            OMOPMatcher.calculate_similarity_score("Ibuprofen", "paracetamol")
+        )
+
+    def test_synonyms_ordered_by_score_with_exact_scores(self):
+        synonyms = select_concepts(self.rows, "paracetamol", 80)[0]["CONCEPT_SYNONYM"]
+
+        assert [s["concept_synonym_name"] for s in synonyms] == ["paracetamol", "acetaminophen"]
+        # Scores below the threshold are still reported, not cut off to 0
+        assert synonyms[1]["concept_synonym_name_similarity_score"] == pytest.approx(
+            OMOPMatcher.calculate_similarity_score("acetaminophen", "paracetamol")
+        )
+
+    def test_nothing_above_threshold(self):
+        assert select_concepts(self.rows, "zzz", 80) == []
+
+    def test_workers(self):
+        assert select_concepts(self.rows, "paracetamol", 80, workers=-1) == select_concepts(
+            self.rows, "paracetamol", 80
+        )
@@ -0,0 +1,88 @@
+import pytest
+
+from components.llama_runtime import (
+    KVCacheType,
+    LlamaRuntime,
+    LlamaRuntimeOptions,
+    load_runtime_profile,
+    resolve_runtime,
+    save_runtime_profile,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_llama_env(monkeypatch):
+    monkeypatch.delenv("LLAMA_RUNTIME_PROFILE", raising=False)
+    for field in LlamaRuntimeOptions.model_fields:
+        monkeypatch.delenv(f"LLAMA_{field.upper()}", raising=False)
+
+
+def test_default_kwargs_match_previous_settings():
+    assert LlamaRuntime().model_kwargs(-1) == {
+        "n_ctx": 1024,
+        "n_batch": 32,
+        "n_gpu_layers": -1,
+        "verbose": True,
+    }
+
+
+def test_kwargs_include_tuned_settings():
+    runtime = LlamaRuntime(
+        n_threads=8,
+        use_mmap=False,
+        use_mlock=True,
+        type_k=KVCacheType.Q8_0,
+        type_v=KVCacheType.Q4_0,
+        flash_attn=True,
+    )
+
+    kwargs = runtime.model_kwargs(0)
+
+    assert kwargs["n_threads"] == 8
+    assert "n_threads_batch" not in kwargs
+    assert kwargs["use_mmap"] is False
+    assert kwargs["use_mlock"] is True
+    assert kwargs["type_k"] == 8
+    assert kwargs["type_v"] == 2
+    assert kwargs["flash_attn"] is True
+
+
+def test_runtime_is_hashable():
+    assert hash(LlamaRuntime(n_batch=64)) == hash(LlamaRuntime(n_batch=64))
+
+
+def test_environment_overrides_defaults(monkeypatch):
+    monkeypatch.setenv("LLAMA_N_BATCH", "256")
+    monkeypatch.setenv("LLAMA_FLASH_ATTN", "true")
+    monkeypatch.setenv("LLAMA_TYPE_K", "q8_0")
+    monkeypatch.setenv("LLAMA_N_THREADS", "")
+
+    runtime = resolve_runtime()
+
+    assert runtime.n_batch == 256
+    assert runtime.flash_attn is True
+    assert runtime.type_k == KVCacheType.Q8_0
+    assert runtime.n_threads is None
+    assert runtime.n_ctx == 1024
+
+
+def test_profile_round_trip(tmp_path):
+    path = str(tmp_path / "profiles" / "host.json")
+    runtime = LlamaRuntime(n_batch=512, n_threads=4, type_k=KVCacheType.F16)
+
+    save_runtime_profile(path, runtime, host="test")
+
+    assert load_runtime_profile(path) == runtime
+
+
+def test_precedence(tmp_path, monkeypatch):
+    path = str(tmp_path / "profile.json")
+    save_runtime_profile(path, LlamaRuntime(n_batch=512, n_threads=4, n_ctx=2048))
+    monkeypatch.setenv("LLAMA_RUNTIME_PROFILE", path)
+    monkeypatch.setenv("LLAMA_N_THREADS", "6")
+
+    runtime = resolve_runtime(LlamaRuntimeOptions(n_ctx=4096))
+
+    assert runtime.n_batch == 512
+    assert runtime.n_threads == 6
+    assert runtime.n_ctx == 4096
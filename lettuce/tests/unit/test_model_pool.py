@@ -0,0 +1,267 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+import pytest
+
+from api_models.requests import ModelPoolRequest
+from components.decoding import SpeculativeDecoding
+from components.llama_runtime import LlamaRuntime, LlamaRuntimeOptions, resolve_runtime
+from components.model_pool import ModelKey, ModelPool, PooledGenerator, compiled_grammar
+from components.models import LlamaModelDraft
+from options.pipeline_options import LLMModel
+from routers import model_routes
+from utils.batching import MicroBatcher
+
+
+def make_key(model: LLMModel = LLMModel.LLAMA_3_1_8B, profile: str = "deterministic") -> ModelKey:
+    return ModelKey(
+        model=model,
+        weights_path=None,
+        n_ctx=1024,
+        n_batch=32,
+        temperature_profile=profile,
+    )
+
+
+@pytest.fixture
+def loader():
+    """
+    Patch model loading so each load returns a new mock generator with a 4GB footprint
+    """
+    with patch("components.model_pool.resolve_weights_path", side_effect=lambda model, path, logger: f"/weights/{model.value}.gguf"), \
+         patch("components.model_pool.os.path.getsize", return_value=4 * 1024**3), \
+         patch("components.model_pool.get_local_weights", side_effect=lambda *args, **kwargs: Mock()) as mock_load:
+        yield mock_load
+
+
+class TestModelPool:
+    def test_model_loaded_once_per_key(self, loader):
+        pool = ModelPool()
+
+        first = pool.get(make_key())
+        second = pool.get(make_key())
+        sampled = pool.get(make_key(profile="sampled"))
+
+        assert first is second
+        assert sampled is not first
+        assert loader.call_count == 2
+        first.generator.warm_up.assert_called_once()
+
+    def test_least_recently_used_evicted_under_budget(self, loader):
+        pool = ModelPool(memory_budget=9 * 1024**3)
+        llama = pool.get(make_key(LLMModel.LLAMA_3_1_8B))
+        pool.get(make_key(LLMModel.MISTRAL_7B))
+        pool.get(make_key(LLMModel.LLAMA_3_1_8B))
+
+        pool.get(make_key(LLMModel.GEMMA_7B))
+
+        assert [entry["model"] for entry in pool.loaded()] == ["llama-3.1-8b", "gemma-7b"]
+        assert not llama.closed
+
+    def test_models_in_use_are_not_evicted(self, loader):
+        pool = ModelPool(memory_budget=5 * 1024**3)
+
+        with pool.acquire(make_key(LLMModel.LLAMA_3_1_8B)):
+            pool.get(make_key(LLMModel.MISTRAL_7B))
+
+        assert len(pool.loaded()) == 2
+
+    def test_reload_swaps_instance(self, loader):
+        pool = ModelPool()
+        old = pool.get(make_key())
+
+        pool.reload(make_key())
+
+        assert pool.get(make_key()) is not old
+        assert old.closed
+        with pool.acquire(make_key()) as generator:
+            assert generator is pool.get(make_key()).generator
+
+    def test_unload(self, loader):
+        pool = ModelPool()
+        entry = pool.get(make_key())
+
+        assert pool.unload(make_key())
+        assert entry.closed
+        assert pool.loaded() == []
+        assert not pool.unload(make_key())
+
+
+    def test_model_freed_when_load_fails(self, loader):
+        pool = ModelPool()
+        generator = Mock()
+        model = generator.model
+        draft = Mock(spec=LlamaModelDraft)
+        draft.check_compatible.side_effect = ValueError("vocabulary mismatch")
+        loader.side_effect = None
+        loader.return_value = generator
+
+        with patch("components.model_pool.speculative_draft_model", return_value=(draft, 1024**3)):
+            with pytest.raises(ValueError, match="vocabulary mismatch"):
+                pool.get(make_key()._replace(speculative_decoding=SpeculativeDecoding.DRAFT_MODEL))
+
+        model.close.assert_called_once()
+        draft.close.assert_called()
+        assert pool.loaded() == []
+
+    def test_routes_reach_instances_loaded_with_runtime_options(self, loader):
+        pool = ModelPool()
+        options = LlamaRuntimeOptions(n_ctx=4096, flash_attn=True)
+        llm = PooledGenerator(
+            LLMModel.LLAMA_3_1_8B, temperature=0, pool=pool, runtime=resolve_runtime(options)
+        )
+        pool.get(llm.key)
+
+        key = model_routes._key(
+            ModelPoolRequest(llm_model=LLMModel.LLAMA_3_1_8B, llm_runtime=options)
+        )
+
+        assert key == llm.key
+        assert pool.unload(key)
+
+
+class TestPooledGenerator:
+    def test_run_sends_temperature_with_prompt(self, loader):
+        pool = ModelPool()
+        llm = PooledGenerator(LLMModel.LLAMA_3_1_8B, temperature=0.2, pool=pool)
+        generator = pool.get(llm.key).generator
+        generator.run.return_value = {"replies": ["Acetaminophen"], "meta": [{}]}
+
+        result = llm.run("prompt", generation_kwargs={"max_tokens": 16})
+
+        assert result["replies"] == ["Acetaminophen"]
+        assert llm.key.temperature_profile == "sampled"
+        generator.run.assert_called_once_with(
+            "prompt", generation_kwargs={"max_tokens": 16, "temperature": 0.2}
+        )
+
+    def test_token_budgets_share_an_instance(self, loader):
+        pool = ModelPool()
+        short, long = [
+            PooledGenerator(
+                LLMModel.LLAMA_3_1_8B, temperature=0, pool=pool, runtime=LlamaRuntime(max_tokens=max_tokens)
+            )
+            for max_tokens in (16, 256)
+        ]
+        generator = pool.get(short.key).generator
+        generator.run.return_value = {"replies": ["Acetaminophen"], "meta": [{}]}
+
+        long.run("prompt")
+
+        assert short.key == long.key
+        assert loader.call_count == 1
+        generator.run.assert_called_once_with(
+            "prompt", generation_kwargs={"max_tokens": 256, "temperature": 0}
+        )
+
+    def test_grammar_compiled_once(self, loader):
+        pool = ModelPool()
+        # A generator is built per request, so the compiled grammar is shared between them
+        llms = [PooledGenerator(LLMModel.LLAMA_3_1_8B, temperature=0, pool=pool) for _ in range(2)]
+        generator = pool.get(llms[0].key).generator
+        generator.run.return_value = {"replies": ["Acetaminophen"], "meta": [{}]}
+        compiled_grammar.cache_clear()
+
+        with patch("components.model_pool.LlamaGrammar.from_string") as compile_grammar:
+            for llm in llms:
+                llm.run("prompt", generation_kwargs={"grammar": 'root ::= "a"'})
+        compiled_grammar.cache_clear()
+
+        compile_grammar.assert_called_once()
+        sent = generator.run.call_args.kwargs["generation_kwargs"]
+        assert sent["grammar"] is compile_grammar.return_value
+
+    def test_concurrent_prompts_decoded_together(self, loader):
+        pool = ModelPool()
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=500)
+        llms = [
+            PooledGenerator(LLMModel.LLAMA_3_1_8B, temperature=0, pool=pool, batcher=batcher)
+            for _ in range(2)
+        ]
+
+        def complete(llama, prompts, **kwargs):
+            return [
+                {"choices": [{"text": f"{prompt} reply"}], "batch_size": len(prompts)}
+                for prompt in prompts
+            ]
+
+        with patch("components.model_pool.batched_completion", side_effect=complete) as batched:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                results = list(executor.map(lambda args: args[0].run(args[1]), zip(llms, ["a", "b"])))
+
+        batched.assert_called_once()
+        assert [result["replies"] for result in results] == [["a reply"], ["b reply"]]
+        assert results[0]["meta"][0]["batch_size"] == 2
+
+    def test_prompts_with_different_prefixes_not_batched_together(self, loader):
+        pool = ModelPool()
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=100)
+        llms = [
+            PooledGenerator(
+                LLMModel.LLAMA_3_1_8B,
+                temperature=0,
+                pool=pool,
+                batcher=batcher,
+                prefix=prefix,
+                prefix_cache=Mock(**{"prepare.return_value": 0}),
+            )
+            for prefix in ["few-shot a", "few-shot b"]
+        ]
+        generator = pool.get(llms[0].key).generator
+        generator.run.side_effect = lambda prompt, generation_kwargs: {
+            "replies": [f"{prompt} reply"],
+            "meta": [{}],
+        }
+
+        with patch("components.model_pool.batched_completion") as batched:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                results = list(
+                    executor.map(
+                        lambda llm: llm.run(f"{llm._prefix} prompt"),
+                        llms,
+                    )
+                )
+
+        batched.assert_not_called()
+        assert [result["meta"][0]["batch_size"] for result in results] == [1, 1]
+
+    def test_prompts_run_singly_without_batched_decoding(self, loader):
+        pool = ModelPool()
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=500)
+        llms = [
+            PooledGenerator(LLMModel.LLAMA_3_1_8B, temperature=0, pool=pool, batcher=batcher)
+            for _ in range(2)
+        ]
+        generator = pool.get(llms[0].key).generator
+        generator.run.side_effect = lambda prompt, generation_kwargs: {
+            "replies": [f"{prompt} reply"],
+            "meta": [{}],
+        }
+
+        with patch("components.model_pool.batched_decoding_supported", return_value=False), \
+             patch("components.model_pool.batched_completion") as batched:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                results = list(executor.map(lambda args: args[0].run(args[1]), zip(llms, ["a", "b"])))
+
+        batched.assert_not_called()
+        assert [result["replies"] for result in results] == [["a reply"], ["b reply"]]
+        assert generator.run.call_count == 2
+
+    def test_grammar_prompts_not_batched(self, loader):
+        pool = ModelPool()
+        llm = PooledGenerator(
+            LLMModel.LLAMA_3_1_8B,
+            temperature=0,
+            pool=pool,
+            batcher=MicroBatcher(max_batch_size=2, max_wait_ms=500),
+        )
+        generator = pool.get(llm.key).generator
+        generator.run.return_value = {"replies": ["Acetaminophen"], "meta": [{}]}
+
+        with patch("components.model_pool.LlamaGrammar.from_string"), \
+             patch("components.model_pool.batched_completion") as batched:
+            result = llm.run("prompt", generation_kwargs={"grammar": 'root ::= "a"'})
+        compiled_grammar.cache_clear()
+
+        batched.assert_not_called()
+        assert result["meta"][0]["batch_size"] == 1
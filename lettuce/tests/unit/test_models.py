@@ -2,12 +2,17 @@ import pytest
 from unittest.mock import patch, Mock, MagicMock 
 import logging 
 import os 
+import numpy as np
+from components.decoding import SpeculativeDecoding
 from components.models import (
     get_local_weights, 
     download_model_from_huggingface, 
     connect_to_openai, 
     get_model, 
-    local_models
+    local_models,
+    LlamaModelDraft,
+    resolve_speculative_decoding,
+    speculative_draft_model,
 )
 from options.pipeline_options import LLMModel 
 
@@ -160,3 +165,57 @@ def test_get_model_huggingface(mock_hf_download, mock_llm_model):
 
     assert result == mock_llm_instance
     mock_hf_download.assert_called_once_with("llama-2-7b-chat", 0.7, logger)
+
+
+@patch("components.models.os.path.isfile")
+@patch("components.models.LlamaCppGenerator")
+@patch("components.models.torch.cuda.is_available")
+def test_local_weights_with_draft_model(mock_cuda, mock_llama, mock_isfile, mock_file_exists):
+    mock_isfile.return_value = True
+    mock_cuda.return_value = True
+    draft = Mock()
+
+    get_local_weights(mock_file_exists, 0.0, logger, draft_model=draft)
+
+    assert mock_llama.call_args.kwargs["model_kwargs"]["draft_model"] is draft
+
+
+def test_prompt_lookup_needs_no_weights():
+    draft, footprint = speculative_draft_model(
+        SpeculativeDecoding.PROMPT_LOOKUP, LLMModel.LLAMA_3_1_8B, logger
+    )
+
+    assert draft.num_pred_tokens == 10
+    assert footprint == 0
+    assert speculative_draft_model(SpeculativeDecoding.NONE, LLMModel.LLAMA_3_1_8B, logger) == (None, 0)
+
+
+def test_draft_model_mode_without_draft_model():
+    with pytest.raises(ValueError):
+        speculative_draft_model(SpeculativeDecoding.DRAFT_MODEL, LLMModel.MISTRAL_7B, logger)
+
+
+def test_speculative_decoding_per_model_from_env(monkeypatch):
+    monkeypatch.setenv("LLM_SPECULATIVE_DECODING", "llama-3.1-8b=draft_model, mistral-7b=prompt_lookup")
+
+    assert resolve_speculative_decoding(None, LLMModel.LLAMA_3_1_8B) == SpeculativeDecoding.DRAFT_MODEL
+    assert resolve_speculative_decoding(None, LLMModel.MISTRAL_7B) == SpeculativeDecoding.PROMPT_LOOKUP
+    assert resolve_speculative_decoding(None, LLMModel.GEMMA_7B) == SpeculativeDecoding.NONE
+    assert resolve_speculative_decoding(SpeculativeDecoding.NONE, LLMModel.MISTRAL_7B) == SpeculativeDecoding.NONE
+
+    monkeypatch.setenv("LLM_SPECULATIVE_DECODING", "prompt_lookup")
+    assert resolve_speculative_decoding(None, LLMModel.GEMMA_7B) == SpeculativeDecoding.PROMPT_LOOKUP
+
+
+def test_llama_model_draft_reuses_context():
+    draft = MagicMock()
+    draft._input_ids = [1, 2, 3]
+    draft.n_ctx.return_value = 1024
+    draft.token_eos.return_value = 0
+    draft.sample.side_effect = [7, 8, 0]
+
+    drafted = LlamaModelDraft(draft, num_pred_tokens=4)(np.array([1, 2, 3, 4, 5], dtype=np.intc))
+
+    assert drafted.tolist() == [7, 8]
+    assert draft.n_tokens == 3
+    assert draft.eval.call_args_list[0].args == ([4, 5],)
@@ -8,6 +8,7 @@ from haystack.dataclasses import Document
 from sqlalchemy.orm import Session
 
 from omop.omop_match import OMOPMatcher 
+from omop.omop_queries import CandidateSearch
 
 
 @pytest.fixture 
@@ -25,6 +26,16 @@ def mock_omop_matcher(mocker):
     # Patch internal methods
     mocker.patch.object(matcher, "fetch_concept_ancestors_and_descendants", return_value=[{"mock": "ancestor"}])
     mocker.patch.object(matcher, "fetch_concept_relationships", return_value=[{"mock": "relationship"}])
+    mocker.patch.object(
+        matcher,
+        "fetch_concept_ancestors_and_descendants_batch",
+        side_effect=lambda ids: {i: [{"mock": "ancestor"}] for i in ids},
+    )
+    mocker.patch.object(
+        matcher,
+        "fetch_concept_relationships_batch",
+        side_effect=lambda ids: {i: [{"mock": "relationship"}] for i in ids},
+    )
     return matcher
 
 
@@ -96,4 +107,183 @@ def test_fetch_omop_concepts_basic_case(mock_omop_matcher, mock_session):
     assert len(result) > 0
     assert result[0]["concept_id"] == "123"
     assert "CONCEPT_ANCESTOR" in result[0]
-    assert "CONCEPT_RELATIONSHIP" in result[0]
\ No newline at end of file
+    assert "CONCEPT_RELATIONSHIP" in result[0]
+
+def test_run_fetches_all_terms_in_one_query(mock_omop_matcher, mock_session, mocker):
+    BatchRow = namedtuple('Row', [
+        "ordinal",
+        "concept_id", 
+        "concept_name", 
+        "vocabulary_id", 
+        "concept_code", 
+        "concept_synonym_name"
+    ])
+    mock_result = MagicMock()
+    mock_result.fetchall.return_value = [
+        BatchRow(1, "123", "Hypertension", "SNOMED", "H123", "Hypertension Synonym"),
+        BatchRow(1, "124", "Hypotension", "SNOMED", "H124", "Low BP"),
+        BatchRow(3, "200", "Migraine", "SNOMED", "M200", None),
+    ]
+    mock_session.execute.return_value = mock_result
+    batch_query = mocker.patch("omop.omop_match.text_search_query_batch")
+
+    result = mock_omop_matcher.run(["Hypertension", "Asthma", "hypertension", "Migraine"])
+
+    mock_session.execute.assert_called_once()
+    # Terms that preprocess to the same query are sent once
+    assert batch_query.call_args.args[0] == ["hypertension", "asthma", "migraine"]
+    assert [r["search_term"] for r in result] == ["Hypertension", "Asthma", "hypertension", "Migraine"]
+    assert result[0]["CONCEPT"][0]["concept_id"] == "123"
+    assert result[2]["CONCEPT"] == result[0]["CONCEPT"]
+    assert result[1]["CONCEPT"] is None
+    assert result[3]["CONCEPT"][0]["concept_id"] == "200"
+
+
+def test_run_chunks_terms(mock_omop_matcher, mock_session, mocker):
+    mock_result = MagicMock()
+    mock_result.fetchall.return_value = []
+    mock_session.execute.return_value = mock_result
+    mocker.patch("omop.omop_match.text_search_query_batch")
+    mock_omop_matcher.batch_size = 2
+
+    result = mock_omop_matcher.run(["a1", "b2", "c3", "d4", "e5"])
+
+    assert mock_session.execute.call_count == 3
+    assert all(r["CONCEPT"] is None for r in result)
+
+
+def test_run_fetches_related_concepts_for_all_terms_together(mock_omop_matcher, mock_session, mocker):
+    BatchRow = namedtuple('Row', [
+        "ordinal",
+        "concept_id", 
+        "concept_name", 
+        "vocabulary_id", 
+        "concept_code", 
+        "concept_synonym_name"
+    ])
+    mock_result = MagicMock()
+    mock_result.fetchall.return_value = [
+        BatchRow(1, 123, "Hypertension", "SNOMED", "H123", None),
+        BatchRow(2, 200, "Migraine", "SNOMED", "M200", None),
+    ]
+    mock_session.execute.return_value = mock_result
+    mocker.patch("omop.omop_match.text_search_query_batch")
+
+    result = mock_omop_matcher.run(["Hypertension", "Migraine"])
+
+    mock_omop_matcher.fetch_concept_ancestors_and_descendants_batch.assert_called_once_with([123, 200])
+    mock_omop_matcher.fetch_concept_relationships_batch.assert_called_once_with([123, 200])
+    mock_omop_matcher.fetch_concept_ancestors_and_descendants.assert_not_called()
+    assert result[1]["CONCEPT"][0]["CONCEPT_ANCESTOR"] == [{"mock": "ancestor"}]
+    assert result[1]["CONCEPT"][0]["CONCEPT_RELATIONSHIP"] == [{"mock": "relationship"}]
+
+
+def test_related_concepts_grouped_by_source_id(mock_session, mocker):
+    matcher = OMOPMatcher(
+        logger=Mock(), vocabulary_id=["SNOMED"], concept_ancestor=True, batch_size=2
+    )
+    HierarchyRow = namedtuple('Row', [
+        "source_concept_id",
+        "relationship_type",
+        "concept_id",
+        "ancestor_concept_id",
+        "descendant_concept_id",
+        "concept_name",
+        "vocabulary_id",
+        "concept_code",
+        "min_levels_of_separation",
+        "max_levels_of_separation",
+    ])
+    first, second = MagicMock(), MagicMock()
+    first.fetchall.return_value = [
+        HierarchyRow(1, "Ancestor", 10, 10, 1, "Parent", "SNOMED", "P10", 1, 1),
+        HierarchyRow(2, "Descendant", 20, 2, 20, "Child", "SNOMED", "C20", 1, 1),
+        HierarchyRow(1, "Descendant", 30, 1, 30, "Other child", "SNOMED", "C30", 1, 1),
+    ]
+    second.fetchall.return_value = []
+    mock_session.execute.side_effect = [first, second]
+    query = mocker.patch("omop.omop_match.query_ancestors_and_descendants_by_ids")
+
+    hierarchy = matcher.fetch_concept_ancestors_and_descendants_batch([1, 2, 3])
+
+    assert [call.args[0] for call in query.call_args_list] == [[1, 2], [3]]
+    assert [c["concept_id"] for c in hierarchy[1]] == [10, 30]
+    assert hierarchy[2][0]["relationship"]["relationship_type"] == "Descendant"
+    assert hierarchy[3] == []
+
+
+def test_all_words_first_falls_back_per_term(mock_omop_matcher, mock_session, mocker):
+    BatchRow = namedtuple('Row', [
+        "ordinal",
+        "concept_id", 
+        "concept_name", 
+        "vocabulary_id", 
+        "concept_code", 
+        "concept_synonym_name"
+    ])
+    all_words, any_word = MagicMock(), MagicMock()
+    all_words.fetchall.return_value = [
+        BatchRow(1, 1, "Paracetamol 500 MG Oral Tablet", "RxNorm", "P1", None),
+        BatchRow(1, 2, "Paracetamol 500 MG Oral Capsule", "RxNorm", "P2", None),
+    ]
+    any_word.fetchall.return_value = [
+        BatchRow(1, 3, "Aspirin", "RxNorm", "A3", None),
+    ]
+    mock_session.execute.side_effect = [all_words, any_word]
+    batch_query = mocker.patch("omop.omop_match.text_search_query_batch")
+    mock_omop_matcher.match_all_words_first = True
+    mock_omop_matcher.min_candidates = 2
+    mock_omop_matcher.max_candidates = 50
+
+    result = mock_omop_matcher.run(["paracetamol 500 mg", "aspirin zzz", "insulin"])
+
+    assert [call.args[0] for call in batch_query.call_args_list] == [
+        ["paracetamol & 500 & mg", "aspirin & zzz", "insulin"],
+        # Only the multi-word term that found too few is searched for again
+        ["aspirin | zzz"],
+    ]
+    assert batch_query.call_args.kwargs["max_candidates"] == 50
+    assert [r["CANDIDATES"] for r in result] == [
+        {"query": "paracetamol & 500 & mg", "count": 2},
+        {"query": "aspirin | zzz", "count": 1},
+        {"query": "insulin", "count": 0},
+    ]
+
+
+def test_trigram_candidate_search(mock_omop_matcher, mock_session, mocker):
+    BatchRow = namedtuple('Row', [
+        "ordinal",
+        "concept_id", 
+        "concept_name", 
+        "vocabulary_id", 
+        "concept_code", 
+        "concept_synonym_name"
+    ])
+    matches = MagicMock()
+    matches.fetchall.return_value = [
+        BatchRow(1, 1, "Paliperidone", "RxNorm", "P1", None),
+        BatchRow(1, 1, "Paliperidone", "RxNorm", "P1", "paliperidone palmitate"),
+    ]
+    mock_session.execute.return_value = matches
+    trigram_query = mocker.patch("omop.omop_match.trigram_search_query_batch")
+    text_query = mocker.patch("omop.omop_match.text_search_query_batch")
+    mock_threshold = mocker.patch("omop.omop_match.apply_trigram_threshold")
+    mock_omop_matcher.candidate_search = CandidateSearch.TRIGRAM
+    mock_omop_matcher.max_candidates = 20
+
+    result = mock_omop_matcher.run(["Ppaliperidone", "zzz", "Ppaliperidone"])
+
+    # search_threshold 50 maps to a trigram similarity of 0.25
+    mock_threshold.assert_called_once_with(mock_session, 0.25)
+    mock_session.execute.assert_called_once()
+    text_query.assert_not_called()
+    assert trigram_query.call_args.args[0] == ["Ppaliperidone", "zzz"]
+    assert trigram_query.call_args.kwargs["max_candidates"] == 20
+    assert result[0]["CONCEPT"][0]["concept_name"] == "Paliperidone"
+    assert result[2]["CONCEPT"] == result[0]["CONCEPT"]
+    assert result[1]["CONCEPT"] is None
+    assert [r["CANDIDATES"] for r in result] == [
+        {"query": "Ppaliperidone", "count": 1},
+        {"query": "zzz", "count": 0},
+        {"query": "Ppaliperidone", "count": 1},
+    ]
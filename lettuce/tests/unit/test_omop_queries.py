@@ -0,0 +1,401 @@
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from omop.omop_queries import (
+    TextRankFunction,
+    query_ancestors_and_descendants_by_ids,
+    query_ancestors_by_name,
+    query_ids_matching_name,
+    query_related_by_ids,
+    query_vector,
+    query_vector_batch,
+    text_search_query,
+    text_search_query_batch,
+    trigram_rank_query,
+    trigram_search_query,
+    trigram_search_query_batch,
+)
+from omop.trigram_index import create_trigram_index_ddl, trigram_threshold
+from omop.vector_index import (
+    LAYOUT_TTL,
+    DistanceMetric,
+    EmbeddingLayout,
+    RetrievalMode,
+    VectorIndexMethod,
+    create_vector_index_ddl,
+    default_ivfflat_lists,
+    detect_embedding_layout,
+    drop_filtered_embeddings,
+)
+
+
+def compile_query(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect()))
+
+
+class TestQueryVectorBatch:
+    def test_single_statement_with_lateral_top_k(self):
+        query = query_vector_batch([[0.1, 0.2], [0.3, 0.4]], n=3)
+        sql = compile_query(query)
+
+        assert "WITH ORDINALITY" in sql
+        assert "LATERAL" in sql
+        assert "<=>" in sql
+        assert sql.count("LIMIT") == 1
+
+    def test_filters_applied_inside_lateral(self):
+        query = query_vector_batch(
+            [[0.1, 0.2]],
+            embed_vocab=["RxNorm"],
+            domain_id=["Drug"],
+            standard_concept=True,
+            valid_concept=True,
+        )
+        sql = compile_query(query)
+
+        assert "vocabulary_id IN" in sql
+        assert "domain_id IN" in sql
+        assert "standard_concept =" in sql
+        assert "invalid_reason IS NULL" in sql
+
+    def test_ordered_by_input_position(self):
+        query = query_vector_batch([[0.1, 0.2]])
+        sql = compile_query(query)
+
+        assert "ORDER BY query_vectors.ordinal" in sql
+
+
+class TestTextSearchQueryBatch:
+    def test_single_statement_with_lateral_match(self):
+        sql = compile_query(text_search_query_batch(["tylenol", "panadol"], ["RxNorm"], True, False))
+
+        assert sql.count("unnest") == 1
+        assert "WITH ORDINALITY" in sql
+        assert "JOIN LATERAL" in sql
+        assert "to_tsquery('english'::regconfig, search_terms.search_term)" in sql
+        assert "ORDER BY search_terms.ordinal" in sql
+
+    def test_synonyms_matched_per_term(self):
+        sql = compile_query(text_search_query_batch(["tylenol"], ["RxNorm"], False, True))
+
+        # The synonym subquery refers to the outer terms rather than unnesting them again
+        assert sql.count("unnest") == 1
+        assert sql.count("LATERAL") == 2
+        assert "AS synonym_concept" in sql
+
+
+class TestRankedCandidates:
+    def test_unbounded_by_default(self):
+        sql = compile_query(text_search_query("tylenol", ["RxNorm"], True, True))
+
+        assert "ts_rank" not in sql
+        assert "OVER" not in sql
+
+    def test_capped_to_best_ranked_concepts(self):
+        query = text_search_query(
+            "tylenol", ["RxNorm"], True, True, max_candidates=25,
+            rank_function=TextRankFunction.TS_RANK_CD,
+        )
+        sql = compile_query(query)
+
+        assert "greatest(ts_rank_cd(cdm.concept.concept_name_tsv" in sql
+        assert "coalesce(synonym_matches.synonym_rank" in sql
+        assert "max(scored.candidate_rank) OVER (PARTITION BY scored.concept_id)" in sql
+        assert "dense_rank() OVER (ORDER BY ranked.concept_rank DESC, ranked.concept_id)" in sql
+        assert list(query.selected_columns.keys()) == [
+            "concept_id", "concept_name", "vocabulary_id", "concept_code", "concept_synonym_name"
+        ]
+
+    def test_batch_capped_per_term(self):
+        sql = compile_query(
+            text_search_query_batch(["tylenol", "panadol"], ["RxNorm"], True, True, max_candidates=25)
+        )
+        lateral = sql.split("JOIN LATERAL", 1)[1]
+
+        assert sql.count("unnest") == 1
+        assert "dense_rank()" in lateral
+        assert "numbered.position <=" in lateral
+
+
+class TestTrigramSearch:
+    def test_matches_names_and_synonyms_with_trigram_operator(self):
+        query = trigram_search_query("ppaliperidone", ["RxNorm"], True, True)
+        sql = compile_query(query)
+
+        assert "cdm.concept.concept_name %% %(param_1)s" in sql
+        assert "cdm.concept_synonym.concept_synonym_name %% %(param_1)s" in sql
+        assert "UNION ALL" in sql
+        assert "OVER" not in sql
+        assert list(query.selected_columns.keys()) == [
+            "concept_id", "concept_name", "vocabulary_id", "concept_code", "concept_synonym_name"
+        ]
+
+    def test_names_only_without_synonyms(self):
+        sql = compile_query(trigram_search_query("ppaliperidone", None, False, False))
+
+        assert "cdm.concept_synonym" not in sql
+        assert "standard_concept" not in sql
+
+    @pytest.mark.parametrize("standard_concept", [True, False])
+    def test_synonyms_only_match_standard_concepts(self, standard_concept):
+        sql = compile_query(trigram_search_query("ppaliperidone", None, standard_concept, True))
+        name_branch, synonym_branch = sql.split("UNION ALL")
+
+        assert ("cdm.concept.standard_concept" in name_branch) == standard_concept
+        assert synonym_branch.count("cdm.concept.standard_concept = %(standard_concept_") == 1
+
+    def test_rank_query_synonyms_only_match_standard_concepts(self):
+        sql = compile_query(trigram_rank_query("asprin", None, None, False, True, top_k=5))
+        name_branch, synonym_branch = sql.split("UNION ALL")
+
+        assert "standard_concept =" not in name_branch
+        assert "cdm.concept.standard_concept = %(standard_concept_" in synonym_branch
+
+    def test_capped_to_most_similar_concepts(self):
+        sql = compile_query(trigram_search_query("ppaliperidone", None, True, True, max_candidates=10))
+
+        assert "trigram_matches.similarity AS candidate_rank" in sql
+        assert "numbered.position <=" in sql
+
+    def test_batch_capped_per_term(self):
+        sql = compile_query(
+            trigram_search_query_batch(["ppaliperidone", "asprin"], ["RxNorm"], True, True, max_candidates=10)
+        )
+        lateral = sql.split("JOIN LATERAL", 1)[1]
+
+        assert sql.count("unnest") == 1
+        # Both branches compare with the term of the outer row, not a search_terms table of their own
+        assert lateral.count("%% search_terms.search_term") == 2
+        assert "FROM unnest" not in lateral
+        assert "numbered.position <=" in lateral
+
+    def test_rank_query_orders_by_best_similarity(self):
+        sql = compile_query(trigram_rank_query("asprin", None, ["Drug"], True, True, top_k=5))
+
+        assert "max(trigram_matches.similarity) AS similarity" in sql
+        assert "cdm.concept.domain_id IN" in sql
+        assert "cdm.concept.invalid_reason IS NULL" in sql
+        assert "ORDER BY similarity DESC, cdm.concept.concept_id" in sql
+        assert "LIMIT" in sql
+
+    def test_threshold_mapping(self):
+        assert trigram_threshold(80) == 0.4
+        assert trigram_threshold(150) == 0.5
+        assert trigram_threshold(-1) == 0
+
+    def test_index_ddl(self):
+        sql = create_trigram_index_ddl("concept", "concept_name", concurrently=False)
+
+        assert "CONCURRENTLY" not in sql
+        assert '"concept_concept_name_trgm_idx"' in sql
+        assert 'USING gin ("concept_name" gin_trgm_ops)' in sql
+
+
+class TestNameLookups:
+    def test_exact_case_matches_name_as_given(self):
+        sql = compile_query(
+            query_ids_matching_name("Paracetamol", ["RxNorm"], full_concept=True, exact_case=True)
+        )
+
+        assert "cdm.concept.concept_name = %(concept_name_1)s" in sql
+        assert "lower(" not in sql
+        assert "cdm.concept.invalid_reason" in sql
+
+    def test_default_matches_case_insensitively(self):
+        sql = compile_query(query_ids_matching_name("Paracetamol", None))
+
+        assert "lower(cdm.concept.concept_name) = %(lower_1)s" in sql
+
+    def test_ancestors_by_name(self):
+        sql = compile_query(query_ancestors_by_name("Paracetamol", ["RxNorm"]))
+
+        assert "JOIN cdm.concept_ancestor ON cdm.concept_ancestor.ancestor_concept_id = cdm.concept.concept_id" in sql
+
+
+class TestSetBasedConceptQueries:
+    def test_hierarchy_for_many_ids(self):
+        query = query_ancestors_and_descendants_by_ids([1, 2, 3])
+        sql = compile_query(query)
+
+        # Both halves share the one array parameter
+        assert sql.count("= ANY (%(param_2)s::INTEGER[])") == 2
+        assert query.compile().params["param_2"] == [1, 2, 3]
+        assert "descendant_concept_id AS source_concept_id" in sql
+        assert "ancestor_concept_id AS source_concept_id" in sql
+        assert list(query.selected_columns.keys())[0] == "source_concept_id"
+
+    def test_relationships_for_many_ids(self):
+        query = query_related_by_ids([1, 2])
+        sql = compile_query(query)
+
+        assert "concept_relationship.concept_id_1 = ANY (%(param_1)s::INTEGER[])" in sql
+        assert query.compile().params["param_1"] == [1, 2]
+        assert "valid_end_date > now()" in sql
+
+
+class TestDistanceMetric:
+    @pytest.mark.parametrize(
+        "metric, operator",
+        [
+            (DistanceMetric.COSINE, "<=>"),
+            (DistanceMetric.INNER_PRODUCT, "<#>"),
+            (DistanceMetric.L2, "<->"),
+        ],
+    )
+    def test_orders_by_metric_operator(self, metric, operator):
+        sql = compile_query(query_vector([0.1, 0.2], metric=metric))
+        order_by = sql.split("ORDER BY")[1]
+
+        assert operator in order_by
+        assert operator in compile_query(query_vector_batch([[0.1, 0.2]], metric=metric))
+
+    def test_scores_on_cosine_distance_scale(self):
+        a = np.array([0.6, 0.8])
+        b = np.array([1.0, 0.0])
+        cosine_distance = 1 - a @ b
+
+        assert DistanceMetric.COSINE.score(cosine_distance) == pytest.approx(cosine_distance)
+        assert DistanceMetric.INNER_PRODUCT.score(-(a @ b)) == pytest.approx(cosine_distance)
+        assert DistanceMetric.L2.score(np.linalg.norm(a - b)) == pytest.approx(cosine_distance)
+
+
+class TestQuantizedRetrieval:
+    def test_halfvec_first_pass_then_exact_rerank(self):
+        sql = compile_query(
+            query_vector([0.1, 0.2], n=5, mode=RetrievalMode.HALFVEC, rerank_factor=4)
+        )
+        first_pass, rerank = sql.split("AS candidates")
+
+        assert "HALFVEC" in first_pass
+        assert "HALFVEC" not in rerank
+        assert "<=>" in rerank
+
+    def test_binary_first_pass_uses_hamming_distance(self):
+        sql = compile_query(query_vector([0.1, 0.2], mode=RetrievalMode.BINARY))
+
+        assert "binary_quantize" in sql
+        assert "<~>" in sql
+
+    def test_batch(self):
+        sql = compile_query(query_vector_batch([[0.1, 0.2]], mode=RetrievalMode.BINARY))
+
+        assert sql.count("LATERAL") == 2
+        assert "<~>" in sql
+        assert "<=>" in sql
+
+    def test_index_expressions(self):
+        halfvec = create_vector_index_ddl(
+            VectorIndexMethod.HNSW, DistanceMetric.INNER_PRODUCT, mode=RetrievalMode.HALFVEC
+        )
+        binary = create_vector_index_ddl(
+            VectorIndexMethod.HNSW, DistanceMetric.COSINE, mode=RetrievalMode.BINARY
+        )
+
+        assert "::halfvec(" in halfvec and "halfvec_ip_ops" in halfvec
+        assert "binary_quantize(embedding)::bit(" in binary and "bit_hamming_ops" in binary
+
+
+class TestDenormalizedLayout:
+    def test_filters_on_vector_table_without_join(self):
+        sql = compile_query(
+            query_vector(
+                [0.1, 0.2],
+                embed_vocab=["RxNorm"],
+                standard_concept=True,
+                layout=EmbeddingLayout.DENORMALIZED,
+            )
+        )
+
+        assert "JOIN" not in sql
+        assert "_filtered.vocabulary_id IN" in sql
+        assert "_filtered.standard_concept =" in sql
+
+    def test_batch(self):
+        sql = compile_query(
+            query_vector_batch(
+                [[0.1, 0.2]], embed_vocab=["RxNorm"], layout=EmbeddingLayout.DENORMALIZED
+            )
+        )
+
+        assert "concept.concept_id" not in sql
+        assert "_filtered.vocabulary_id IN" in sql
+
+    def test_quantized_candidates_filtered_in_place(self):
+        sql = compile_query(
+            query_vector(
+                [0.1, 0.2],
+                embed_vocab=["RxNorm"],
+                mode=RetrievalMode.HALFVEC,
+                layout=EmbeddingLayout.DENORMALIZED,
+            )
+        )
+        first_pass = sql.split("AS candidates")[0].split("(SELECT", 1)[1]
+
+        assert "_filtered.vocabulary_id IN" in first_pass
+        assert "JOIN" not in first_pass
+
+
+class TestLayoutDetection:
+    def test_cached_until_filtered_table_dropped(self, monkeypatch):
+        monkeypatch.delenv("VECTOR_TABLE_LAYOUT", raising=False)
+        connection = MagicMock()
+        connection.execute.return_value.scalar.return_value = "cdm.embeddings_filtered"
+        drop_filtered_embeddings(MagicMock())
+
+        assert detect_embedding_layout(connection) == EmbeddingLayout.DENORMALIZED
+        connection.execute.return_value.scalar.return_value = None
+        assert detect_embedding_layout(connection) == EmbeddingLayout.DENORMALIZED
+        assert connection.execute.call_count == 1
+
+        engine = MagicMock()
+        drop_filtered_embeddings(engine)
+
+        assert "DROP TABLE IF EXISTS" in str(engine.begin().__enter__().execute.call_args.args[0])
+        assert detect_embedding_layout(connection) == EmbeddingLayout.JOINED
+        drop_filtered_embeddings(MagicMock())
+
+    def test_redetected_after_ttl(self, monkeypatch):
+        monkeypatch.delenv("VECTOR_TABLE_LAYOUT", raising=False)
+        clock = MagicMock(return_value=1000.0)
+        monkeypatch.setattr("omop.vector_index.time.monotonic", clock)
+        connection = MagicMock()
+        connection.execute.return_value.scalar.return_value = None
+        drop_filtered_embeddings(MagicMock())
+
+        assert detect_embedding_layout(connection) == EmbeddingLayout.JOINED
+        # Another process builds the table
+        connection.execute.return_value.scalar.return_value = "cdm.embeddings_filtered"
+        clock.return_value = 1000.0 + LAYOUT_TTL - 1
+        assert detect_embedding_layout(connection) == EmbeddingLayout.JOINED
+        clock.return_value = 1000.0 + LAYOUT_TTL
+        assert detect_embedding_layout(connection) == EmbeddingLayout.DENORMALIZED
+        assert connection.execute.call_count == 2
+        drop_filtered_embeddings(MagicMock())
+
+
+class TestVectorIndexDDL:
+    def test_hnsw(self):
+        sql = create_vector_index_ddl(
+            VectorIndexMethod.HNSW, DistanceMetric.COSINE, m=24, ef_construction=128
+        )
+
+        assert sql.startswith("CREATE INDEX CONCURRENTLY IF NOT EXISTS")
+        assert "USING hnsw (embedding vector_cosine_ops)" in sql
+        assert "WITH (m = 24, ef_construction = 128)" in sql
+
+    def test_ivfflat(self):
+        sql = create_vector_index_ddl(
+            VectorIndexMethod.IVFFLAT, DistanceMetric.L2, lists=300, concurrently=False
+        )
+
+        assert "CONCURRENTLY" not in sql
+        assert "USING ivfflat (embedding vector_l2_ops)" in sql
+        assert "WITH (lists = 300)" in sql
+
+    def test_default_ivfflat_lists(self):
+        assert default_ivfflat_lists(500) == 1
+        assert default_ivfflat_lists(200_000) == 200
+        assert default_ivfflat_lists(4_000_000) == 2000
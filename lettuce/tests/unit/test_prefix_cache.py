@@ -0,0 +1,116 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from components.llama_runtime import KVCacheType, LlamaRuntime
+from components.prefix_cache import PrefixStateCache
+from components.prompt import Prompts
+from options.pipeline_options import LLMModel
+
+
+class FakeLlama:
+    """
+    Stands in for llama_cpp.Llama, with one token per word and a count of evaluated tokens
+    """
+
+    model_path = "/weights/model.gguf"
+
+    def __init__(self):
+        self._input_ids = []
+        self.evaluated = 0
+
+    def n_ctx(self):
+        return 1024
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return [1] + [sum(word) for word in text.split()]
+
+    def reset(self):
+        self._input_ids = []
+
+    def eval(self, tokens):
+        self._input_ids = self._input_ids + list(tokens)
+        self.evaluated += len(tokens)
+
+    def save_state(self):
+        return SimpleNamespace(
+            input_ids=np.array(self._input_ids), n_tokens=len(self._input_ids)
+        )
+
+    def load_state(self, state):
+        self._input_ids = state.input_ids[: state.n_tokens].tolist()
+
+
+PREFIX = "Respond with the formal name.\nInformal name: Tylenol\nResponse: Acetaminophen\n"
+
+
+def test_prefix_evaluated_once_and_reused():
+    cache = PrefixStateCache()
+    llama = FakeLlama()
+
+    first = cache.prepare(llama, PREFIX, PREFIX + "Informal name: banana\nResponse:")
+    second = cache.prepare(llama, PREFIX, PREFIX + "Informal name: apple\nResponse:")
+
+    prefix_tokens = len(llama.tokenize(PREFIX.encode()))
+    assert llama.evaluated == prefix_tokens
+    assert first == second == prefix_tokens
+    assert cache.stats() == {"prefixes": 1, "requests": 2, "tokens_saved": 2 * first}
+
+
+def test_state_restored_after_unrelated_prompt():
+    cache = PrefixStateCache()
+    llama = FakeLlama()
+    cache.prepare(llama, PREFIX, PREFIX + "Informal name: banana")
+
+    llama.reset()
+    llama.eval(llama.tokenize(b"something else entirely"))
+    reused = cache.prepare(llama, PREFIX, PREFIX + "Informal name: apple")
+
+    assert reused >= len(llama.tokenize(PREFIX.encode()))
+    assert llama._input_ids[:reused] == llama.tokenize((PREFIX + "Informal name: apple").encode())[:reused]
+
+
+def test_state_persisted_to_disk(tmp_path):
+    llama = FakeLlama()
+    PrefixStateCache(directory=str(tmp_path)).prepare(llama, PREFIX, PREFIX + "x")
+
+    cold = FakeLlama()
+    reused = PrefixStateCache(directory=str(tmp_path)).prepare(cold, PREFIX, PREFIX + "x")
+
+    assert cold.evaluated == 0
+    assert reused == len(cold.tokenize(PREFIX.encode()))
+
+
+def test_states_not_shared_between_kv_cache_layouts(tmp_path):
+    f16 = LlamaRuntime()
+    q8 = LlamaRuntime(type_k=KVCacheType.Q8_0, type_v=KVCacheType.Q8_0, flash_attn=True)
+    PrefixStateCache(directory=str(tmp_path)).prepare(FakeLlama(), PREFIX, PREFIX + "x", runtime=f16)
+
+    cold = FakeLlama()
+    PrefixStateCache(directory=str(tmp_path)).prepare(cold, PREFIX, PREFIX + "x", runtime=q8)
+
+    assert cold.evaluated > 0
+    assert PrefixStateCache.key(cold, PREFIX, f16) != PrefixStateCache.key(cold, PREFIX, q8)
+
+
+def test_states_shared_between_token_budgets():
+    llama = FakeLlama()
+
+    assert PrefixStateCache.key(llama, PREFIX, LlamaRuntime(max_tokens=16)) == PrefixStateCache.key(
+        llama, PREFIX, LlamaRuntime(max_tokens=256)
+    )
+
+
+@pytest.mark.parametrize("prompt_type", ["simple", "top_n_RAG"])
+def test_static_prefix_is_start_of_rendered_prompt(prompt_type):
+    prompts = Prompts(model=LLMModel.LLAMA_3_1_8B, prompt_type=prompt_type)
+    prefix = prompts.get_static_prefix()
+
+    rendered = prompts.get_prompt().run(
+        informal_name="banana", vec_results=[{"content": "apple"}]
+    )["prompt"]
+
+    assert "Aleve" in prefix
+    assert "{" not in prefix
+    assert rendered.startswith(prefix)
@@ -14,3 +14,10 @@ def test_preprocess_with_stopword():
     assert (
         preprocess_search_term("paracetamol and caffeine") == "paracetamol | caffeine"
     )
+
+
+def test_preprocess_all_words():
+    assert (
+        preprocess_search_term("paracetamol and caffeine", operator="&")
+        == "paracetamol & caffeine"
+    )
@@ -0,0 +1,124 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from components.prompt import Prompts
+from components.response_cache import CachedGenerator, LLMResponseCache, grammar_digest
+from options.pipeline_options import LLMModel
+
+
+@pytest.fixture
+def generator():
+    mock = Mock()
+    mock.run.side_effect = lambda prompt, generation_kwargs=None: {
+        "replies": [f"reply to {prompt}"],
+        "meta": [{"model": "llama"}],
+    }
+    return mock
+
+
+def make_cached(generator, cache, temperature=0.0, template_version="v1"):
+    return CachedGenerator(
+        generator,
+        model="llama-3.1-8b:",
+        template_version=template_version,
+        temperature=temperature,
+        cache=cache,
+    )
+
+
+def test_repeated_prompt_served_from_cache(generator):
+    cache = LLMResponseCache()
+    llm = make_cached(generator, cache)
+
+    first = llm.run("Informal name: Tylenol")
+    second = llm.run("Informal name: Tylenol")
+
+    assert generator.run.call_count == 1
+    assert second["replies"] == first["replies"]
+    assert first["meta"][0]["cache_hit"] is False
+    assert second["meta"][0]["cache_hit"] is True
+    assert cache.stats()["hit_rate"] == 0.5
+
+
+def test_sampled_requests_bypass_cache(generator):
+    cache = LLMResponseCache()
+    llm = make_cached(generator, cache, temperature=0.7)
+
+    llm.run("Informal name: Tylenol")
+    llm.run("Informal name: Tylenol")
+    make_cached(generator, cache).run(
+        "Informal name: Tylenol", generation_kwargs={"temperature": 0.5}
+    )
+
+    assert generator.run.call_count == 3
+    assert cache.stats()["bypassed"] == 3
+    assert cache.stats()["misses"] == 0
+
+
+def test_key_includes_template_version_and_settings(generator):
+    cache = LLMResponseCache()
+
+    make_cached(generator, cache, template_version="v1").run("prompt")
+    make_cached(generator, cache, template_version="v2").run("prompt")
+    make_cached(generator, cache).run("prompt", generation_kwargs={"max_tokens": 16})
+
+    assert generator.run.call_count == 3
+
+
+def test_grammar_digested_once(generator):
+    cache = LLMResponseCache()
+    grammar = 'root ::= "Acetaminophen" | "Aspirin"'
+    llm = CachedGenerator(
+        generator,
+        model="llama-3.1-8b:",
+        template_version="v1",
+        temperature=0.0,
+        cache=cache,
+        generation_kwargs={"grammar": grammar, "max_tokens": 48},
+    )
+
+    with patch("components.response_cache.grammar_digest", wraps=grammar_digest) as digest:
+        llm.run("prompt")
+        llm.run("prompt")
+        llm.run("prompt", generation_kwargs={"grammar": 'root ::= "Aspirin"'})
+
+    digest.assert_called_once_with('root ::= "Aspirin"')
+    assert generator.run.call_count == 2
+    assert generator.run.call_args_list[0].kwargs["generation_kwargs"]["grammar"] == grammar
+
+
+def test_request_meta_not_served_from_cache():
+    cache = LLMResponseCache()
+    batched = Mock()
+    batched.run.return_value = {
+        "replies": ["Acetaminophen"],
+        "meta": [{"model": "llama", "batch_size": 4, "prompt_tokens_reused": 120}],
+    }
+    llm = make_cached(batched, cache)
+
+    first = llm.run("prompt")
+    second = llm.run("prompt")
+
+    assert first["meta"][0]["batch_size"] == 4
+    assert second["meta"] == [{"model": "llama", "cache_hit": True}]
+
+
+def test_replies_persist_in_sqlite(generator, tmp_path):
+    path = str(tmp_path / "responses.db")
+    make_cached(generator, LLMResponseCache(path=path)).run("prompt")
+
+    restarted = LLMResponseCache(path=path)
+    result = make_cached(generator, restarted).run("prompt")
+
+    assert generator.run.call_count == 1
+    assert result["replies"] == ["reply to prompt"]
+    assert restarted.stats()["disk_hits"] == 1
+
+
+def test_template_version_differs_by_prompt_type():
+    simple = Prompts(model=LLMModel.LLAMA_3_1_8B, prompt_type="simple")
+    rag = Prompts(model=LLMModel.LLAMA_3_1_8B, prompt_type="top_n_RAG")
+
+    assert simple.get_template_version() != rag.get_template_version()
+    assert simple.get_template_version() == Prompts(model=LLMModel.LLAMA_3_1_8B).get_template_version()
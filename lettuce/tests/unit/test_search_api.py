@@ -1,3 +1,4 @@
+import threading
 import pytest
 from unittest.mock import Mock, patch
 from fastapi.testclient import TestClient
@@ -347,5 +348,86 @@ class TestTextSearchEndpoint:
         )
 
 
+class TestTrigramSearchEndpoint:
+    """Test suite for the trigram_search endpoint"""
+
+    @patch('routers.search_routes.apply_trigram_threshold')
+    @patch('routers.search_routes.get_session')
+    @patch('routers.search_routes.trigram_rank_query')
+    def test_basic_trigram_search(self, mock_trigram_rank_query, mock_get_session, mock_apply_threshold):
+        """Test a misspelt term is searched for with the threshold set on the same session"""
+        mock_session = Mock()
+        mock_context_manager = Mock()
+        mock_context_manager.__enter__ = Mock(return_value=mock_session)
+        mock_context_manager.__exit__ = Mock(return_value=None)
+        mock_get_session.return_value = mock_context_manager
+
+        result = Mock(
+            concept_name="paliperidone",
+            concept_id=703244,
+            concept_code="679314",
+            domain_id="Drug",
+            vocabulary_id="RxNorm",
+            concept_class_id="Ingredient",
+            standard_concept="S",
+            invalid_reason=None,
+            similarity=0.8,
+        )
+        mock_session.execute.return_value.fetchall.return_value = [result]
+        mock_query = Mock()
+        mock_trigram_rank_query.return_value = mock_query
+
+        response = client.get(
+            "/trigram-search/Ppaliperidone",
+            params={"vocabulary": ["RxNorm"], "search_threshold": 60, "concept_synonym": False}
+        )
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["metadata"]["pipeline"] == "Trigram search"
+        assert data["recommendations"][0]["conceptName"] == "paliperidone"
+        assert data["recommendations"][0]["ranks"]["trigram_search"] == 1
+        assert data["recommendations"][0]["scores"]["trigram_search"] == 0.8
+
+        mock_trigram_rank_query.assert_called_once_with(
+            search_term="Ppaliperidone",
+            vocabulary_id=["RxNorm"],
+            domain_id=None,
+            standard_concept=True,
+            valid_concept=True,
+            top_k=5,
+            concept_synonym=False,
+        )
+        mock_apply_threshold.assert_called_once_with(mock_session, 0.3)
+        mock_session.execute.assert_called_once_with(mock_query)
+
+    def test_threshold_out_of_range(self):
+        """Test search_threshold is on the fuzzy match scale"""
+        response = client.get("/trigram-search/aspirin", params={"search_threshold": 101})
+        assert response.status_code == 422
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
+
+
+class TestVectorSearchEndpoint:
+    @patch("routers.search_routes.Embeddings")
+    def test_retriever_built_off_the_event_loop(self, mock_embeddings):
+        threads = {}
+        handler = mock_embeddings.return_value
+        handler.get_embedder.return_value.run.return_value = {"embedding": [0.1, 0.2]}
+
+        def get_retriever():
+            threads["get_retriever"] = threading.current_thread().name
+            retriever = Mock()
+            retriever.run.return_value = []
+            return retriever
+
+        handler.get_retriever.side_effect = get_retriever
+
+        response = client.get("/vector-search/diabetes")
+
+        assert response.status_code == 200
+        assert response.json()["recommendations"] == []
+        assert threads["get_retriever"].startswith("lettuce-database")
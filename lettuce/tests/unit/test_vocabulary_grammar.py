@@ -0,0 +1,68 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from llama_cpp import LlamaGrammar
+from sqlalchemy.dialects import postgresql
+
+from components import vocabulary_grammar
+from components.vocabulary_grammar import names_to_gbnf
+from omop.omop_queries import query_concept_names, query_ids_matching_name
+
+NAMES = ["Amoxicillin", "Amoxicillin / Clavulanate", "Aspirin", "Acetaminophen"]
+
+
+def test_shared_prefixes_written_once():
+    grammar = names_to_gbnf(NAMES)
+
+    assert grammar.startswith('root ::= " "? n0 "\\n"')
+    assert grammar.count("moxicillin") == 1
+    assert '" / Clavulanate"' in grammar
+
+
+def test_grammar_parses():
+    names = NAMES + ['Vitamin "D"', "Back\\slash", "Naproxen 250 MG"]
+    assert LlamaGrammar.from_string(names_to_gbnf(names), verbose=False) is not None
+
+
+def test_empty_names_rejected():
+    with pytest.raises(ValueError):
+        names_to_gbnf(["", "line\nbreak"])
+
+
+def test_grammar_cached_per_vocabulary_set():
+    vocabulary_grammar._cached_grammar.cache_clear()
+    session = MagicMock()
+    session.execute.return_value.scalars.return_value.all.return_value = NAMES
+    with patch("components.vocabulary_grammar.get_session") as get_session:
+        get_session.return_value.__enter__.return_value = session
+
+        first = vocabulary_grammar.vocabulary_grammar(["RxNorm", "RxNorm Extension"], ["Ingredient"])
+        second = vocabulary_grammar.vocabulary_grammar(["RxNorm Extension", "RxNorm"], ["Ingredient"])
+        vocabulary_grammar.vocabulary_grammar(["RxNorm"], ["Ingredient"])
+
+    assert first is second
+    assert session.execute.call_count == 2
+    vocabulary_grammar._cached_grammar.cache_clear()
+
+
+def test_concept_names_query_filters():
+    sql = str(
+        query_concept_names(["RxNorm"], ["Ingredient"], standard_concept=True).compile(
+            dialect=postgresql.dialect()
+        )
+    )
+
+    assert "SELECT DISTINCT" in sql
+    assert "vocabulary_id IN" in sql
+    assert "concept_class_id IN" in sql
+    assert "standard_concept" in sql
+
+
+def test_exact_case_lookup_compares_name_directly():
+    sql = str(
+        query_ids_matching_name("Aspirin", ["RxNorm"], exact_case=True).compile(
+            dialect=postgresql.dialect()
+        )
+    )
+
+    assert "lower" not in sql
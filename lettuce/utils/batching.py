@@ -0,0 +1,143 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Generic, Hashable, List, TypeVar
+
+from utils.metrics import Histogram
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+
+class _Request(Generic[T]):
+    __slots__ = ("item", "leader", "wake", "result", "error")
+
+    def __init__(self, item: T) -> None:
+        self.item = item
+        self.leader = False
+        self.wake = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class MicroBatcher:
+    """
+    Merges concurrent calls from different threads into batches
+
+    Calls are grouped by a key, e.g. the model they need, and only calls with the same key are batched together.
+    The first call in a group leads: it waits up to max_wait_ms for others to join, or until max_batch_size have, then runs the batch in its own thread and hands each caller its result.
+    Calls that join a batch block until it is done. Any calls left over once a batch is full wait for the next one, led by the oldest of them.
+    No background threads are used, so nothing runs when there are no calls.
+
+    Parameters
+    ----------
+    max_batch_size: int
+        The most calls run as one batch. 1 disables batching
+    max_wait_ms: float
+        How long the leader of a batch waits for other calls
+    """
+
+    def __init__(self, max_batch_size: int, max_wait_ms: float) -> None:
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._queues: Dict[Hashable, List[_Request]] = {}
+        self._condition = threading.Condition()
+        self.queue_depth = Histogram(SIZE_BUCKETS)
+        self.batch_size = Histogram(SIZE_BUCKETS)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch_size > 1
+
+    def submit(self, group: Hashable, item: T, run_batch: Callable[[List[T]], List[R]]) -> R:
+        """
+        Add an item to the group's next batch and wait for its result
+
+        Parameters
+        ----------
+        group: Hashable
+            Only items with equal groups are batched together
+        item: T
+            The item to process
+        run_batch: Callable[[List[T]], List[R]]
+            Processes a batch, returning one result per item in order. A result that is an exception is raised to that item's caller alone.
+            The leader's function is used for the whole batch, so every caller in a group must pass an equivalent one
+
+        Returns
+        -------
+        R
+            The result for this item
+        """
+        if not self.enabled:
+            result = run_batch([item])[0]
+            self.batch_size.observe(1)
+            if isinstance(result, BaseException):
+                raise result
+            return result
+
+        request = _Request(item)
+        with self._condition:
+            queue = self._queues.setdefault(group, [])
+            queue.append(request)
+            self.queue_depth.observe(len(queue))
+            request.leader = len(queue) == 1
+            if len(queue) >= self.max_batch_size:
+                self._condition.notify_all()
+        if not request.leader:
+            request.wake.wait()
+        if request.leader:
+            self._lead(group, run_batch)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self, group: Hashable) -> List[_Request]:
+        deadline = time.monotonic() + self.max_wait
+        with self._condition:
+            queue = self._queues[group]
+            while len(queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = queue[: self.max_batch_size]
+            del queue[: self.max_batch_size]
+            if queue:
+                queue[0].leader = True
+                queue[0].wake.set()
+            else:
+                del self._queues[group]
+        self.batch_size.observe(len(batch))
+        return batch
+
+    def _lead(self, group: Hashable, run_batch: Callable[[List[T]], List[R]]) -> None:
+        batch = self._collect(group)
+        try:
+            results = run_batch([request.item for request in batch])
+            for request, result in zip(batch, results, strict=True):
+                if isinstance(result, BaseException):
+                    request.error = result
+                else:
+                    request.result = result
+        except BaseException as e:
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                request.leader = False
+                request.wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Report the batching settings and histograms of queue depth on arrival and of batch sizes
+        """
+        with self._condition:
+            waiting = sum(len(queue) for queue in self._queues.values())
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "waiting": waiting,
+            "queue_depth": self.queue_depth.snapshot(),
+            "batch_size": self.batch_size.snapshot(),
+        }
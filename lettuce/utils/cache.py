@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple
+
+
+class TieredCache:
+    """
+    A byte-valued cache with an in-memory LRU tier and an optional SQLite tier
+
+    Lookups check memory first, then disk. A disk hit is promoted into memory.
+    Writes go to both tiers, so the disk tier survives restarts and is shared by processes pointing at the same file.
+    All methods are thread-safe.
+
+    Parameters
+    ----------
+    max_entries: int
+        The number of entries held in memory before the least recently used is evicted
+    path: str | None
+        Path of a SQLite database for the persistent tier. If None, the cache is memory-only
+    table: str
+        The table used in the SQLite database, so several caches can share a file
+    """
+
+    def __init__(
+        self, max_entries: int = 10000, path: str | None = None, table: str = "cache"
+    ) -> None:
+        self._max_entries = max_entries
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+        self._table = table
+        self._db = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+            )
+            self._db.commit()
+
+    def _remember(self, key: str, value: bytes) -> None:
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> bytes | None:
+        """
+        Fetch a value, or None if neither tier holds the key
+        """
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute(
+                    f"SELECT value FROM {self._table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        """
+        Store a value in memory and, if configured, on disk
+        """
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO {self._table} (key, value) VALUES (?, ?)",
+                    (key, value),
+                )
+                self._db.commit()
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]) -> None:
+        """
+        Store several values, writing them to disk in one transaction rather than committing each
+        """
+        items = list(items)
+        with self._lock:
+            for key, value in items:
+                self._remember(key, value)
+            if self._db is not None and items:
+                self._db.executemany(
+                    f"INSERT OR REPLACE INTO {self._table} (key, value) VALUES (?, ?)",
+                    items,
+                )
+                self._db.commit()
+
+    def clear(self) -> None:
+        """
+        Empty both tiers and reset the counters
+        """
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute(f"DELETE FROM {self._table}")
+                self._db.commit()
+            self.memory_hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Report hit and miss counts
+
+        Returns
+        -------
+        Dict[str, float]
+            Counts of memory hits, disk hits and misses, the number of entries in memory, and the overall hit rate
+        """
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,44 @@
+import bisect
+import threading
+from typing import Dict, Sequence
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, cumulatively as Prometheus does
+
+    All methods are thread-safe.
+
+    Parameters
+    ----------
+    buckets: Sequence[float]
+        The upper bounds of the buckets, in increasing order. An unbounded "+Inf" bucket is added
+    """
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self._bounds = list(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._counts[bisect.bisect_left(self._bounds, value)] += 1
+            self._sum += value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts = [0] * (len(self._bounds) + 1)
+            self._sum = 0.0
+
+    def snapshot(self) -> Dict[str, object]:
+        """
+        Report the number of observations at or below each bound, the total count and the sum
+        """
+        with self._lock:
+            cumulative = {}
+            total = 0
+            for bound, count in zip([*self._bounds, "+Inf"], self._counts):
+                total += count
+                cumulative[f"{bound:g}" if bound != "+Inf" else bound] = total
+            return {"buckets": cumulative, "count": total, "sum": self._sum}